@@ -1,21 +1,63 @@
 import asyncio
 import json
+import logging
 import sqlite3
 import html
-from typing import List, Dict, Any, Tuple
+import re
+import sys
+import hashlib
+import gzip
+import difflib
+import random
+import struct
+import zlib
+import heapq
+import itertools
+import multiprocessing
+import os
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+from typing import List, Dict, Any, NamedTuple, Tuple, Callable, Optional
 
-from aiogram import Bot, Dispatcher, F
+from aiohttp import web, ClientSession, ClientError, UnixConnector
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
     InputMediaPhoto, InputMediaVideo,
-    ReplyKeyboardMarkup, KeyboardButton
+    ReplyKeyboardMarkup, KeyboardButton,
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent,
+    Update,
 )
+from aiogram.filters import Command, StateFilter
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter, TelegramNetworkError, TelegramServerError,
+)
+from aiogram.methods import DeleteMessages, EditMessageCaption, SendMediaGroup, SendMessage, TelegramMethod
+
+import config
+from config import (
+    BOT_TOKEN, CHANNEL_ID, MOD_GROUP_ID, DB_PATH,
+    WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE,
+    ADMIN_TOKEN, SHARDS,
+    PUBLISH_INTERVAL, PUBLISH_SLOTS, PUBLISH_TZ,
+    BUMP_INTERVAL, ARCHIVE_AFTER, ARCHIVE_DIR,
+)
 
-from config import BOT_TOKEN, CHANNEL_ID, MOD_GROUP_ID
+# Номер цього процесу серед SHARDS воркерів (0 — єдиний або головний)
+SHARD = 0
 
 # ---------- MODERATORS ----------
 MODERATOR_IDS = {535860827, 688059959, 669987059, 464271249}
@@ -26,6 +68,14 @@ SOURCE_TAG = "@car_spot_ua"
 # Максимальна довжина опису
 MAX_DESCRIPTION_LENGTH = 1000
 
+# Максимум медіа в одному оголошенні (ліміт альбому Telegram)
+MAX_MEDIA = 10
+
+# Обмеження на медіа, перевіряються одразу при завантаженні
+MAX_VIDEO_SIZE = 50 * 1024 * 1024   # байт
+MAX_VIDEO_DURATION = 180            # секунд
+MIN_PHOTO_SIDE = 400                # пікселів по меншій стороні
+
 # Хештеги (можеш редагувати як хочеш)
 TAGS = [
     # КПП
@@ -42,35 +92,732 @@ TAGS = [
     "#бензин", "#дизель", "#електро", "#гібрид", "#газ",
 ]
 
+# ---------- Metrics ----------
+# Мінімальні метрики у форматі Prometheus (без зовнішніх залежностей).
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(key)} {value}" for key, value in self.values.items()]
+        return lines
+
+
+class Histogram:
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        # labels -> [лічильники по бакетах..., сума, кількість]
+        self.values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(key)} {series[-1]}")
+        return lines
+
+
+def _labels(key: tuple) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in key) + "}"
+
+def gauge(name: str, help_text: str, values: Dict[tuple, float]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    lines += [f"{name}{_labels(key)} {value}" for key, value in values.items()]
+    return lines
+
+
+HANDLER_SECONDS = Histogram("bazar_handler_seconds", "Час обробки апдейту хендлером")
+HANDLER_ERRORS = Counter("bazar_handler_errors_total", "Винятки в хендлерах")
+DB_SECONDS = Histogram("bazar_db_query_seconds", "Час виконання запитів SQLite")
+API_SECONDS = Histogram("bazar_telegram_api_seconds", "Час запитів до Telegram Bot API")
+API_ERRORS = Counter("bazar_telegram_api_errors_total", "Помилки запитів до Telegram Bot API")
+
 # ---------- DB ----------
-db = sqlite3.connect("autobazar.db")
-cur = db.cursor()
-cur.execute("""
-CREATE TABLE IF NOT EXISTS submissions (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id INTEGER,
-  username TEXT,
-  answers TEXT,
-  photos TEXT,
-  status TEXT DEFAULT 'pending'
+class Storage:
+    """Асинхронна обгортка над SQLite.
+
+    Усі запити виконуються в окремих потоках, тому event loop не блокується
+    на fsync. Запис іде через одне з'єднання (SQLite все одно має одного
+    writer'а), читання — через пул з'єднань, які в режимі WAL не чекають на запис.
+    """
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None  # з'єднання запису, див. open()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+
+    def open(self):
+        """Відкриває з'єднання запису; до цього модуль можна імпортувати без файлу БД."""
+        if self.conn is None:
+            conn = self._connect()
+            # діє лише для нової порожньої БД; старі переводить Archiver
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.conn = conn
+
+    def _connect(self) -> sqlite3.Connection:
+        # cached_statements — кеш підготовлених запитів усередині sqlite3
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _read(self, fn: Callable[[sqlite3.Connection], Any]):
+        def run():
+            start = time.perf_counter()
+            try:
+                return fn(self._reader_conn())
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - start, op="read")
+        return asyncio.get_running_loop().run_in_executor(self._readers, run)
+
+    def _write(self, fn: Callable[[sqlite3.Connection], Any]):
+        def run():
+            start = time.perf_counter()
+            try:
+                with self.conn:  # commit / rollback
+                    return fn(self.conn)
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - start, op="write")
+        return asyncio.get_running_loop().run_in_executor(self._writer, run)
+
+    async def read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Виконує fn(conn) на з'єднанні читання (кілька запитів з одного знімка WAL)."""
+        return await self._read(fn)
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        return await self._read(lambda c: c.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[tuple]:
+        return await self._read(lambda c: c.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Виконує запит і повертає rowcount.
+
+        Курсор лишається в потоці запису: читати чи прибирати його з event loop'а
+        не можна (sqlite3 падає з «bad parameter or other API misuse»).
+        """
+        return await self._write(lambda c: c.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, rows: List[tuple]) -> int:
+        return await self._write(lambda c: c.executemany(sql, rows).rowcount)
+
+    async def transaction(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Виконує fn(conn) в одній транзакції на з'єднанні запису."""
+        return await self._write(fn)
+
+
+# ---------- Migrations ----------
+# Кожна міграція виконується один раз; номер останньої зберігається в PRAGMA user_version.
+# Нову міграцію додаємо лише в кінець списку.
+
+def _columns(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def _submission_rows(conn: sqlite3.Connection, columns: str, chunk: int = 10_000):
+    """Усі заявки порціями по id: fetchall() на мільйоні рядків тримав би в пам'яті всі answers."""
+    last = 0
+    while True:
+        rows = conn.execute(
+            f"SELECT id, {columns} FROM submissions WHERE id > ? ORDER BY id LIMIT ?", (last, chunk)
+        ).fetchall()
+        if not rows:
+            return
+        yield from rows
+        last = rows[-1][0]
+
+def _m1_base(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS submissions (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER,
+      username TEXT,
+      answers TEXT,
+      photos TEXT,
+      status TEXT DEFAULT 'pending'
+    )
+    """)
+    # старі бази могли бути створені без цих колонок
+    cols = _columns(conn, "submissions")
+    if "tags" not in cols:
+        conn.execute("ALTER TABLE submissions ADD COLUMN tags TEXT DEFAULT '[]'")
+    if "media_types" not in cols:
+        conn.execute("ALTER TABLE submissions ADD COLUMN media_types TEXT DEFAULT '[]'")
+
+def _m2_timestamps(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE submissions ADD COLUMN created_at INTEGER")
+    conn.execute("ALTER TABLE submissions ADD COLUMN updated_at INTEGER")
+    # для старих рядків точного часу немає — ставимо час міграції, порядок зберігає id
+    conn.execute("UPDATE submissions SET created_at=strftime('%s','now'), updated_at=strftime('%s','now')")
+    conn.execute("""
+    CREATE TRIGGER submissions_updated_at AFTER UPDATE ON submissions
+    BEGIN
+      UPDATE submissions SET updated_at=strftime('%s','now') WHERE id=NEW.id;
+    END
+    """)
+    conn.execute("CREATE INDEX idx_submissions_status_created ON submissions (status, created_at)")
+    conn.execute("CREATE INDEX idx_submissions_user ON submissions (user_id)")
+
+def _m3_media_and_tags(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE submission_media (
+      sub_id INTEGER NOT NULL REFERENCES submissions(id),
+      position INTEGER NOT NULL,
+      file_id TEXT NOT NULL,
+      media_type TEXT NOT NULL,
+      PRIMARY KEY (sub_id, position)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    conn.execute("""
+    CREATE TABLE submission_tags (
+      sub_id INTEGER NOT NULL REFERENCES submissions(id),
+      tag_id INTEGER NOT NULL REFERENCES tags(id),
+      PRIMARY KEY (sub_id, tag_id)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX idx_submission_tags_tag ON submission_tags (tag_id, sub_id)")
+
+    # перенос існуючих JSON-даних
+    for sub_id, photos_json, media_types_json, tags_json in _submission_rows(conn, "photos, media_types, tags"):
+        photos = json.loads(photos_json or "[]")
+        media_types = json.loads(media_types_json or "[]") or ["photo"] * len(photos)
+        # не _save_media: вона пише колонки пізніших міграцій
+        conn.executemany(
+            "INSERT INTO submission_media (sub_id, position, file_id, media_type) VALUES (?, ?, ?, ?)",
+            [(sub_id, i, *row) for i, row in enumerate(zip(photos, media_types))]
+        )
+        _save_tags(conn, sub_id, json.loads(tags_json or "[]"))
+
+def _m4_outbox(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE outbox (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      sub_id INTEGER,
+      kind TEXT NOT NULL,
+      payload TEXT NOT NULL DEFAULT '{}',
+      status TEXT NOT NULL DEFAULT 'pending',
+      attempts INTEGER NOT NULL DEFAULT 0,
+      last_error TEXT,
+      next_attempt_at INTEGER NOT NULL DEFAULT (strftime('%s','now')),
+      created_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+    )
+    """)
+    conn.execute("CREATE INDEX idx_outbox_status_next ON outbox (status, next_attempt_at)")
+
+def _m5_caption(conn: sqlite3.Connection):
+    # готовий підпис і маска тегів, з якими він зрендерений
+    conn.execute("ALTER TABLE submissions ADD COLUMN caption TEXT")
+    conn.execute("ALTER TABLE submissions ADD COLUMN caption_tags INTEGER")
+
+def _m6_mod_sessions(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE mod_sessions (
+      moder_id INTEGER NOT NULL,
+      kind TEXT NOT NULL,
+      sub_id INTEGER NOT NULL,
+      value INTEGER NOT NULL,
+      expires_at INTEGER NOT NULL,
+      PRIMARY KEY (moder_id, kind, sub_id)
+    )
+    """)
+    conn.execute("CREATE INDEX idx_mod_sessions_expires ON mod_sessions (expires_at)")
+
+def _m7_status_counts(conn: sqlite3.Connection):
+    # лічильники заявок за статусом, які оновлюються тригерами — без COUNT(*) по таблиці
+    conn.execute("CREATE TABLE submission_counts (status TEXT PRIMARY KEY, n INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("INSERT INTO submission_counts SELECT status, COUNT(*) FROM submissions GROUP BY status")
+    conn.execute("""
+    CREATE TRIGGER submission_counts_insert AFTER INSERT ON submissions
+    BEGIN
+      INSERT INTO submission_counts (status, n) VALUES (NEW.status, 1)
+        ON CONFLICT(status) DO UPDATE SET n = n + 1;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER submission_counts_update AFTER UPDATE OF status ON submissions
+    WHEN OLD.status IS NOT NEW.status
+    BEGIN
+      UPDATE submission_counts SET n = n - 1 WHERE status = OLD.status;
+      INSERT INTO submission_counts (status, n) VALUES (NEW.status, 1)
+        ON CONFLICT(status) DO UPDATE SET n = n + 1;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER submission_counts_delete AFTER DELETE ON submissions
+    BEGIN
+      UPDATE submission_counts SET n = n - 1 WHERE status = OLD.status;
+    END
+    """)
+
+def _m8_search(conn: sqlite3.Connection):
+    # повнотекстовий індекс опублікованих оголошень; rowid = id заявки
+    conn.execute("""
+    CREATE VIRTUAL TABLE listings_fts USING fts5(
+      car_title, city, description,
+      tokenize='unicode61 remove_diacritics 2'
+    )
+    """)
+    conn.execute(f"INSERT INTO listings_fts (rowid, car_title, city, description) {_FTS_SELECT} WHERE status='approved'")
+
+# поля для індексу беремо прямо з answers
+_FTS_SELECT = (
+    "SELECT id, json_extract(answers, '$.car_title'), json_extract(answers, '$.city'), "
+    "json_extract(answers, '$.description') FROM submissions"
 )
-""")
-db.commit()
-
-# додамо колонку tags (якщо ще нема)
-try:
-    cur.execute("ALTER TABLE submissions ADD COLUMN tags TEXT DEFAULT '[]'")
-    db.commit()
-except sqlite3.OperationalError:
-    # колонка вже існує
-    pass
-
-# додамо колонку для збереження типу медіа (photo/video)
-try:
-    cur.execute("ALTER TABLE submissions ADD COLUMN media_types TEXT DEFAULT '[]'")
-    db.commit()
-except sqlite3.OperationalError:
-    pass
+
+def _m9_suggested_tags(conn: sqlite3.Connection):
+    # маска тегів, підказаних автоматично при подачі (див. suggest_tags)
+    conn.execute("ALTER TABLE submissions ADD COLUMN suggested_tags INTEGER NOT NULL DEFAULT 0")
+
+def _m10_duplicates(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE submission_media ADD COLUMN file_unique_id TEXT")
+    conn.execute("CREATE INDEX idx_submission_media_unique ON submission_media (file_unique_id)")
+    conn.execute("ALTER TABLE submissions ADD COLUMN minhash BLOB")
+    # LSH-кошики MinHash-підписів: однаковий band_key — кандидат у дублікати
+    conn.execute("""
+    CREATE TABLE dup_lsh (
+      band_key INTEGER NOT NULL,
+      sub_id INTEGER NOT NULL,
+      PRIMARY KEY (band_key, sub_id)
+    ) WITHOUT ROWID
+    """)
+    for sub_id, answers in _submission_rows(conn, "answers"):
+        _save_signature(conn, sub_id, listing_signature(json.loads(answers or "{}")))
+
+def _m11_publish_schedule(conn: sqlite3.Connection):
+    # для пошуку останнього запланованого поста (MAX(next_attempt_at) по kind)
+    conn.execute("CREATE INDEX idx_outbox_kind_next ON outbox (kind, next_attempt_at)")
+
+def _m12_listing_lifecycle(conn: sqlite3.Connection):
+    # id повідомлень альбому в каналі — щоб редагувати підпис, а не перепостити
+    conn.execute("""
+    CREATE TABLE channel_posts (
+      sub_id INTEGER NOT NULL,
+      position INTEGER NOT NULL,
+      message_id INTEGER NOT NULL,
+      PRIMARY KEY (sub_id, position)
+    ) WITHOUT ROWID
+    """)
+    # правки продавця, що чекають модерації (лише змінене поле)
+    conn.execute("""
+    CREATE TABLE listing_edits (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      sub_id INTEGER NOT NULL,
+      field TEXT NOT NULL,
+      value TEXT NOT NULL,
+      status TEXT NOT NULL DEFAULT 'pending',
+      created_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+    )
+    """)
+    conn.execute("CREATE INDEX idx_listing_edits_sub ON listing_edits (sub_id, status)")
+    conn.execute("ALTER TABLE submissions ADD COLUMN published_at INTEGER")
+    conn.execute("ALTER TABLE submissions ADD COLUMN bumped_at INTEGER")
+
+def _m13_media_meta(conn: sqlite3.Connection):
+    # метадані файлів з Message (без завантаження самих файлів); user_id — хто надіслав першим
+    conn.execute("""
+    CREATE TABLE media_meta (
+      file_unique_id TEXT PRIMARY KEY,
+      media_type TEXT NOT NULL,
+      file_size INTEGER,
+      width INTEGER,
+      height INTEGER,
+      duration INTEGER,
+      mime_type TEXT,
+      user_id INTEGER NOT NULL,
+      seen_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+    ) WITHOUT ROWID
+    """)
+
+def _m14_fsm_state(conn: sqlite3.Connection):
+    # раніше таблицю створював SQLiteStorage при кожному старті
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_state (
+      key TEXT PRIMARY KEY,
+      state TEXT,
+      data TEXT,
+      updated_at REAL
+    )
+    """)
+
+def _m15_typed_fields(conn: sqlite3.Connection):
+    # розібрані значення з анкети — для фільтрів за ціною/пробігом/містом по індексу
+    conn.execute("ALTER TABLE submissions ADD COLUMN price_amount INTEGER")
+    conn.execute("ALTER TABLE submissions ADD COLUMN price_currency TEXT")
+    conn.execute("ALTER TABLE submissions ADD COLUMN mileage_km INTEGER")
+    conn.execute("ALTER TABLE submissions ADD COLUMN city TEXT")
+    # фільтри потрібні лише серед опублікованих — часткові індекси менші
+    conn.execute("CREATE INDEX idx_submissions_price ON submissions (price_currency, price_amount) WHERE status='approved'")
+    conn.execute("CREATE INDEX idx_submissions_mileage ON submissions (mileage_km) WHERE status='approved'")
+    conn.execute("CREATE INDEX idx_submissions_city ON submissions (city) WHERE status='approved'")
+    for sub_id, answers in _submission_rows(conn, "answers"):
+        _save_typed(conn, sub_id, json.loads(answers or "{}"))
+
+def _m16_archive(conn: sqlite3.Connection):
+    # час, коли повні дані заявки перенесено в архівний файл (рядок лишається заглушкою)
+    conn.execute("ALTER TABLE submissions ADD COLUMN archived_at INTEGER")
+    conn.execute("CREATE INDEX idx_submissions_archive ON submissions (updated_at) WHERE archived_at IS NULL")
+
+def _m17_subscriptions(conn: sqlite3.Connection):
+    # збережені пошуки; conditions — розібраний запит (див. parse_subscription)
+    conn.execute("""
+    CREATE TABLE subscriptions (
+      id INTEGER PRIMARY KEY,
+      user_id INTEGER NOT NULL,
+      query TEXT NOT NULL,
+      conditions TEXT NOT NULL,
+      created_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+    )
+    """)
+    conn.execute("CREATE INDEX idx_subscriptions_user ON subscriptions (user_id)")
+    # інвертований індекс: кожна підписка лежить під одним, найвужчим своїм ключем
+    conn.execute("""
+    CREATE TABLE subscription_keys (
+      key TEXT NOT NULL,
+      subscription_id INTEGER NOT NULL,
+      PRIMARY KEY (key, subscription_id)
+    ) WITHOUT ROWID
+    """)
+    # черга розсилки: хто ще не отримав сповіщення про пост
+    conn.execute("""
+    CREATE TABLE fanout_queue (
+      sub_id INTEGER NOT NULL,
+      subscription_id INTEGER NOT NULL,
+      PRIMARY KEY (sub_id, subscription_id)
+    ) WITHOUT ROWID
+    """)
+
+def _m18_changed_at(conn: sqlite3.Connection):
+    # час останньої змістовної зміни (статус, відповіді, підняття) — від нього рахується архівація;
+    # updated_at оновлюють і службові записи (перерендер підпису, перерахунок тегів)
+    conn.execute("ALTER TABLE submissions ADD COLUMN changed_at INTEGER")
+    # точний час відомий для публікацій, піднять і правок; для решти — updated_at як верхня межа
+    conn.execute("""
+    UPDATE submissions SET changed_at = CASE WHEN status IN ('approved', 'denied') THEN MAX(
+        COALESCE(created_at, 0), COALESCE(published_at, 0), COALESCE(bumped_at, 0),
+        COALESCE((SELECT MAX(e.created_at) FROM listing_edits e WHERE e.sub_id = submissions.id), 0)
+      ) ELSE updated_at END
+    """)
+    conn.execute("""
+    CREATE TRIGGER submissions_changed_at AFTER UPDATE OF status, answers, bumped_at ON submissions
+    WHEN OLD.status IS NOT NEW.status OR OLD.answers IS NOT NEW.answers OR OLD.bumped_at IS NOT NEW.bumped_at
+    BEGIN
+      UPDATE submissions SET changed_at=strftime('%s','now') WHERE id=NEW.id;
+    END
+    """)
+    conn.execute("DROP INDEX idx_submissions_archive")
+    conn.execute("CREATE INDEX idx_submissions_archive ON submissions (changed_at) WHERE archived_at IS NULL")
+
+def _m19_search_active(conn: sqlite3.Connection):
+    # архівні заглушки лишаються зі статусом approved — з пошуку й фільтрів їх прибирає archived_at
+    for name, columns in (("price", "price_currency, price_amount"), ("mileage", "mileage_km"), ("city", "city")):
+        conn.execute(f"DROP INDEX idx_submissions_{name}")
+        conn.execute(
+            f"CREATE INDEX idx_submissions_{name} ON submissions ({columns}) "
+            "WHERE status='approved' AND archived_at IS NULL"
+        )
+
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _m1_base,
+    _m2_timestamps,
+    _m3_media_and_tags,
+    _m4_outbox,
+    _m5_caption,
+    _m6_mod_sessions,
+    _m7_status_counts,
+    _m8_search,
+    _m9_suggested_tags,
+    _m10_duplicates,
+    _m11_publish_schedule,
+    _m12_listing_lifecycle,
+    _m13_media_meta,
+    _m14_fsm_state,
+    _m15_typed_fields,
+    _m16_archive,
+    _m17_subscriptions,
+    _m18_changed_at,
+    _m19_search_active,
+]
+
+def migrate(conn: sqlite3.Connection):
+    """Кожна міграція разом із user_version — одна явна транзакція.
+
+    sqlite3 сам відкриває транзакцію лише перед INSERT/UPDATE/DELETE, тож
+    CREATE/ALTER до першого такого запиту комітились одразу: міграція, що впала
+    посередині, лишала пів схеми зі старою версією, і повторний запуск падав.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    isolation, conn.isolation_level = conn.isolation_level, None
+    try:
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute("BEGIN")
+            try:
+                migration(conn)
+                conn.execute(f"PRAGMA user_version={number}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            print(f"DB migrated to v{number}")
+    finally:
+        conn.isolation_level = isolation
+
+# ---------- Submissions queries ----------
+# id тегів у таблиці tags (для пошуку); заповнюється після міграцій і в _save_tags
+TAG_IDS: Dict[str, int] = {}
+
+def _save_media(conn: sqlite3.Connection, sub_id: int, photos: List[str], media_types: List[str],
+                media_uids: Optional[List[Optional[str]]] = None):
+    uids = list(media_uids or [])
+    uids += [None] * (len(photos) - len(uids))
+    conn.executemany(
+        "INSERT INTO submission_media (sub_id, position, file_id, media_type, file_unique_id) VALUES (?, ?, ?, ?, ?)",
+        [(sub_id, i, *row) for i, row in enumerate(zip(photos, media_types, uids))]
+    )
+
+def _save_channel_posts(conn: sqlite3.Connection, sub_id: int, messages: List[Message]):
+    conn.execute("DELETE FROM channel_posts WHERE sub_id=?", (sub_id,))
+    conn.executemany(
+        "INSERT INTO channel_posts (sub_id, position, message_id) VALUES (?, ?, ?)",
+        [(sub_id, i, msg.message_id) for i, msg in enumerate(messages)]
+    )
+
+def _save_typed(conn: sqlite3.Connection, sub_id: int, data: Dict[str, Any]):
+    price = parse_amount(data.get("price"))
+    conn.execute(
+        "UPDATE submissions SET price_amount=?, price_currency=?, mileage_km=?, city=? WHERE id=?",
+        (price[0] if price else None, price[1] if price else None,
+         parse_mileage(data.get("mileage")), canonical_city(data.get("city")), sub_id)
+    )
+
+def _save_signature(conn: sqlite3.Connection, sub_id: int, signature: List[int]):
+    conn.execute("UPDATE submissions SET minhash=? WHERE id=?", (pack_signature(signature), sub_id))
+    conn.executemany(
+        "INSERT OR IGNORE INTO dup_lsh (band_key, sub_id) VALUES (?, ?)",
+        [(key, sub_id) for key in lsh_bands(signature)]
+    )
+
+def _save_tags(conn: sqlite3.Connection, sub_id: int, tags: List[str]):
+    conn.execute("DELETE FROM submission_tags WHERE sub_id=?", (sub_id,))
+    conn.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(t,) for t in tags])
+    for tag in tags:
+        if tag not in TAG_IDS:
+            TAG_IDS[tag] = conn.execute("SELECT id FROM tags WHERE name=?", (tag,)).fetchone()[0]
+    conn.executemany(
+        "INSERT OR IGNORE INTO submission_tags (sub_id, tag_id) SELECT ?, id FROM tags WHERE name=?",
+        [(sub_id, t) for t in tags]
+    )
+
+async def load_media(sub_id: int) -> Tuple[List[str], List[str]]:
+    rows = await db.fetchall(
+        "SELECT file_id, media_type FROM submission_media WHERE sub_id=? ORDER BY position", (sub_id,)
+    )
+    return [r[0] for r in rows], [r[1] for r in rows]
+
+async def status_counts() -> Dict[str, int]:
+    return dict(await db.fetchall("SELECT status, n FROM submission_counts WHERE n > 0"))
+
+async def pending_page(after: Optional[Tuple[int, int]] = None, limit: int = 10) -> List[tuple]:
+    """Сторінка заявок на модерації, від найстаріших (keyset-пагінація по (created_at, id)).
+
+    Повертає (id, created_at, user_id, username, car_title).
+    """
+    created_at, last_id = after or (-1, 0)
+    return await db.fetchall(
+        "SELECT id, created_at, user_id, username, json_extract(answers, '$.car_title') FROM submissions "
+        "WHERE status='pending' AND (created_at, id) > (?, ?) "
+        "ORDER BY created_at, id LIMIT ?",
+        (created_at, last_id, limit)
+    )
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Курсор сторінки у вигляді «created_at:id»."""
+    if not cursor:
+        return None
+    created_at, last_id = cursor.split(":")
+    return int(created_at), int(last_id)
+
+def index_listing(conn: sqlite3.Connection, sub_id: int):
+    """Додає опубліковане оголошення в повнотекстовий індекс (теги вже в submission_tags)."""
+    conn.execute("DELETE FROM listings_fts WHERE rowid=?", (sub_id,))
+    conn.execute(f"INSERT INTO listings_fts (rowid, car_title, city, description) {_FTS_SELECT} WHERE id=?", (sub_id,))
+
+_FILTER_RE = re.compile(r"(ціна|цена|пробіг|пробег)([<>])(.+)")
+_FILTER_COLUMNS = {"ціна": "price", "цена": "price", "пробіг": "mileage", "пробег": "mileage"}
+
+class Filter(NamedTuple):
+    column: str               # price | mileage
+    op: str                   # < | >
+    value: int
+    currency: Optional[str]   # лише для ціни
+
+    def sql(self) -> Tuple[str, Tuple[Any, ...]]:
+        if self.column == "mileage":
+            return f"s.mileage_km {self.op} ?", (self.value,)
+        return f"s.price_currency = ? AND s.price_amount {self.op} ?", (self.currency, self.value)
+
+    def check(self, amount: Optional[int], currency: Optional[str] = None) -> bool:
+        if amount is None or (self.column == "price" and currency != self.currency):
+            return False
+        return amount < self.value if self.op == "<" else amount > self.value
+
+def parse_filter(token: str) -> Optional[Filter]:
+    """«ціна<10к» → фільтр по price_amount (без валюти — $), «пробіг<150т» → по mileage_km."""
+    match = _FILTER_RE.fullmatch(token)
+    if not match:
+        return None
+    column, op, value = _FILTER_COLUMNS[match.group(1)], match.group(2), match.group(3)
+    if column == "mileage":
+        km = parse_mileage(value)
+        return Filter(column, op, km, None) if km is not None else None
+    price = parse_amount(value)
+    if not price:
+        return None
+    return Filter(column, op, price[0], price[1] or "USD")
+
+def parse_search(query: str) -> Tuple[List[str], List[str], List[Filter]]:
+    """«audi #дизель до10к пробіг<150т» → (["audi"], ["#дизель", "#до10к"], [умова пробігу]).
+
+    Слова, що збігаються з тегом, — теж теги.
+    """
+    words, tags, filters = [], [], []
+    for token in query.lower().split():
+        condition = parse_filter(token)
+        if condition:
+            filters.append(condition)
+            continue
+        tag = token if token.startswith("#") else "#" + token
+        if tag in TAG_INDEX:
+            tags.append(tag)
+        elif not token.startswith("#"):
+            word = re.sub(r"[^\w]+", " ", token).strip()
+            if word:
+                words.extend(word.split())
+    return words, tags, filters
+
+async def search_listings(query: str, before: Optional[int] = None, limit: int = 20) -> List[tuple]:
+    """Пошук серед опублікованих оголошень, від найновіших.
+
+    Сторінку веде індекс, уже впорядкований за id: для слів — FTS5 (префіксний
+    збіг, rowid = id заявки) або submission_tags (tag_id, sub_id) для тегу. Він
+    читається у зворотному порядку від before, решта умов (інші теги — EXISTS,
+    фільтри ціни й пробігу, статус) перевіряються точково, тож запит зупиняється,
+    щойно набере limit рядків, і не сортує всі збіги; CROSS JOIN не дає
+    планувальнику переставити таблиці. Фільтри без слів і тегів ідуть по
+    часткових індексах submissions.
+    Повертає (id, caption, car_title, price, city).
+    """
+    words, tags, filters = parse_search(query)
+    if any(t not in TAG_IDS for t in tags):
+        # тег міг з'явитися в іншому процесі (див. SHARDS)
+        TAG_IDS.update((name, tag_id) for tag_id, name in await db.fetchall("SELECT id, name FROM tags"))
+    tag_ids = [TAG_IDS[t] for t in tags if t in TAG_IDS]
+    if len(tag_ids) < len(tags):
+        return []  # такого тегу ще ніхто не ставив
+
+    conds: List[str] = []
+    params: List[Any] = []
+    if words:
+        source, key = "listings_fts m CROSS JOIN submissions s ON s.id = m.rowid", "m.rowid"
+        conds.append("listings_fts MATCH ?")
+        params.append(" ".join(f'"{w}"*' for w in words))
+    elif tag_ids:
+        source, key = "submission_tags m CROSS JOIN submissions s ON s.id = m.sub_id", "m.sub_id"
+        conds.append("m.tag_id = ?")
+        params.append(tag_ids.pop(0))
+    elif filters:
+        source, key = "submissions s", "s.id"
+    else:
+        source, key = "listings_fts m CROSS JOIN submissions s ON s.id = m.rowid", "m.rowid"
+    if before:
+        conds.append(f"{key} < ?")
+        params.append(before)
+
+    conds += ["s.status='approved'", "s.archived_at IS NULL"]
+    for condition, values in map(Filter.sql, filters):
+        conds.append(condition)
+        params.extend(values)
+    for tag_id in tag_ids:
+        conds.append("EXISTS (SELECT 1 FROM submission_tags t WHERE t.sub_id=s.id AND t.tag_id=?)")
+        params.append(tag_id)
+    params.append(limit)
+
+    return await db.fetchall(
+        f"SELECT s.id, s.caption, json_extract(s.answers, '$.car_title'), json_extract(s.answers, '$.price'), "
+        f"json_extract(s.answers, '$.city') FROM {source} "
+        f"WHERE {' AND '.join(conds)} ORDER BY {key} DESC LIMIT ?",
+        tuple(params)
+    )
+
+async def create_submission(user_id: int, username: str, data: Dict[str, Any],
+                            photos: List[str], media_types: List[str], caption: str,
+                            suggested_tags: int = 0, signature: Optional[List[int]] = None) -> int:
+    def write(conn: sqlite3.Connection) -> int:
+        sub_id = conn.execute(
+            "INSERT INTO submissions (user_id, username, answers, caption, caption_tags, suggested_tags, "
+            "created_at, updated_at, changed_at) "
+            "VALUES (?, ?, ?, ?, 0, ?, strftime('%s','now'), strftime('%s','now'), strftime('%s','now'))",
+            (user_id, username, json.dumps(data, ensure_ascii=False), caption, suggested_tags)
+        ).lastrowid
+        _save_media(conn, sub_id, photos, media_types, data.get("media_uids"))
+        _save_signature(conn, sub_id, signature or listing_signature(data))
+        _save_typed(conn, sub_id, data)
+        return sub_id
+    return await db.transaction(write)
+
+
+db = Storage(DB_PATH)
+
+def open_db():
+    """Відкриває БД; міграції виконуються, лише якщо user_version відстає від MIGRATIONS."""
+    if db.conn is None:
+        db.open()
+        migrate(db.conn)
+        TAG_IDS.update((name, tag_id) for tag_id, name in db.conn.execute("SELECT id, name FROM tags"))
 
 # ---------- FSM ----------
 class Form(StatesGroup):
@@ -87,18 +834,173 @@ class Form(StatesGroup):
     photo_back = State()     # 2) ззаду
     photos_extra = State()   # 3) решта
 
+
+class ModForm(StatesGroup):
+    deny_reason = State()    # модератор пише причину відмови
+    batch_deny_reason = State()    # причина відмови для вибраних у /queue
+
+
+class EditForm(StatesGroup):
+    value = State()          # продавець пише нове значення поля
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-сховище в autobazar.db, щоб незавершені оголошення переживали рестарт.
+
+    Зміни накопичуються в пам'яті й раз на flush_interval записуються однією
+    транзакцією. Записи, яких не чіпали cache_ttl, вивантажуються з пам'яті,
+    а чернетки старші за ttl видаляються з БД.
+    """
+
+    def __init__(self, db: Storage, flush_interval: float = 1.0,
+                 cache_ttl: float = 15 * 60, ttl: float = 7 * 24 * 3600):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder()
+        # key -> [state, data, last_access]
+        self._cache: Dict[str, list] = {}
+        self._dirty: set = set()
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def _record(self, key: StorageKey) -> list:
+        k = self.key_builder.build(key)
+        rec = self._cache.get(k)
+        if rec is None:
+            row = await self.db.fetchone("SELECT state, data FROM fsm_state WHERE key=?", (k,))
+            loaded = [row[0], json.loads(row[1])] if row else [None, {}]
+            # поки читали, запис міг з'явитися в кеші — він новіший
+            rec = self._cache.setdefault(k, loaded + [0.0])
+        rec[2] = time.monotonic()
+        return rec
+
+    def _touch(self, key: StorageKey):
+        self._dirty.add(self.key_builder.build(key))
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        rec = await self._record(key)
+        rec[0] = state.state if isinstance(state, State) else state
+        self._touch(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        rec = await self._record(key)
+        rec[1] = data.copy()
+        self._touch(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key))[1].copy()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        now = time.time()
+        upserts, deletes = [], []
+        for k in keys:
+            state, data, _ = self._cache[k]
+            if state is None and not data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, state, json.dumps(data, ensure_ascii=False), now))
+
+        def write(conn: sqlite3.Connection):
+            conn.executemany(
+                "INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at",
+                upserts
+            )
+            conn.executemany("DELETE FROM fsm_state WHERE key=?", deletes)
+
+        try:
+            await self.db.transaction(write)
+        except BaseException:
+            # не записали — ключі знову брудні, наступний flush повторить спробу
+            self._dirty |= keys
+            raise
+
+    def _evict(self):
+        # вивантажуємо з пам'яті записи, які вже збережені й давно не використовувались
+        deadline = time.monotonic() - self.cache_ttl
+        for k in [k for k, rec in self._cache.items() if rec[2] < deadline and k not in self._dirty]:
+            del self._cache[k]
+
+    async def sweep(self):
+        """Видаляє покинуті чернетки з БД."""
+        await self.db.execute("DELETE FROM fsm_state WHERE updated_at < ?", (time.time() - self.ttl,))
+
+    async def _flush_loop(self):
+        last_sweep = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                self._evict()
+                if time.monotonic() - last_sweep > 3600:
+                    await self.sweep()
+                    last_sweep = time.monotonic()
+            except Exception:
+                logging.exception("FSM flush failed")
+
+    def size(self) -> int:
+        return len(self._cache)
+
+    async def close(self) -> None:
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
 # ---------- Keyboards ----------
+# Статичні клавіатури будуються один раз (типи aiogram незмінні, тож їх можна
+# віддавати повторно), а залежні від заявки — кешуються через lru_cache.
+
+# Вибрані теги зберігаються як бітова маска: біт i — TAGS[i]
+TAG_INDEX: Dict[str, int] = {tag: i for i, tag in enumerate(TAGS)}
+
+def tags_to_mask(tags: List[str]) -> int:
+    mask = 0
+    for tag in tags:
+        if tag in TAG_INDEX:
+            mask |= 1 << TAG_INDEX[tag]
+    return mask
+
+def mask_to_tags(mask: int) -> List[str]:
+    return [tag for i, tag in enumerate(TAGS) if mask >> i & 1]
+
+_KB_DONE = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Готово ✅", callback_data="photos_done")]
+])
+
+_KB_SEND = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Надіслати на модерацію ✅", callback_data="send_mod")],
+    [InlineKeyboardButton(text="Скасувати ❌", callback_data="cancel")]
+])
+
+_MAIN_MENU_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🚗 Подати оголошення"), KeyboardButton(text="📋 Мої оголошення")],
+        [KeyboardButton(text="ℹ️ Як це працює"), KeyboardButton(text="🔄 Почати заново")],
+        [KeyboardButton(text="🔔 Підписки"), KeyboardButton(text="❌ Скасувати")]
+    ],
+    resize_keyboard=True
+)
+
 def kb_done():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Готово ✅", callback_data="photos_done")]
-    ])
+    return _KB_DONE
 
 def kb_send():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Надіслати на модерацію ✅", callback_data="send_mod")],
-        [InlineKeyboardButton(text="Скасувати ❌", callback_data="cancel")]
-    ])
+    return _KB_SEND
+
+def main_menu_kb():
+    return _MAIN_MENU_KB
 
+@lru_cache(maxsize=1024)
 def kb_mod(sub_id: int):
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -107,32 +1009,62 @@ def kb_mod(sub_id: int):
         ]
     ])
 
-def main_menu_kb():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🚗 Подати оголошення")],
-            [KeyboardButton(text="ℹ️ Як це працює"), KeyboardButton(text="🔄 Почати заново")],
-            [KeyboardButton(text="❌ Скасувати")]
-        ],
-        resize_keyboard=True
-    )
-
-def kb_approve_options(sub_id: int):
-    return InlineKeyboardMarkup(inline_keyboard=[
+@lru_cache(maxsize=1024)
+def kb_approve_options(sub_id: int, suggested: int = 0):
+    rows = []
+    if suggested:
+        rows.append([InlineKeyboardButton(
+            text="🚀 Постити з тегами: " + " ".join(mask_to_tags(suggested)),
+            callback_data=f"postsugg:{sub_id}"
+        )])
+    rows += [
         [InlineKeyboardButton(text="🏷 Додати хештеги", callback_data=f"addtags:{sub_id}")],
         [InlineKeyboardButton(text="🚀 Постити без хештегів", callback_data=f"postnow:{sub_id}")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+# Поля, які продавець може змінити після публікації
+EDITABLE_FIELDS = {"price": "💰 Ціна", "description": "📝 Опис"}
+
+@lru_cache(maxsize=1024)
+def kb_listing(sub_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"✏️ {label}", callback_data=f"edit:{sub_id}:{field}")
+         for field, label in EDITABLE_FIELDS.items()],
+        [
+            InlineKeyboardButton(text="✅ Продано", callback_data=f"sold:{sub_id}"),
+            InlineKeyboardButton(text="⬆️ Підняти", callback_data=f"bump:{sub_id}")
+        ]
     ])
 
-def kb_tags_picker(sub_id: int, selected: List[str]):
-    rows = []
-    # по 2 теги в ряд
-    for i in range(0, len(TAGS), 2):
-        row = []
-        for tag in TAGS[i:i+2]:
-            mark = "✅ " if tag in selected else ""
-            row.append(InlineKeyboardButton(text=f"{mark}{tag}", callback_data=f"tag:{sub_id}:{tag}"))
-        rows.append(row)
+@lru_cache(maxsize=1024)
+def kb_edit_mod(edit_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Approve", callback_data=f"editok:{edit_id}"),
+        InlineKeyboardButton(text="❌ Deny", callback_data=f"editno:{edit_id}")
+    ]])
+
+@lru_cache(maxsize=1024)
+def kb_reschedule(sub_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="🚀 Зараз", callback_data=f"resched:{sub_id}:now"),
+        InlineKeyboardButton(text="+1 год", callback_data=f"resched:{sub_id}:hour"),
+        InlineKeyboardButton(text="Завтра 09:00", callback_data=f"resched:{sub_id}:morning"),
+    ]])
 
+@lru_cache(maxsize=4096)
+def _tag_button(sub_id: int, index: int, marked: bool) -> InlineKeyboardButton:
+    # у callback — індекс тегу, а не сам тег (ліміт 64 байти)
+    return InlineKeyboardButton(text=f"{'✅ ' if marked else ''}{TAGS[index]}", callback_data=f"tag:{sub_id}:{index}")
+
+@lru_cache(maxsize=4096)
+def kb_tags_picker(sub_id: int, selected: int):
+    # кожен клік міняє маску, тож кеш клавіатури майже не влучає; кнопки ж повторюються —
+    # перебудовується лише та, що змінилась (валідація pydantic — основна ціна клавіатури)
+    rows = [
+        [_tag_button(sub_id, j, bool(selected >> j & 1)) for j in range(i, min(i + 2, len(TAGS)))]
+        for i in range(0, len(TAGS), 2)  # по 2 теги в ряд
+    ]
     rows.append([
         InlineKeyboardButton(text="✅ Готово", callback_data=f"tags_done:{sub_id}"),
         InlineKeyboardButton(text="↩️ Скасувати", callback_data=f"tags_cancel:{sub_id}")
@@ -143,263 +1075,2106 @@ def kb_tags_picker(sub_id: int, selected: List[str]):
 def esc(x: Any) -> str:
     return html.escape(str(x), quote=False).strip()
 
-def render_post(data: Dict[str, Any], tags: List[str] | None = None) -> str:
-    """Варіант 1: Мінімалістичний (без надписів)"""
-    car_title = esc(data.get("car_title", ""))
-    engine = esc(data.get("engine", ""))
-    gearbox = esc(data.get("gearbox", ""))
-    mileage = esc(data.get("mileage", ""))
-    city = esc(data.get("city", ""))
-    price = esc(data.get("price", ""))
-    contacts = esc(data.get("contacts", ""))
-    description = esc(data.get("description", ""))
-
-    base = (
-        f"🚗 <b>{car_title}</b>\n\n"
-        f"⚡ {engine}\n"
-        f"🔄 {gearbox}\n"
-        f"📏 {mileage} км\n\n"
-        f"📍 {city}\n"
-        f"💰 {price}\n"
-        f"📞 {contacts}\n\n"
-        f"📝 {description}\n\n"
-	f"━━━━━━━━━━━━━━━\n"
-		f"Подати оголошення — @car_spot_ua_bot \n\n"
-        f"Канал — {SOURCE_TAG}"
-    )
-
-    if tags:
-        tags_line = " ".join(tags)
-        return base + "\n\n" + tags_line
-    return base
+# Ліміт підпису до медіа в Telegram (рахується в UTF-16 символах, без HTML-тегів)
+CAPTION_LIMIT = 1024
 
-async def start_flow(m: Message, state: FSMContext):
-    await state.clear()
-    await m.answer("1️⃣ Назва авто (наприклад: Audi A4 2013)", reply_markup=main_menu_kb())
-    await state.set_state(Form.car_title)
+def tg_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def tg_cut(text: str, length: int) -> str:
+    return text.encode("utf-16-le")[:length * 2].decode("utf-16-le", errors="ignore")
+
+
+class PostTemplate:
+    """Шаблон поста, який розбирається один раз при старті.
+
+    Довжина постійної частини рахується заздалегідь, тож при рендері лишається
+    лише екранувати поля й підставити їх. Якщо пост не влазить у limit,
+    обрізається поле truncate (опис).
+    """
+
+    def __init__(self, template: str, fields: Tuple[str, ...], truncate: str, limit: int):
+        self.template = template
+        self.fields = fields
+        self.truncate = truncate
+        self.limit = limit
+        empty = template.format_map({f: "" for f in fields})
+        self.fixed_len = tg_len(re.sub(r"<[^>]+>", "", empty))
+
+    def render(self, data: Dict[str, Any], tags: List[str] | None = None, reserve: int = 0) -> str:
+        values = {f: str(data.get(f, "")).strip() for f in self.fields}
+        tags_line = " ".join(tags) if tags else ""
+
+        used = self.fixed_len + reserve + sum(tg_len(v) for v in values.values())
+        if tags_line:
+            used += tg_len("\n\n" + tags_line)
+        over = used - self.limit
+        if over > 0:
+            text = values[self.truncate]
+            values[self.truncate] = tg_cut(text, max(0, tg_len(text) - over - 1)).rstrip() + "…"
+
+        post = self.template.format_map({k: html.escape(v, quote=False) for k, v in values.items()})
+        if tags_line:
+            return post + "\n\n" + tags_line
+        return post
+
+
+# Варіант 1: Мінімалістичний (без надписів)
+POST_TEMPLATE = PostTemplate(
+    "🚗 <b>{car_title}</b>\n\n"
+    "⚡ {engine}\n"
+    "🔄 {gearbox}\n"
+    "📏 {mileage} км\n\n"
+    "📍 {city}\n"
+    "💰 {price}\n"
+    "📞 {contacts}\n\n"
+    "📝 {description}\n\n"
+    "━━━━━━━━━━━━━━━\n"
+    "Подати оголошення — @car_spot_ua_bot \n\n"
+    "Канал — " + SOURCE_TAG,
+    fields=("car_title", "engine", "gearbox", "mileage", "city", "price", "contacts", "description"),
+    truncate="description",
+    limit=CAPTION_LIMIT,
+)
+
+def render_post(data: Dict[str, Any], tags: List[str] | None = None, reserve: int = 0) -> str:
+    """reserve — скільки символів лишити під префікс (напр. номер заявки для модераторів)."""
+    return POST_TEMPLATE.render(data, tags, reserve)
+
+async def get_caption(sub_id: int, tags: List[str]) -> str:
+    """Підпис для публікації: береться готовий з БД, якщо теги не змінились."""
+    mask = tags_to_mask(tags)
+    caption, caption_tags = await db.fetchone("SELECT caption, caption_tags FROM submissions WHERE id=?", (sub_id,))
+    if caption is not None and caption_tags == mask:
+        return caption
+
+    answers_json, = await db.fetchone("SELECT answers FROM submissions WHERE id=?", (sub_id,))
+    caption = render_post(json.loads(answers_json), tags)
+    await db.execute("UPDATE submissions SET caption=?, caption_tags=? WHERE id=?", (caption, mask, sub_id))
+    return caption
+
+# Позначка проданого авто над підписом у каналі
+SOLD_MARK = "❌ <b>ПРОДАНО</b>\n\n"
+
+async def listing_caption(sub_id: int) -> str:
+    """Підпис уже опублікованого оголошення: з поточними відповідями, тегами і статусом."""
+    answers_json, mask, status = await db.fetchone(
+        "SELECT answers, caption_tags, status FROM submissions WHERE id=?", (sub_id,)
+    )
+    if status == "sold":
+        caption = SOLD_MARK + render_post(json.loads(answers_json), mask_to_tags(mask or 0), reserve=tg_len("❌ ПРОДАНО\n\n"))
+    else:
+        caption = render_post(json.loads(answers_json), mask_to_tags(mask or 0))
+    await db.execute("UPDATE submissions SET caption=? WHERE id=?", (caption, sub_id))
+    return caption
+
+def build_album(photos: List[str], media_types: List[str], caption: str) -> List[InputMediaPhoto | InputMediaVideo]:
+    album: List[InputMediaPhoto | InputMediaVideo] = []
+    for i, (media_id, media_type) in enumerate(zip(photos, media_types)):
+        media_cls = InputMediaVideo if media_type == "video" else InputMediaPhoto
+        # підпис — тільки на першому медіа
+        album.append(media_cls(media=media_id, caption=caption if i == 0 else None))
+    return album
+
+# ---------- Tag suggestions ----------
+# Більшість тегів випливає з відповідей, тож підказуємо їх модератору заздалегідь.
+
+# Роздільник тисяч — пробіл або «.»/«,», за якими рівно три цифри («8,500$», «$12.000»);
+# інакше «.»/«,» — десяткова частина («8.5k», «1,5 млн»).
+_THOUSANDS_SEP = r"(?:[ \u00a0\u202f]|[.,](?=\d{3}(?!\d)))"
+_NUMBER_RE = re.compile(
+    r"(\d+(?:" + _THOUSANDS_SEP + r"\d{3})*(?:[.,]\d+)?)\s*(?:(k|к|тис|тыс|т|млн|mln)(?!\w)\.?)?", re.I
+)
+_MULTIPLIERS = {"млн": 1_000_000, "mln": 1_000_000}
+
+_CURRENCIES = [
+    ("USD", re.compile(r"\$|usd|дол|[уy]\.?\s?[оoеe]\.?(?!\w)|бакс", re.I)),
+    ("EUR", re.compile(r"€|eur|євро|евро", re.I)),
+    ("UAH", re.compile(r"₴|грн|uah|гривен|гривень", re.I)),
+]
+
+def _parse_number(text: str) -> Optional[Tuple[float, bool]]:
+    """Перше число в тексті з урахуванням «k»/«тис»/«млн»; друге — чи був множник."""
+    match = _NUMBER_RE.search(text)
+    if not match:
+        return None
+    number = re.sub(_THOUSANDS_SEP, "", match.group(1)).replace(",", ".")
+    value = float(number)
+    if match.group(2):
+        value *= _MULTIPLIERS.get(match.group(2).lower(), 1000)
+    return value, bool(match.group(2))
+
+def parse_amount(text: Any) -> Optional[Tuple[int, Optional[str]]]:
+    """«$8 500» → (8500, "USD"), «8.5k» → (8500, None), «8500 у.о.» → (8500, "USD")."""
+    text = str(text or "")
+    parsed = _parse_number(text)
+    if not parsed:
+        return None
+    currency = next((code for code, pattern in _CURRENCIES if pattern.search(text)), None)
+    return int(round(parsed[0])), currency
+
+def parse_mileage(text: Any) -> Optional[int]:
+    """Пробіг у км: «173383», «173 тис», «173k». Число до 1000 без одиниць вважаємо тисячами."""
+    parsed = _parse_number(str(text or ""))
+    if not parsed:
+        return None
+    km, scaled = parsed
+    # «1.5» — це 1 500 км, тож множимо до округлення
+    return int(round(km * 1000 if km < 1000 and not scaled else km))
+
+def _keywords(mapping: Dict[str, str]) -> List[Tuple[str, re.Pattern]]:
+    # тег → регулярка з початками слів
+    return [(tag, re.compile(r"(?<!\w)(?:" + stems + ")", re.I)) for tag, stems in mapping.items()]
+
+_GEARBOX_RULES = _keywords({
+    "#автомат": r"автомат|акпп|авт\.|auto|at(?!\w)|ат(?!\w)|типтроник|тіптронік",
+    "#механіка": r"механ|мкпп|manual|mt(?!\w)",
+    "#робот": r"робот|dsg|s-tronic|powershift",
+    "#варіатор": r"варіатор|вариатор|cvt",
+})
+
+_FUEL_RULES = _keywords({
+    "#дизель": r"дизел|diesel|tdi|crdi|dci|hdi|cdi|d4d|tdci",
+    "#бензин": r"бенз|petrol|gasoline|tsi|tfsi|fsi|mpi",
+    "#електро": r"електро|электро|electric|ev(?!\w)|квт|kwh",
+    "#гібрид": r"гібрид|гибрид|hybrid|phev",
+    "#газ": r"газ|гбо|lpg|метан|пропан",
+})
+
+_BODY_RULES = _keywords({
+    "#седан": r"седан|sedan",
+    "#універсал": r"універсал|универсал|wagon|avant|touring|variant|estate|kombi|combi",
+    "#хетчбек": r"хетчбек|хэтчбек|хечбек|hatch|хетч",
+    "#кросовер": r"кросовер|кроссовер|crossover",
+    "#позашляховик": r"позашляховик|внедорожник|джип|suv",
+    "#мінівен": r"мінівен|минивэн|минивен|minivan",
+    "#пікап": r"пікап|пикап|pickup|pick-up",
+})
+
+# (верхня межа ціни в $/€, тег)
+_PRICE_BANDS = [(3000, "#до3к"), (5000, "#до5к"), (10000, "#до10к"), (15000, "#до15к"), (20000, "#до20к")]
+
+def price_band(price: Optional[Tuple[int, Optional[str]]]) -> Optional[str]:
+    # у гривнях діапазони не рахуємо — курс змінюється
+    if not price or price[1] == "UAH" or price[0] <= 0:
+        return None
+    for limit, tag in _PRICE_BANDS:
+        if price[0] <= limit:
+            return tag
+    return "#20кплюс"
+
+def suggest_tags(data: Dict[str, Any]) -> int:
+    """Маска тегів, які можна вивести з відповідей (КПП, пальне, кузов, ціна)."""
+    mask = 0
+
+    def apply(rules: List[Tuple[str, re.Pattern]], text: str, first_only: bool):
+        nonlocal mask
+        for tag, pattern in rules:
+            if pattern.search(text):
+                mask |= 1 << TAG_INDEX[tag]
+                if first_only:
+                    return
+
+    gearbox = str(data.get("gearbox") or "")
+    engine = str(data.get("engine") or "")
+    title_and_description = f"{data.get('car_title') or ''} {data.get('description') or ''}"
+
+    apply(_GEARBOX_RULES, gearbox, first_only=True)
+    apply(_FUEL_RULES, engine, first_only=False)  # газ/бензин буває разом
+    apply(_BODY_RULES, title_and_description, first_only=True)
+
+    band = price_band(parse_amount(data.get("price")))
+    if band:
+        mask |= 1 << TAG_INDEX[band]
+    return mask
+
+# ---------- Field validation ----------
+# Кожен текстовий крок анкети описується Field: питання, розбір і текст помилки.
+# parse повертає нормалізовані значення для стану FSM або None, якщо відповідь не підходить.
+
+class Field(NamedTuple):
+    name: str
+    state: State
+    prompt: str
+    error: str
+    parse: Callable[[str], Optional[Dict[str, Any]]]
+
+def _clean(text: str) -> str:
+    return " ".join(text.split())
+
+def _text(name: str, max_len: int, min_len: int = 1) -> Callable[[str], Optional[Dict[str, Any]]]:
+    def parse(text: str) -> Optional[Dict[str, Any]]:
+        value = _clean(text)
+        if not min_len <= len(value) <= max_len or not re.search(r"\w", value):
+            return None
+        return {name: value}
+    return parse
+
+_CURRENCY_FORMAT = {"USD": "${}", "EUR": "{} €", "UAH": "{} грн"}
+# «$8» чи «50 €» — майже напевно пропущені нулі або «k», тож просимо ввести ще раз
+_MIN_PRICE = {"USD": 100, "EUR": 100}
+
+def fmt_number(value: int) -> str:
+    return f"{value:,}".replace(",", " ")
+
+def parse_price(text: str) -> Optional[Dict[str, Any]]:
+    parsed = parse_amount(text)
+    if not parsed or not parsed[1] or not _MIN_PRICE.get(parsed[1], 1) <= parsed[0] < 100_000_000:
+        return None
+    amount, currency = parsed
+    return {"price": _CURRENCY_FORMAT[currency].format(fmt_number(amount))}
+
+def parse_mileage_answer(text: str) -> Optional[Dict[str, Any]]:
+    km = parse_mileage(text)
+    if km is None or km > 3_000_000:
+        return None
+    return {"mileage": fmt_number(km)}
+
+_PHONE_RE = re.compile(r"\+?\d[\d\s\-()]{7,}\d")
+_USERNAME_RE = re.compile(r"(?:@|t\.me/|telegram\.me/)([A-Za-z][A-Za-z0-9_]{4,31})", re.I)
+
+def normalize_phone(text: str) -> Optional[str]:
+    """«050 123-45-67», «380501234567» → «+380501234567»; інші країни — лише з «+»."""
+    digits = re.sub(r"\D", "", text)
+    if len(digits) == 10 and digits.startswith("0"):
+        return "+38" + digits
+    if len(digits) == 12 and digits.startswith("380"):
+        return "+" + digits
+    if text.strip().startswith("+") and 10 <= len(digits) <= 15:
+        return "+" + digits
+    return None
+
+def parse_contacts(text: str) -> Optional[Dict[str, Any]]:
+    contacts = [phone for phone in map(normalize_phone, _PHONE_RE.findall(text)) if phone]
+    contacts += ["@" + name for name in _USERNAME_RE.findall(text)]
+    if not contacts:
+        return None
+    return {"contacts": ", ".join(dict.fromkeys(contacts))}
+
+# Довідник міст: назва → інші написання (рос., лат.). Індекс будується один раз при імпорті.
+CITIES = {
+    "Київ": ("киев", "kyiv", "kiev"),
+    "Харків": ("харьков", "kharkiv", "kharkov"),
+    "Одеса": ("одесса", "odesa", "odessa"),
+    "Дніпро": ("днепр", "дніпропетровськ", "днепропетровск", "dnipro", "dnepr"),
+    "Запоріжжя": ("запорожье", "zaporizhzhia", "zaporozhye"),
+    "Львів": ("львов", "lviv", "lvov"),
+    "Кривий Ріг": ("кривой рог", "kryvyi rih", "krivoy rog"),
+    "Миколаїв": ("николаев", "mykolaiv", "nikolaev"),
+    "Вінниця": ("винница", "vinnytsia", "vinnitsa"),
+    "Херсон": ("kherson",),
+    "Полтава": ("poltava",),
+    "Чернігів": ("чернигов", "chernihiv"),
+    "Черкаси": ("черкассы", "cherkasy"),
+    "Хмельницький": ("хмельницкий", "khmelnytskyi"),
+    "Житомир": ("zhytomyr",),
+    "Суми": ("сумы", "sumy"),
+    "Рівне": ("ровно", "rivne"),
+    "Івано-Франківськ": ("ивано-франковск", "франківськ", "ivano-frankivsk"),
+    "Тернопіль": ("тернополь", "ternopil"),
+    "Луцьк": ("луцк", "lutsk"),
+    "Ужгород": ("uzhhorod",),
+    "Чернівці": ("черновцы", "chernivtsi"),
+    "Кропивницький": ("кропивницкий", "кіровоград", "кировоград", "kropyvnytskyi"),
+    "Біла Церква": ("белая церковь", "bila tserkva"),
+    "Кременчук": ("кременчуг", "kremenchuk"),
+    "Мукачево": ("mukachevo",),
+    "Бровари": ("бровары", "brovary"),
+    "Бориспіль": ("борисполь", "boryspil"),
+    "Ірпінь": ("ирпень", "irpin"),
+    "Буча": ("bucha",),
+    "Кам'янець-Подільський": ("каменец-подольский", "kamianets-podilskyi"),
+    "Умань": ("uman",),
+    "Ковель": ("kovel",),
+    "Нікополь": ("никополь", "nikopol"),
+    "Кам'янське": ("каменское", "днепродзержинск", "kamianske"),
+    "Павлоград": ("pavlohrad",),
+    "Мелітополь": ("мелитополь", "melitopol"),
+    "Бердянськ": ("бердянск", "berdiansk"),
+    "Маріуполь": ("мариуполь", "mariupol"),
+    "Краматорськ": ("краматорск", "kramatorsk"),
+    "Слов'янськ": ("славянск", "sloviansk"),
+    "Ізмаїл": ("измаил", "izmail"),
+    "Дрогобич": ("дрогобыч", "drohobych"),
+    "Стрий": ("stryi",),
+    "Самбір": ("самбор", "sambir"),
+    "Калуш": ("kalush",),
+    "Коломия": ("коломыя", "kolomyia"),
+    "Олександрія": ("александрия", "oleksandriia"),
+}
+
+def _city_key(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"^(?:м\.|г\.|місто|город)\s*", "", text.strip())
+    return re.sub(r"[\s\-'’ʼ`.]+", "", text)
+
+CITY_INDEX: Dict[str, str] = {
+    _city_key(alias): city for city, aliases in CITIES.items() for alias in (city, *aliases)
+}
+
+def canonical_city(text: Any) -> Optional[str]:
+    """Назва з довідника для «киев», «м. Київ», «Kyiv», «Кіев» (одна-дві помилки); інакше None."""
+    key = _city_key(str(text or ""))
+    if not key:
+        return None
+    city = CITY_INDEX.get(key)
+    if city is None:
+        close = difflib.get_close_matches(key, CITY_INDEX.keys(), n=1, cutoff=0.75)
+        city = CITY_INDEX[close[0]] if close else None
+    return city
+
+def parse_city(text: str) -> Optional[Dict[str, Any]]:
+    value = _clean(text)
+    if not 2 <= len(value) <= 50 or not re.search(r"[^\W\d_]", value):
+        return None
+    # невідоме місто (село, смт) приймаємо як є
+    return {"city": canonical_city(value) or value}
+
+def parse_description(text: str) -> Optional[Dict[str, Any]]:
+    value = text.strip()
+    if not value or len(value) > MAX_DESCRIPTION_LENGTH:
+        return None
+    return {"description": value}
+
+FIELDS = [
+    Field("car_title", Form.car_title, "1️⃣ Назва авто (наприклад: Audi A4 2013)",
+          "Напиши марку, модель і рік, наприклад: Audi A4 2013", _text("car_title", 100, 2)),
+    Field("engine", Form.engine, "2️⃣ Двигун (наприклад: 2.0 бензин / 2.0 дизель / електро)",
+          "Напиши об'єм і тип пального, наприклад: 2.0 дизель", _text("engine", 60)),
+    Field("gearbox", Form.gearbox, "3️⃣ Коробка (автомат / механіка / робот / варіатор)",
+          "Напиши тип коробки: автомат / механіка / робот / варіатор", _text("gearbox", 40)),
+    Field("mileage", Form.mileage, "4️⃣ Пробіг (тільки число в км) — наприклад: 173383",
+          "Не вдалося розібрати пробіг. Напиши число в км, наприклад: 173383 або 173 тис", parse_mileage_answer),
+    Field("city", Form.city, "5️⃣ Місто",
+          "Напиши назву міста, наприклад: Київ", parse_city),
+    Field("price", Form.price, "6️⃣ Ціна (з валютою: $, € або грн) — наприклад: 8500$",
+          "Напиши суму з валютою, наприклад: 8500$, 7 900 € або 350 000 грн", parse_price),
+    Field("contacts", Form.contacts, "7️⃣ Контакти (телефон або Telegram)",
+          "Напиши телефон (наприклад: 050 123 45 67) або Telegram (@username)", parse_contacts),
+    Field("description", Form.description, f"8️⃣ Опис (стан, нюанси)\n\n⚠️ Максимум {MAX_DESCRIPTION_LENGTH} символів",
+          f"❌ <b>Опис порожній або задовгий</b>\n\nМаксимум: {MAX_DESCRIPTION_LENGTH} символів\n\n"
+          f"Будь ласка, скороти опис і надішли його ще раз.", parse_description),
+]
+FIELD_BY_STATE = {field.state.state: i for i, field in enumerate(FIELDS)}
+FIELD_BY_NAME = {field.name: field for field in FIELDS}
+
+def _retag_row(sub_id: int, answers: Optional[str]) -> tuple:
+    data = json.loads(answers or "{}")
+    price = parse_amount(data.get("price"))
+    return (suggest_tags(data), price[0] if price else None, price[1] if price else None,
+            parse_mileage(data.get("mileage")), sub_id)
+
+async def retag_all(batch_size: int = 5000) -> int:
+    """Перераховує suggested_tags і розібрані ціну/пробіг для всієї таблиці пачками.
+
+    Архівні заглушки пропускаємо: від відповідей у них лишилась тільки назва.
+    Повертає кількість рядків.
+    """
+    last_id, total = 0, 0
+    while True:
+        rows = await db.fetchall(
+            "SELECT id, answers FROM submissions WHERE id > ? AND archived_at IS NULL ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        )
+        if not rows:
+            return total
+        await db.executemany(
+            "UPDATE submissions SET suggested_tags=?, price_amount=?, price_currency=?, mileage_km=? WHERE id=?",
+            [_retag_row(*row) for row in rows]
+        )
+        last_id = rows[-1][0]
+        total += len(rows)
+
+# ---------- Duplicate detection ----------
+# MinHash-підпис тексту оголошення + LSH: схожі оголошення потрапляють в однакові
+# кошики dup_lsh, тож перевірка — кілька точкових запитів по індексу, а не скан.
+
+MINHASH_BANDS = 4
+MINHASH_ROWS = 4      # 16 хешів; поріг спрацьовування ≈ (1/4) ** (1/4) ≈ 0.7 схожості
+DUP_SIMILARITY = 0.8  # з якої оціночної схожості показуємо модератору
+MAX_SUBMISSIONS_PER_DAY = 3
+
+_MERSENNE = (1 << 61) - 1
+_rng = random.Random(20240601)  # фіксоване зерно: підписи мають бути однакові між запусками
+_MINHASH_PARAMS = [
+    (_rng.randrange(1, _MERSENNE), _rng.randrange(0, _MERSENNE))
+    for _ in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+_DUP_FIELDS = ("car_title", "engine", "gearbox", "mileage", "city", "price", "description")
+
+def listing_signature(data: Dict[str, Any]) -> List[int]:
+    text = " ".join(str(data.get(f) or "") for f in _DUP_FIELDS).lower()
+    words = re.findall(r"\w+", text)
+    # шингли — пари сусідніх слів
+    shingles = {zlib.crc32(f"{a} {b}".encode()) for a, b in zip(words, words[1:])} or {0}
+    return [min((a * h + b) % _MERSENNE for h in shingles) for a, b in _MINHASH_PARAMS]
+
+def lsh_bands(signature: List[int]) -> List[int]:
+    keys = []
+    for band in range(MINHASH_BANDS):
+        chunk = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+        digest = hashlib.blake2b(struct.pack(f"<B{MINHASH_ROWS}Q", band, *chunk), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, "little", signed=True))
+    return keys
+
+def pack_signature(signature: List[int]) -> bytes:
+    return struct.pack(f"<{len(signature)}Q", *signature)
+
+def similarity(a: List[int], b: bytes) -> float:
+    other = struct.unpack(f"<{len(a)}Q", b)
+    return sum(x == y for x, y in zip(a, other)) / len(a)
+
+async def duplicate_warnings(user_id: int, signature: List[int], media_uids: List[Optional[str]]) -> List[str]:
+    """Попередження для модераторів: схожий текст, ті самі медіа, забагато заявок за добу."""
+    warnings = []
+
+    bands = lsh_bands(signature)
+    # 50 найновіших з кожного кошика по PRIMARY KEY (band_key, sub_id): у популярному
+    # кошику (перепости того самого) тисячі заявок, і без LIMIT читалися б усі
+    per_band = " UNION ".join(
+        ["SELECT * FROM (SELECT sub_id FROM dup_lsh WHERE band_key=? ORDER BY sub_id DESC LIMIT 50)"] * len(bands)
+    )
+    candidates = await db.fetchall(
+        f"SELECT s.id, s.status, s.minhash FROM submissions s WHERE s.id IN ({per_band}) "
+        f"ORDER BY s.id DESC LIMIT 50",
+        tuple(bands)
+    )
+    similar = [
+        (sub_id, status, similarity(signature, blob))
+        for sub_id, status, blob in candidates if blob
+    ]
+    similar = [x for x in similar if x[2] >= DUP_SIMILARITY][:5]
+    if similar:
+        warnings.append("⚠️ Схоже на заявки: " + ", ".join(
+            f"#{sub_id} ({STATUS_NAMES.get(status, status)}, {score:.0%})" for sub_id, status, score in similar
+        ))
+
+    uids = [u for u in media_uids if u]
+    if uids:
+        rows = await db.fetchall(
+            f"SELECT DISTINCT sub_id FROM submission_media WHERE file_unique_id IN ({','.join('?' * len(uids))}) "
+            f"ORDER BY sub_id DESC LIMIT 5",
+            tuple(uids)
+        )
+        if rows:
+            warnings.append("⚠️ Ті самі фото/відео, що в " + ", ".join(f"#{r[0]}" for r in rows))
+        # кеш метаданих бачить і медіа з чужих чернеток, які так і не подали
+        others, = await db.fetchone(
+            f"SELECT COUNT(*) FROM media_meta WHERE file_unique_id IN ({','.join('?' * len(uids))}) AND user_id != ?",
+            (*uids, user_id)
+        )
+        if others:
+            warnings.append(f"⚠️ {others} фото/відео раніше надсилав інший користувач")
+
+    recent, = await db.fetchone(
+        "SELECT COUNT(*) FROM submissions WHERE user_id=? AND created_at > strftime('%s','now') - 86400",
+        (user_id,)
+    )
+    if recent >= MAX_SUBMISSIONS_PER_DAY:
+        warnings.append(f"⚠️ Користувач уже подав {recent} заявок за добу")
+
+    return warnings
+
+# ---------- Media validation ----------
+class MediaInfo(NamedTuple):
+    """Метадані медіа з Message. file_unique_id однаковий для того самого файлу в будь-якого бота/чату."""
+    file_id: str
+    media_type: str
+    unique_id: str
+    file_size: Optional[int]
+    width: int
+    height: int
+    duration: Optional[int]
+    mime_type: Optional[str]
+
+def media_of(m: Message) -> Optional[MediaInfo]:
+    if m.photo:
+        p = m.photo[-1]
+        return MediaInfo(p.file_id, "photo", p.file_unique_id, p.file_size, p.width, p.height, None, "image/jpeg")
+    if m.video:
+        v = m.video
+        return MediaInfo(v.file_id, "video", v.file_unique_id, v.file_size, v.width, v.height, v.duration, v.mime_type)
+    return None
+
+def check_media(info: MediaInfo) -> Optional[str]:
+    """Текст помилки, якщо медіа не проходить обмеження."""
+    if info.media_type == "video":
+        if info.file_size and info.file_size > MAX_VIDEO_SIZE:
+            return f"Відео завелике ({info.file_size // (1024 * 1024)} МБ), максимум {MAX_VIDEO_SIZE // (1024 * 1024)} МБ."
+        if info.duration and info.duration > MAX_VIDEO_DURATION:
+            return f"Відео задовге ({fmt_duration(info.duration)}), максимум {fmt_duration(MAX_VIDEO_DURATION)}."
+    elif min(info.width, info.height) < MIN_PHOTO_SIDE:
+        return f"Фото замале ({info.width}×{info.height}), потрібно хоча б {MIN_PHOTO_SIDE} пікселів по меншій стороні."
+    return None
+
+def fmt_duration(seconds: int) -> str:
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+async def remember_media(user_id: int, items: List[MediaInfo]):
+    """Кешує метадані; для файлу, що вже є, лишається перший відправник."""
+    if items:
+        await db.executemany(
+            "INSERT INTO media_meta (file_unique_id, media_type, file_size, width, height, duration, mime_type, user_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(file_unique_id) DO NOTHING",
+            [(i.unique_id, i.media_type, i.file_size, i.width, i.height, i.duration, i.mime_type, user_id) for i in items]
+        )
+
+async def media_summary(media_uids: List[Optional[str]]) -> str:
+    """«📎 6 фото, 2 відео (3:05, 41 МБ)» з кешу метаданих — для модераторів."""
+    uids = [u for u in media_uids if u]
+    if not uids:
+        return ""
+    rows = await db.fetchall(
+        f"SELECT media_type, file_size, duration FROM media_meta WHERE file_unique_id IN ({','.join('?' * len(uids))})",
+        tuple(uids)
+    )
+    photos = sum(1 for r in rows if r[0] == "photo")
+    videos = [r for r in rows if r[0] == "video"]
+    parts = [f"{photos} фото"] if photos else []
+    if videos:
+        duration = sum(r[2] or 0 for r in videos)
+        size = sum(r[1] or 0 for r in videos)
+        parts.append(f"{len(videos)} відео ({fmt_duration(duration)}, {size // (1024 * 1024)} МБ)")
+    return "📎 " + ", ".join(parts) if parts else ""
+
+# ---------- Send scheduler ----------
+# Пріоритети вихідних повідомлень: менше — важливіше
+PRIORITY_MOD = 0       # модераторська група
+PRIORITY_CHANNEL = 1   # публікація в канал
+PRIORITY_USER = 2      # сповіщення користувачам
+PRIORITY_FANOUT = 3    # масові сповіщення за підписками — лише коли немає іншого
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, cost: float) -> float:
+        """Скільки секунд чекати, доки можна буде витратити cost токенів."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.capacity)
+        wait = max(0.0, (cost - self.tokens) / self.rate)
+        return max(wait, self.paused_until - now)
+
+    def consume(self, cost: float):
+        self.tokens -= min(cost, self.capacity)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class SendJob:
+    __slots__ = ("bot", "method", "priority", "key", "future", "created", "attempts")
+
+    def __init__(self, bot: Bot, method: TelegramMethod, priority: int, key: Optional[str]):
+        self.bot = bot
+        self.method = method
+        self.priority = priority
+        self.key = key
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.created = time.monotonic()
+        self.attempts = 0
+
+    @property
+    def chat_id(self):
+        return getattr(self.method, "chat_id", None)
+
+    @property
+    def cost(self) -> int:
+        # альбом рахується Telegram'ом як N повідомлень
+        media = getattr(self.method, "media", None)
+        return len(media) if isinstance(media, list) else 1
+
+
+class SendScheduler:
+    """Єдина черга вихідних повідомлень з урахуванням лімітів Telegram.
+
+    Глобальний token bucket (~30 повідомлень/с) + окремий на кожен чат
+    (1/с для приватних, 20/хв для груп і каналів). Черга пріоритетна,
+    RetryAfter ставить чат на паузу й повторює відправку, а виклики з тим
+    самим key (напр. публікація заявки) виконуються лише один раз.
+    """
+
+    def __init__(self, global_rate: float = 25, max_attempts: int = 5, remember: int = 10_000):
+        self.global_rate = global_rate
+        self.share = 1
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: Dict[Any, TokenBucket] = {}
+        self.max_attempts = max_attempts
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # event loop тримає лише слабкі посилання на задачі — без цього відправку може зібрати GC
+        self._tasks: set = set()
+        self._done: OrderedDict = OrderedDict()
+        self._remember = remember
+        # метрики
+        self.latencies: deque = deque(maxlen=1000)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            # у групи пишуть усі шарди, в приватний чат — лише шард його користувача
+            bucket = TokenBucket(20 / 60 / self.share, 20 // self.share) if is_group else TokenBucket(1, 1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def set_share(self, shards: int):
+        """Лишає цьому процесу 1/shards загальних лімітів бота (кілька процесів шлють від одного бота)."""
+        self.share = shards
+        self.global_bucket = TokenBucket(self.global_rate / shards, max(self.global_rate // shards, 1))
+        self.chat_buckets.clear()
+
+    def _push(self, job: SendJob):
+        heapq.heappush(self._heap, (job.priority, next(self._seq), job))
+        self._wakeup.set()
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def send(self, bot: Bot, method: TelegramMethod, priority: int = PRIORITY_USER,
+                   key: Optional[str] = None) -> Any:
+        if key is not None:
+            if key in self._done:
+                return self._done[key]
+            if key in self._inflight:
+                return await asyncio.shield(self._inflight[key])
+
+        job = SendJob(bot, method, priority, key)
+        if key is not None:
+            self._inflight[key] = job.future
+        self._push(job)
+        # задача вже в черзі й однаково виконається: скасування того, хто чекає
+        # (напр. зупинка outbox), не повинно скасувати її результат для інших
+        return await asyncio.shield(job.future)
+
+    def queue_depth(self) -> int:
+        return len(self._heap)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            _, _, job = heapq.heappop(self._heap)
+            chat_wait = self._chat_bucket(job.chat_id).wait_time(job.cost)
+            if chat_wait > 0:
+                # чат зайнятий — повертаємо в чергу пізніше, інші чати не чекають
+                loop.call_later(chat_wait, self._push, job)
+                continue
+
+            global_wait = self.global_bucket.wait_time(job.cost)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+            self.global_bucket.consume(job.cost)
+            self._chat_bucket(job.chat_id).consume(job.cost)
+            task = asyncio.create_task(self._execute(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job: SendJob):
+        job.attempts += 1
+        try:
+            result = await job.bot(job.method)
+        except TelegramRetryAfter as e:
+            self.retried += 1
+            self._chat_bucket(job.chat_id).pause(e.retry_after)
+            self._retry(job, e, e.retry_after)
+            return
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self.retried += 1
+            self._retry(job, e, 2 ** job.attempts)
+            return
+        except Exception as e:
+            self._finish(job, error=e)
+            return
+        self._finish(job, result=result)
+
+    def _retry(self, job: SendJob, error: Exception, delay: float):
+        if job.attempts >= self.max_attempts:
+            self._finish(job, error=error)
+            return
+        asyncio.get_running_loop().call_later(delay, self._push, job)
+
+    def _finish(self, job: SendJob, result: Any = None, error: Optional[Exception] = None):
+        self.latencies.append(time.monotonic() - job.created)
+        if job.key is not None:
+            self._inflight.pop(job.key, None)
+        if error is not None:
+            self.failed += 1
+            job.future.set_exception(error)
+            return
+        self.sent += 1
+        if job.key is not None:
+            self._done[job.key] = result
+            if len(self._done) > self._remember:
+                self._done.popitem(last=False)
+        job.future.set_result(result)
+
+    def metrics(self) -> Dict[str, Any]:
+        lat = sorted(self.latencies)
+        return {
+            "queue_depth": self.queue_depth(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_p50": lat[len(lat) // 2] if lat else 0.0,
+            "latency_p99": lat[int(len(lat) * 0.99)] if lat else 0.0,
+        }
+
+
+sender = SendScheduler()
+
+async def start_flow(m: Message, state: FSMContext):
+    await state.clear()
+    await m.answer(FIELDS[0].prompt, reply_markup=main_menu_kb())
+    await state.set_state(FIELDS[0].state)
+
+# ---------- Publishing schedule ----------
+# Схвалені оголошення не йдуть у канал пачкою: кожне отримує свій час
+# публікації (не частіше за PUBLISH_INTERVAL, і/або лише у слоти PUBLISH_SLOTS).
+
+PUBLISH_ZONE = ZoneInfo(PUBLISH_TZ)
+_SLOTS = sorted(tuple(map(int, slot.split(":"))) for slot in PUBLISH_SLOTS.split(",") if slot.strip())
+
+def next_slot(ts: float) -> int:
+    """Найближчий слот публікації, не раніше ts."""
+    moment = datetime.fromtimestamp(ts, PUBLISH_ZONE)
+    for day in range(2):
+        date = (moment + timedelta(days=day)).date()
+        for hour, minute in _SLOTS:
+            slot = datetime(date.year, date.month, date.day, hour, minute, tzinfo=PUBLISH_ZONE)
+            if slot.timestamp() >= ts:
+                return int(slot.timestamp())
+    return int(ts)
+
+def publish_time(last: Optional[int], now: int) -> int:
+    """Час публікації наступного поста, якщо попередній запланований на last."""
+    if last is None:
+        at = now
+    else:
+        # у режимі слотів — не більше одного поста на слот
+        at = max(now, last + max(PUBLISH_INTERVAL, 1 if _SLOTS else 0))
+    return next_slot(at) if _SLOTS else at
+
+# записи outbox, що постять у канал і мають іти за розкладом
+CHANNEL_KINDS = ("publish", "bump")
+
+def last_scheduled(conn: sqlite3.Connection, sent: bool = False) -> Optional[int]:
+    """Час останнього запланованого (sent=True — відправленого) поста в каналі.
+
+    Виконані записи зберігають у next_attempt_at час фактичної відправки.
+    """
+    status = "status = 'done'" if sent else "status != 'failed'"
+    times = [
+        conn.execute(
+            f"SELECT MAX(next_attempt_at) FROM outbox WHERE kind=? AND {status}", (kind,)
+        ).fetchone()[0]
+        for kind in CHANNEL_KINDS
+    ]
+    return max((t for t in times if t is not None), default=None)
+
+def respace_posts(conn: sqlite3.Connection, now: int) -> int:
+    """Переносить пости, що стоять ближче до останнього відправленого, ніж дозволяє розклад.
+
+    Так буває, коли бот лежав (усі пропущені пости прострочені) або пост вийшов
+    пізніше запланованого. Повертає кількість перенесених записів.
+    """
+    last = last_scheduled(conn, sent=True)
+    rows = conn.execute(
+        f"SELECT id, next_attempt_at FROM outbox WHERE kind IN ({','.join('?' * len(CHANNEL_KINDS))}) "
+        "AND status='pending' ORDER BY next_attempt_at, id", CHANNEL_KINDS
+    ).fetchall()
+    moved = []
+    for entry_id, at in rows:
+        due = publish_time(last, now)
+        if at < due:
+            moved.append((due, entry_id))
+            at = due
+        last = at
+    conn.executemany("UPDATE outbox SET next_attempt_at=? WHERE id=?", moved)
+    return len(moved)
+
+def fmt_time(ts: float) -> str:
+    return datetime.fromtimestamp(ts, PUBLISH_ZONE).strftime("%d.%m о %H:%M")
+
+async def publish_submission(sub_id: int, with_tags: List[str] | None = None,
+                             at: Optional[int] = None) -> Optional[int]:
+    """Атомарно забирає заявку (pending → publishing) і ставить публікацію в outbox.
+
+    Якщо два модератори натиснуть одночасно, заявку забере лише один.
+    Саму відправку в канал робить OutboxDispatcher у призначений час
+    (at або наступний вільний за розкладом). Повертає цей час.
+    """
+    tags = with_tags or []
+    now = int(outbox.clock())
+    publish_at = await db.transaction(lambda conn: _claim_publish(conn, sub_id, tags, now, at))
+    if publish_at is not None:
+        outbox.wake()
+    return publish_at
+
+def _claim_publish(conn: sqlite3.Connection, sub_id: int, tags: List[str], now: int,
+                   at: Optional[int] = None) -> Optional[int]:
+    claimed = conn.execute(
+        "UPDATE submissions SET status='publishing' WHERE id=? AND status='pending'", (sub_id,)
+    ).rowcount
+    if not claimed:
+        return None
+    _save_tags(conn, sub_id, tags)
+    publish_at = at if at is not None else publish_time(last_scheduled(conn), now)
+    conn.execute(
+        "INSERT INTO outbox (sub_id, kind, payload, next_attempt_at) VALUES (?, 'publish', ?, ?)",
+        (sub_id, json.dumps({"tags": tags}, ensure_ascii=False), publish_at)
+    )
+    return publish_at
+
+async def publish_batch(sub_ids: List[int]) -> List[Tuple[int, int]]:
+    """Схвалює кілька заявок з підказаними тегами однією транзакцією.
+
+    Публікації стають в outbox за розкладом одна за одною, тож канал
+    отримує їх з тим самим інтервалом, що й поодинокі. Повертає (sub_id, час).
+    """
+    now = int(outbox.clock())
+
+    def claim_all(conn: sqlite3.Connection) -> List[Tuple[int, int]]:
+        suggested = dict(conn.execute(
+            f"SELECT id, suggested_tags FROM submissions WHERE id IN ({','.join('?' * len(sub_ids))}) "
+            "AND status='pending' ORDER BY created_at, id", sub_ids
+        ).fetchall())
+        scheduled = []
+        for sub_id, mask in suggested.items():
+            publish_at = _claim_publish(conn, sub_id, mask_to_tags(mask or 0), now)
+            if publish_at is not None:
+                scheduled.append((sub_id, publish_at))
+        return scheduled
+
+    scheduled = await db.transaction(claim_all) if sub_ids else []
+    if scheduled:
+        outbox.wake()
+    return scheduled
+
+async def deny_batch(sub_ids: List[int], reason: str) -> List[int]:
+    """Відхиляє кілька заявок однією транзакцією; сповіщення авторам ідуть через outbox."""
+    text = f"❌ Оголошення відхилено.\nПричина: {reason}\n\nНатисни «🚗 Подати оголошення» або /start — подати заново."
+
+    def deny_all(conn: sqlite3.Connection) -> List[int]:
+        rows = conn.execute(
+            f"UPDATE submissions SET status='denied' WHERE id IN ({','.join('?' * len(sub_ids))}) "
+            "AND status='pending' RETURNING id, user_id", sub_ids
+        ).fetchall()
+        conn.executemany(
+            "INSERT INTO outbox (sub_id, kind, payload) VALUES (?, 'notify', ?)",
+            [(sub_id, json.dumps({"chat_id": user_id, "text": text}, ensure_ascii=False)) for sub_id, user_id in rows]
+        )
+        return sorted(sub_id for sub_id, _ in rows)
+
+    denied = await db.transaction(deny_all) if sub_ids else []
+    if denied:
+        outbox.wake()
+    return denied
+
+async def reschedule(sub_id: int, at: int) -> bool:
+    """Переносить ще не опублікований пост на інший час."""
+    updated = await db.execute(
+        "UPDATE outbox SET next_attempt_at=? WHERE sub_id=? AND kind='publish' AND status='pending'", (at, sub_id)
+    )
+    outbox.wake()
+    return updated > 0
+
+
+class OutboxDispatcher:
+    """Фонова корутина, що розгрібає outbox пачками з повторами.
+
+    Статус заявки стає approved в одній транзакції з позначкою про виконання
+    запису outbox і постановкою сповіщення автору. Перед відправкою поста в
+    канал запис позначається 'sending': якщо процес впаде між відправкою і
+    цією транзакцією, після рестарту пост не повторюється (Telegram не має
+    ключа ідемпотентності, тож невідомо, чи він вийшов) — recover() повертає
+    заявку модераторам із проханням перевірити канал.
+
+    Пости в канал (CHANNEL_KINDS) ідуть по одному; прострочені після простою
+    переносяться за розкладом від останнього фактично відправленого (respace_posts).
+    Розсилки підписникам ('fanout') розгрібає окрема корутина, порція за порцією,
+    щоб пачка сповіщень не тримала пост чи повідомлення автору до свого кінця.
+    """
+
+    def __init__(self, batch_size: int = 20, poll_interval: float = 60.0, max_attempts: int = 5,
+                 clock: Callable[[], float] = time.time):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self._wakeup = asyncio.Event()
+        self._fanout_wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def wake(self):
+        self._wakeup.set()
+        self._fanout_wakeup.set()
+
+    def start(self, bot: Bot):
+        self._tasks = [asyncio.create_task(self.run(bot)), asyncio.create_task(self.run_fanout(bot))]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def run(self, bot: Bot):
+        try:
+            await self.recover(bot)
+        except Exception:
+            logging.exception("Outbox recovery failed")
+        # одна корутина на всю чергу: спить до найближчого запису або до wake()
+        while True:
+            self._wakeup.clear()
+            try:
+                now = int(self.clock())
+                await db.transaction(lambda conn: respace_posts(conn, now))
+                rows = await db.fetchall(
+                    "SELECT id, sub_id, kind, payload, attempts FROM outbox "
+                    "WHERE status='pending' AND kind != 'fanout' AND next_attempt_at <= ? "
+                    "ORDER BY next_attempt_at, id LIMIT ?",
+                    (now, self.batch_size)
+                )
+                # пости в канал — по одному: наступний переноситься від часу щойно відправленого
+                posts = [row for row in rows if row[2] in CHANNEL_KINDS][:1]
+                others = [row for row in rows if row[2] not in CHANNEL_KINDS]
+                await asyncio.gather(*(self._process(bot, *row) for row in others + posts))
+            except Exception:
+                logging.exception("Outbox batch failed")
+                rows = []
+
+            if len(rows) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), await self.next_due_in())
+                except asyncio.TimeoutError:
+                    pass
+
+    async def run_fanout(self, bot: Bot):
+        """Розсилки підписникам: по одній порції за прохід, черговість — за next_attempt_at."""
+        while True:
+            self._fanout_wakeup.clear()
+            try:
+                row = await db.fetchone(
+                    "SELECT id, sub_id, kind, payload, attempts FROM outbox "
+                    "WHERE status='pending' AND kind='fanout' AND next_attempt_at <= ? "
+                    "ORDER BY next_attempt_at, id LIMIT 1",
+                    (int(self.clock()),)
+                )
+                if row:
+                    await self._process(bot, *row)
+            except Exception:
+                logging.exception("Outbox fanout failed")
+                row = None
+
+            if not row:
+                try:
+                    await asyncio.wait_for(self._fanout_wakeup.wait(), await self.next_due_in(fanout=True))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def recover(self, bot: Bot):
+        """Записи, відправку яких перервало падіння процесу (status='sending')."""
+        rows = await db.fetchall("SELECT id, sub_id, kind FROM outbox WHERE status='sending'")
+        for entry_id, sub_id, kind in rows:
+            logging.warning("Outbox entry %s (%s) was interrupted while sending", entry_id, kind)
+            await self._fail(bot, entry_id, sub_id, kind, self.max_attempts,
+                             RuntimeError("відправку перервано, перевірте канал: пост міг вийти"))
+
+    async def _send_once(self, bot: Bot, entry_id: int, method: TelegramMethod, key: str) -> Any:
+        """Пост у канал: запис позначається 'sending' до відправки, тож після падіння не повториться.
+
+        Якщо Telegram відповів помилкою (пост точно не вийшов) — запис знову 'pending'.
+        """
+        await db.execute("UPDATE outbox SET status='sending' WHERE id=?", (entry_id,))
+        try:
+            return await sender.send(bot, method, priority=PRIORITY_CHANNEL, key=key)
+        except Exception:
+            await db.execute("UPDATE outbox SET status='pending' WHERE id=?", (entry_id,))
+            raise
+
+    async def next_due_in(self, fanout: bool = False) -> float:
+        """Скільки спати до наступного запису своєї черги (не довше poll_interval)."""
+        due, = await db.fetchone(
+            "SELECT MIN(next_attempt_at) FROM outbox WHERE status='pending' AND "
+            + ("kind='fanout'" if fanout else "kind != 'fanout'")
+        )
+        if due is None:
+            return self.poll_interval
+        return min(max(due - self.clock(), 0.0), self.poll_interval)
+
+    async def _process(self, bot: Bot, entry_id: int, sub_id: int, kind: str, payload_json: str, attempts: int):
+        payload = json.loads(payload_json)
+        try:
+            if kind == "publish":
+                await self._publish(bot, entry_id, sub_id, payload)
+            elif kind == "edit":
+                await self._edit(bot, entry_id, sub_id)
+            elif kind == "bump":
+                await self._bump(bot, entry_id, sub_id)
+            elif kind == "fanout":
+                await self._fanout(bot, entry_id, sub_id, payload)
+            elif kind == "notify":
+                await sender.send(
+                    bot,
+                    SendMessage(chat_id=payload["chat_id"], text=payload["text"], reply_markup=main_menu_kb()),
+                    priority=PRIORITY_USER, key=f"outbox:{entry_id}"
+                )
+                await db.execute("UPDATE outbox SET status='done' WHERE id=?", (entry_id,))
+        except Exception as e:
+            logging.exception("Outbox entry %s (%s) failed", entry_id, kind)
+            await self._fail(bot, entry_id, sub_id, kind, attempts + 1, e)
+
+    async def _publish(self, bot: Bot, entry_id: int, sub_id: int, payload: Dict[str, Any]):
+        user_id, = await db.fetchone("SELECT user_id FROM submissions WHERE id=?", (sub_id,))
+        photos, media_types = await load_media(sub_id)
+
+        post_text = await get_caption(sub_id, payload.get("tags") or [])
+        messages = await self._send_once(
+            bot, entry_id, SendMediaGroup(chat_id=CHANNEL_ID, media=build_album(photos, media_types, post_text)),
+            key=f"publish:{sub_id}"
+        )
+        sent_at = int(self.clock())
+
+        def done(conn: sqlite3.Connection):
+            conn.execute(
+                "UPDATE submissions SET status='approved', published_at=strftime('%s','now') "
+                "WHERE id=? AND status='publishing'", (sub_id,)
+            )
+            conn.execute("UPDATE outbox SET status='done', next_attempt_at=? WHERE id=?", (sent_at, entry_id))
+            _save_channel_posts(conn, sub_id, messages)
+            index_listing(conn, sub_id)
+            conn.execute(
+                "INSERT INTO outbox (sub_id, kind, payload) VALUES (?, 'notify', ?)",
+                (sub_id, json.dumps({"chat_id": user_id, "text": "✅ Оголошення опубліковано"}, ensure_ascii=False))
+            )
+            conn.execute("INSERT INTO outbox (sub_id, kind, payload) VALUES (?, 'fanout', '{}')", (sub_id,))
+        await db.transaction(done)
+        self.wake()
+
+    async def _fanout(self, bot: Bot, entry_id: int, sub_id: int, payload: Dict[str, Any]):
+        """Сповіщення підписникам про новий пост, порціями по FANOUT_BATCH.
+
+        Перший прохід один раз підбирає підписки і кладе їх у fanout_queue;
+        кожен наступний надсилає порцію і лишає запис у черзі outbox (його знову
+        підбере run_fanout), тож після рестарту розсилка продовжується.
+        """
+        if not payload.get("queued"):
+            def queue(conn: sqlite3.Connection) -> int:
+                count = queue_matches(conn, sub_id)
+                conn.execute("UPDATE outbox SET payload=? WHERE id=?", (json.dumps({"queued": count}), entry_id))
+                return count
+            await db.transaction(queue)
+
+        rows = await db.fetchall(
+            "SELECT s.id, s.user_id, s.query FROM fanout_queue q JOIN subscriptions s ON s.id = q.subscription_id "
+            "WHERE q.sub_id=? ORDER BY q.subscription_id LIMIT ?",
+            (sub_id, FANOUT_BATCH)
+        )
+        listing = rows and await db.read(lambda conn: listing_terms(conn, sub_id))
+        if listing:
+            await notify_subscribers(bot, sub_id, listing, rows)
+
+        def sent(conn: sqlite3.Connection):
+            # сюди ж потрапляють і видалені за цей час підписки (JOIN їх пропускає)
+            last = rows[-1][0] if len(rows) == FANOUT_BATCH and listing else None
+            if last is None:
+                conn.execute("DELETE FROM fanout_queue WHERE sub_id=?", (sub_id,))
+                conn.execute("UPDATE outbox SET status='done' WHERE id=?", (entry_id,))
+                return
+            conn.execute("DELETE FROM fanout_queue WHERE sub_id=? AND subscription_id <= ?", (sub_id, last))
+            conn.execute("UPDATE outbox SET next_attempt_at=? WHERE id=?", (int(self.clock()), entry_id))
+        await db.transaction(sent)
+
+    async def _edit(self, bot: Bot, entry_id: int, sub_id: int):
+        """Оновлює підпис уже опублікованого альбому одним editMessageCaption."""
+        row = await db.fetchone("SELECT message_id FROM channel_posts WHERE sub_id=? AND position=0", (sub_id,))
+        if row:
+            try:
+                await sender.send(
+                    bot, EditMessageCaption(chat_id=CHANNEL_ID, message_id=row[0], caption=await listing_caption(sub_id)),
+                    priority=PRIORITY_CHANNEL, key=f"outbox:{entry_id}"
+                )
+            except TelegramBadRequest as e:
+                if "not modified" not in str(e):
+                    raise
+        await db.execute("UPDATE outbox SET status='done' WHERE id=?", (entry_id,))
+
+    async def _bump(self, bot: Bot, entry_id: int, sub_id: int):
+        """Піднімає оголошення: новий альбом у каналі, старий видаляється."""
+        old = [r[0] for r in await db.fetchall(
+            "SELECT message_id FROM channel_posts WHERE sub_id=? ORDER BY position", (sub_id,)
+        )]
+        photos, media_types = await load_media(sub_id)
+        messages = await self._send_once(
+            bot, entry_id, SendMediaGroup(chat_id=CHANNEL_ID, media=build_album(photos, media_types, await listing_caption(sub_id))),
+            key=f"outbox:{entry_id}"
+        )
+        sent_at = int(self.clock())
+
+        def done(conn: sqlite3.Connection):
+            _save_channel_posts(conn, sub_id, messages)
+            conn.execute("UPDATE outbox SET status='done', next_attempt_at=? WHERE id=?", (sent_at, entry_id))
+        await db.transaction(done)
+
+        if old:
+            try:
+                await sender.send(bot, DeleteMessages(chat_id=CHANNEL_ID, message_ids=old), priority=PRIORITY_CHANNEL)
+            except TelegramBadRequest as e:
+                logging.warning("Could not delete old post of #%s: %s", sub_id, e)
+
+    async def _fail(self, bot: Bot, entry_id: int, sub_id: int, kind: str, attempts: int, error: Exception):
+        if attempts < self.max_attempts:
+            await db.execute(
+                "UPDATE outbox SET attempts=?, last_error=?, next_attempt_at=? WHERE id=?",
+                (attempts, str(error), int(self.clock()) + 2 ** attempts * 10, entry_id)
+            )
+            return
+
+        def give_up(conn: sqlite3.Connection):
+            conn.execute("UPDATE outbox SET status='failed', attempts=?, last_error=? WHERE id=?",
+                         (attempts, str(error), entry_id))
+            if kind == "publish":
+                # повертаємо заявку модераторам
+                conn.execute("UPDATE submissions SET status='pending' WHERE id=? AND status='publishing'", (sub_id,))
+        await db.transaction(give_up)
+
+        if kind == "publish":
+            await sender.send(
+                bot,
+                SendMessage(chat_id=MOD_GROUP_ID,
+                            text=f"⚠️ Не вдалося опублікувати заявку #{sub_id}: {esc(error)}",
+                            reply_markup=kb_mod(sub_id)),
+                priority=PRIORITY_MOD
+            )
+
+
+outbox = OutboxDispatcher()
+
+# ---------- Bot ----------
+# Створюється в setup(), а не при імпорті: без BOT_TOKEN модуль усе одно імпортується
+bot: Optional[Bot] = None
+class AlbumMiddleware(BaseMiddleware):
+    """Збирає повідомлення одного альбому (media_group_id) в один виклик хендлера.
+
+    Telegram надсилає кожне фото альбому окремим оновленням. Перше з них чекає,
+    доки протягом latency не перестануть приходити нові, і передає хендлеру
+    весь альбом у data["album"]; решта оновлень просто додаються до нього.
+    """
+
+    def __init__(self, latency: float = 0.5):
+        self.latency = latency
+        self._albums: Dict[Tuple[int, str], List[Message]] = {}
+
+    async def __call__(self, handler, event: Message, data: Dict[str, Any]):
+        if not event.media_group_id:
+            return await handler(event, data)
+
+        key = (event.chat.id, event.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(event)
+            return None
+
+        self._albums[key] = album = [event]
+        try:
+            size = 0
+            while size != len(album):
+                size = len(album)
+                await asyncio.sleep(self.latency)
+        finally:
+            del self._albums[key]
+
+        album.sort(key=lambda x: x.message_id)
+        data["album"] = album
+        return await handler(album[0], data)
+
+
+fsm_storage = SQLiteStorage(db)
+dp = Dispatcher(storage=fsm_storage)
+dp.message.outer_middleware(AlbumMiddleware())
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Час і помилки кожного хендлера (мітка — ім'я функції)."""
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        name = data["handler"].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Час і помилки запитів до Bot API (мітка — назва методу)."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, method=name)
+
+
+for observer in (dp.message, dp.callback_query, dp.inline_query):
+    observer.middleware(HandlerMetricsMiddleware())
+
+
+def setup() -> Bot:
+    """Фабрика застосунку: перевіряє конфіг, відкриває БД і створює бота (один раз).
+
+    Нічого не звертається до Telegram — це робить уже запуск polling/webhook.
+    """
+    global bot
+    if bot is None:
+        config.require()
+        open_db()
+        bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+        bot.session.middleware(ApiMetricsMiddleware())
+    return bot
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    # фонові задачі — лише в одному процесі (див. SHARDS)
+    if SHARD == 0:
+        outbox.start(bot)
+        mod_sessions.start()
+        archiver.start()
+
+@dp.shutdown()
+async def on_shutdown():
+    await outbox.stop()
+    await mod_sessions.stop()
+    await archiver.stop()
+    # дописуємо в БД останні зміни FSM
+    await fsm_storage.close()
+
+class ModSessions:
+    """Незавершені дії модераторів (відмова, вибір тегів) у спільній БД.
+
+    Замість словників у пам'яті: переживають рестарт, спільні для всіх
+    процесів, мають TTL і не більше max_per_kind записів на модератора
+    (найстаріші витісняються). Прострочені записи прибирає фоновий sweeper.
+    """
+
+    # відмова з причиною, вибір тегів, вибір заявок для пакетної модерації
+    KINDS = ("deny", "tags", "batch")
+
+    def __init__(self, db: Storage, ttl: int = 3600, max_per_kind: int = 20, sweep_interval: float = 600):
+        self.db = db
+        self.ttl = ttl
+        self.max_per_kind = max_per_kind
+        self.sweep_interval = sweep_interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def get(self, moder_id: int, kind: str, sub_id: int = 0) -> Optional[int]:
+        row = await self.db.fetchone(
+            "SELECT value FROM mod_sessions WHERE moder_id=? AND kind=? AND sub_id=? AND expires_at > strftime('%s','now')",
+            (moder_id, kind, sub_id)
+        )
+        return row[0] if row else None
+
+    async def set(self, moder_id: int, kind: str, sub_id: int, value: int, limit: Optional[int] = None):
+        def write(conn: sqlite3.Connection):
+            conn.execute(
+                "INSERT OR REPLACE INTO mod_sessions (moder_id, kind, sub_id, value, expires_at) "
+                "VALUES (?, ?, ?, ?, strftime('%s','now') + ?)",
+                (moder_id, kind, sub_id, value, self.ttl)
+            )
+            conn.execute(
+                # REPLACE дає рядку новий rowid, тож найбільші rowid — нещодавно використані
+                "DELETE FROM mod_sessions WHERE moder_id=? AND kind=? AND rowid NOT IN ("
+                "  SELECT rowid FROM mod_sessions WHERE moder_id=? AND kind=? ORDER BY rowid DESC LIMIT ?)",
+                (moder_id, kind, moder_id, kind, limit or self.max_per_kind)
+            )
+        await self.db.transaction(write)
+
+    async def pop(self, moder_id: int, kind: str, sub_id: int = 0) -> Optional[int]:
+        def take(conn: sqlite3.Connection) -> Optional[int]:
+            row = conn.execute(
+                "DELETE FROM mod_sessions WHERE moder_id=? AND kind=? AND sub_id=? "
+                "AND expires_at > strftime('%s','now') RETURNING value",
+                (moder_id, kind, sub_id)
+            ).fetchone()
+            return row[0] if row else None
+        return await self.db.transaction(take)
+
+    async def items(self, moder_id: int, kind: str) -> Dict[int, int]:
+        rows = await self.db.fetchall(
+            "SELECT sub_id, value FROM mod_sessions WHERE moder_id=? AND kind=? AND expires_at > strftime('%s','now')",
+            (moder_id, kind)
+        )
+        return dict(rows)
+
+    async def pop_all(self, moder_id: int, kind: str) -> List[int]:
+        def take(conn: sqlite3.Connection) -> List[int]:
+            rows = conn.execute(
+                "DELETE FROM mod_sessions WHERE moder_id=? AND kind=? AND expires_at > strftime('%s','now') RETURNING sub_id",
+                (moder_id, kind)
+            ).fetchall()
+            return sorted(row[0] for row in rows)
+        return await self.db.transaction(take)
+
+    async def sweep(self) -> int:
+        return await self.db.execute("DELETE FROM mod_sessions WHERE expires_at <= strftime('%s','now')")
+
+    async def sizes(self) -> Dict[str, int]:
+        rows = await self.db.fetchall("SELECT kind, COUNT(*) FROM mod_sessions GROUP BY kind")
+        return dict(rows)
+
+    async def _sweeper(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logging.exception("Mod sessions sweep failed")
+
+    def start(self):
+        self._task = asyncio.create_task(self._sweeper())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+mod_sessions = ModSessions(db)
+
+# ---------- Archive ----------
+class Archiver:
+    """Переносить давно оброблені заявки з БД у стиснуті помісячні файли.
+
+    Повний рядок (answers, підпис, file_id медіа, теги, правки, пости в каналі)
+    дописується в ARCHIVE_DIR/submissions-YYYY-MM.jsonl.gz за місяцем подачі.
+    У БД лишається заглушка: статус, автор, дати, типізовані поля, MinHash і
+    file_unique_id медіа — для пошуку дублікатів і статистики. Працює пачками
+    по batch_size рядків, кожна — окрема коротка транзакція, а звільнені
+    сторінки повертаються incremental vacuum'ом кроками по vacuum_pages.
+    Якщо процес впаде між записом файлу і транзакцією, пачка буде дописана
+    ще раз (як і outbox — краще повтор, ніж втрата).
+    """
+
+    def __init__(self, db: Storage, directory: str, age: int, batch_size: int = 200,
+                 vacuum_pages: int = 1000, interval: float = 24 * 3600):
+        self.db = db
+        self.directory = directory
+        self.age = age
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self) -> Dict[str, int]:
+        """Архівує все, що встигло застаріти. Повертає кількість рядків і звільнені байти."""
+        await self.db.transaction(self._enable_incremental_vacuum)
+        size_before = await self.db_size()
+        cutoff = int(time.time()) - self.age
+        archived = 0
+        while True:
+            ids = [row[0] for row in await self.db.fetchall(
+                # спершу за індексом по changed_at, потім перевірка статусу і незавершених записів outbox
+                "SELECT id FROM submissions s WHERE archived_at IS NULL AND changed_at < ? "
+                "AND status IN ('approved', 'denied', 'sold') "
+                "AND NOT EXISTS (SELECT 1 FROM outbox o WHERE o.sub_id=s.id AND o.status IN ('pending', 'sending')) "
+                "ORDER BY changed_at LIMIT ?",
+                (cutoff, self.batch_size)
+            )]
+            if not ids:
+                break
+            records = await self.db.read(lambda conn: self._collect(conn, ids))
+            await asyncio.to_thread(self._write_files, records)
+            archived += await self.db.transaction(lambda conn: self._stub(conn, ids))
+
+        while await self.db.transaction(self._vacuum_step):
+            pass
+        reclaimed = size_before - await self.db_size()
+        if archived:
+            logging.info("Archived %s submissions, reclaimed %s bytes", archived, reclaimed)
+        return {"archived": archived, "reclaimed_bytes": reclaimed}
+
+    async def db_size(self) -> int:
+        pages, = await self.db.fetchone("PRAGMA page_count")
+        page_size, = await self.db.fetchone("PRAGMA page_size")
+        return pages * page_size
+
+    @staticmethod
+    def _enable_incremental_vacuum(conn: sqlite3.Connection):
+        # режим auto_vacuum змінюється лише повним VACUUM — один раз для старих баз
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.commit()
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+
+    def _vacuum_step(self, conn: sqlite3.Connection) -> bool:
+        if not conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            return False
+        conn.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall()
+        return True
+
+    @staticmethod
+    def _collect(conn: sqlite3.Connection, ids: List[int]) -> List[Dict[str, Any]]:
+        marks = ",".join("?" * len(ids))
+        cursor = conn.execute(f"SELECT * FROM submissions WHERE id IN ({marks})", ids)
+        columns = [c[0] for c in cursor.description]
+        records = {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+        for record in records.values():
+            record["answers"] = json.loads(record["answers"] or "{}")
+            record["minhash"] = None  # лишається в заглушці
+            record.update(media=[], tags=[], edits=[], channel_posts=[])
+        for sub_id, file_id, media_type, uid in conn.execute(
+            f"SELECT sub_id, file_id, media_type, file_unique_id FROM submission_media "
+            f"WHERE sub_id IN ({marks}) ORDER BY sub_id, position", ids
+        ):
+            records[sub_id]["media"].append({"file_id": file_id, "type": media_type, "file_unique_id": uid})
+        for sub_id, name in conn.execute(
+            f"SELECT st.sub_id, t.name FROM submission_tags st JOIN tags t ON t.id = st.tag_id "
+            f"WHERE st.sub_id IN ({marks})", ids
+        ):
+            records[sub_id]["tags"].append(name)
+        for sub_id, field, value, status, created_at in conn.execute(
+            f"SELECT sub_id, field, value, status, created_at FROM listing_edits WHERE sub_id IN ({marks}) ORDER BY id", ids
+        ):
+            records[sub_id]["edits"].append({"field": field, "value": value, "status": status, "created_at": created_at})
+        for sub_id, message_id in conn.execute(
+            f"SELECT sub_id, message_id FROM channel_posts WHERE sub_id IN ({marks}) ORDER BY sub_id, position", ids
+        ):
+            records[sub_id]["channel_posts"].append(message_id)
+        return list(records.values())
+
+    def _write_files(self, records: List[Dict[str, Any]]):
+        by_month: Dict[str, List[str]] = {}
+        for record in records:
+            month = time.strftime("%Y-%m", time.gmtime(record["created_at"] or 0))
+            by_month.setdefault(month, []).append(json.dumps(record, ensure_ascii=False))
+        os.makedirs(self.directory, exist_ok=True)
+        for month, lines in by_month.items():
+            path = os.path.join(self.directory, f"submissions-{month}.jsonl.gz")
+            # кожна пачка — окремий gzip-member; gzip.open читає файл цілком
+            with open(path, "ab") as f:
+                f.write(gzip.compress(("\n".join(lines) + "\n").encode()))
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def _stub(conn: sqlite3.Connection, ids: List[int]) -> int:
+        marks = ",".join("?" * len(ids))
+        cursor = conn.execute(f"SELECT * FROM submissions WHERE id IN ({marks}) AND archived_at IS NULL", ids)
+        columns = [c[0] for c in cursor.description]
+        stubs = []
+        for row in cursor.fetchall():
+            stub = dict(zip(columns, row))
+            stub.update(
+                answers=json.dumps({"car_title": json.loads(stub["answers"] or "{}").get("car_title")}, ensure_ascii=False),
+                caption=None, photos=None, media_types=None, tags=None, archived_at=int(time.time()),
+            )
+            stubs.append(tuple(stub[c] for c in columns))
+        # DELETE + INSERT замість UPDATE: SQLite не зливає напівпорожні сторінки при
+        # зменшенні рядка на місці, а після видалення — так, і їх забирає incremental vacuum
+        conn.execute(f"DELETE FROM submissions WHERE id IN ({marks}) AND archived_at IS NULL", ids)
+        conn.executemany(
+            f"INSERT INTO submissions ({','.join(columns)}) VALUES ({','.join('?' * len(columns))})", stubs
+        )
+        archived = len(stubs)
+        # file_unique_id лишається для пошуку тих самих фото
+        media = conn.execute(
+            f"SELECT sub_id, position, media_type, file_unique_id FROM submission_media WHERE sub_id IN ({marks})", ids
+        ).fetchall()
+        conn.execute(f"DELETE FROM submission_media WHERE sub_id IN ({marks})", ids)
+        conn.executemany(
+            "INSERT INTO submission_media (sub_id, position, file_id, media_type, file_unique_id) VALUES (?, ?, '', ?, ?)",
+            media
+        )
+        conn.execute(f"DELETE FROM submission_tags WHERE sub_id IN ({marks})", ids)
+        conn.execute(f"DELETE FROM listing_edits WHERE sub_id IN ({marks})", ids)
+        conn.execute(f"DELETE FROM channel_posts WHERE sub_id IN ({marks})", ids)
+        conn.execute(f"DELETE FROM listings_fts WHERE rowid IN ({marks})", ids)
+        return archived
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logging.exception("Archive run failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.age > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+archiver = Archiver(db, ARCHIVE_DIR, ARCHIVE_AFTER)
+
+# ---------- Commands / Menu ----------
+@dp.message(F.text.in_({"/help", "help", "ℹ️ Як це працює"}))
+async def help_cmd(m: Message):
+    await m.answer(
+        "Як подати оголошення:\n"
+        "1) Натисни «🚗 Подати оголошення» або /start\n"
+        "2) Відповідай на питання\n"
+        "3) Додай фото/відео: 1) головне, 2) ззаду, 3) решта до 8\n"
+        "4) Натисни «Надіслати на модерацію ✅»\n\n"
+        "Команди:\n"
+        "/start — почати\n"
+        "/restart — почати заново\n"
+        "/cancel — скасувати\n"
+        "/my — мої оголошення: змінити ціну чи опис, позначити проданим, підняти\n"
+        "/sub — підписатися на нові оголошення за запитом, /subs — мої підписки\n"
+        "/help — інструкція",
+        reply_markup=main_menu_kb()
+    )
+
+@dp.message(F.text.in_({"/cancel", "cancel", "❌ Скасувати"}))
+async def cancel_cmd(m: Message, state: FSMContext):
+    await state.clear()
+    await m.answer(
+        "Скасовано ✅\nНатисни «🚗 Подати оголошення» або /start, щоб почати знову.",
+        reply_markup=main_menu_kb()
+    )
+
+@dp.message(F.text.in_({"/restart", "restart", "🔄 Почати заново"}))
+async def restart_cmd(m: Message, state: FSMContext):
+    await state.clear()
+    await m.answer("Ок, починаємо заново ✅", reply_markup=main_menu_kb())
+    await m.answer(FIELDS[0].prompt)
+    await state.set_state(FIELDS[0].state)
+
+@dp.message(F.text.in_({"/start", "🚗 Подати оголошення"}))
+async def start(m: Message, state: FSMContext):
+    await start_flow(m, state)
+
+@dp.message(F.text.in_({"/my", "📋 Мої оголошення"}))
+async def my_listings(m: Message):
+    rows = await db.fetchall(
+        "SELECT s.id, s.status, json_extract(s.answers, '$.car_title'), json_extract(s.answers, '$.price') "
+        "FROM submissions s WHERE s.user_id=? AND s.status IN ('approved', 'sold') "
+        "AND EXISTS (SELECT 1 FROM channel_posts p WHERE p.sub_id=s.id) ORDER BY s.id DESC LIMIT 10",
+        (m.from_user.id,)
+    )
+    if not rows:
+        await m.answer("Опублікованих оголошень поки немає.", reply_markup=main_menu_kb())
+        return
+    for sub_id, status, car_title, price in rows:
+        text = f"#{sub_id} · {esc(car_title or '')} · {esc(price or '')}"
+        if status == "sold":
+            await m.answer(text + " · продано ✅")
+        else:
+            await m.answer(text, reply_markup=kb_listing(sub_id))
+
+# ---------- Moderation queue ----------
+QUEUE_PAGE_SIZE = 10
+
+STATUS_NAMES = {
+    "pending": "на модерації",
+    "publishing": "публікуються",
+    "approved": "опубліковані",
+    "denied": "відхилені",
+    "sold": "продані",
+}
+
+BATCH_LIMIT = 50
+
+async def render_queue(cursor: Optional[str], moder_id: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Сторінка черги; кнопки з номерами додають заявку у вибір для пакетної дії."""
+    counts = await status_counts()
+    rows = await pending_page(parse_cursor(cursor), QUEUE_PAGE_SIZE)
+    selected = await mod_sessions.items(moder_id, "batch")
+    here = cursor or ""
+
+    lines = [" · ".join(f"{STATUS_NAMES.get(k, k)}: {v}" for k, v in counts.items()) or "Заявок немає", ""]
+    for sub_id, created_at, _, username, car_title in rows:
+        when = time.strftime("%d.%m %H:%M", time.localtime(created_at))
+        who = f"@{esc(username)}" if username else "—"
+        lines.append(f"#{sub_id} · {when} · {esc(car_title or '')} · {who}")
+    if not rows:
+        lines.append("Черга порожня ✅")
+
+    buttons = [
+        InlineKeyboardButton(text=("☑️" if sub_id in selected else "▫️") + f" #{sub_id}",
+                             callback_data=f"bsel:{sub_id}:{here}")
+        for sub_id, *_ in rows
+    ]
+    keyboard = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+    if rows:
+        keyboard.append([InlineKeyboardButton(text="Вибрати сторінку", callback_data=f"bpage:{here}")])
+    if selected:
+        lines += ["", f"Вибрано: {len(selected)}"]
+        keyboard.append([
+            InlineKeyboardButton(text=f"🚀 Схвалити ({len(selected)})", callback_data=f"bapprove:{here}"),
+            InlineKeyboardButton(text=f"❌ Відхилити ({len(selected)})", callback_data="bdeny"),
+        ])
+        keyboard.append([InlineKeyboardButton(text="Зняти вибір", callback_data=f"bclear:{here}")])
+    if len(rows) == QUEUE_PAGE_SIZE:
+        last_id, last_created = rows[-1][0], rows[-1][1]
+        keyboard.append([InlineKeyboardButton(text="Далі ▶️", callback_data=f"queue:{last_created}:{last_id}")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=keyboard) if keyboard else None
+
+@dp.message(Command("queue"))
+async def queue_cmd(m: Message):
+    if m.from_user.id not in MODERATOR_IDS:
+        return
+    text, kb = await render_queue(None, m.from_user.id)
+    await m.answer(text, reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("queue:"))
+async def queue_page(cb: CallbackQuery):
+    if cb.from_user.id not in MODERATOR_IDS:
+        await cb.answer("Немає доступу", show_alert=True)
+        return
+    text, kb = await render_queue(cb.data.split(":", 1)[1], cb.from_user.id)
+    await cb.message.edit_text(text, reply_markup=kb)
+    await cb.answer()
+
+# ---------- Batch moderation ----------
+# Вибір зберігається в mod_sessions (kind="batch"), тож переживає рестарт і
+# видимий усім процесам; самі дії — одна транзакція на всі вибрані заявки.
+
+async def refresh_queue(cb: CallbackQuery, cursor: str):
+    text, kb = await render_queue(cursor, cb.from_user.id)
+    try:
+        await cb.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+@dp.callback_query(F.data.startswith("bsel:"))
+async def batch_toggle(cb: CallbackQuery):
+    if cb.from_user.id not in MODERATOR_IDS:
+        await cb.answer("Немає доступу", show_alert=True)
+        return
+
+    _, sub_id_str, cursor = cb.data.split(":", 2)
+    sub_id = int(sub_id_str)
+    if await mod_sessions.pop(cb.from_user.id, "batch", sub_id) is None:
+        if len(await mod_sessions.items(cb.from_user.id, "batch")) >= BATCH_LIMIT:
+            await cb.answer(f"Не більше {BATCH_LIMIT} заявок за раз", show_alert=True)
+            return
+        await mod_sessions.set(cb.from_user.id, "batch", sub_id, 1, limit=BATCH_LIMIT)
+    await refresh_queue(cb, cursor)
+    await cb.answer()
+
+@dp.callback_query(F.data.startswith("bpage:"))
+async def batch_select_page(cb: CallbackQuery):
+    if cb.from_user.id not in MODERATOR_IDS:
+        await cb.answer("Немає доступу", show_alert=True)
+        return
+
+    cursor = cb.data.split(":", 1)[1]
+    rows = await pending_page(parse_cursor(cursor), QUEUE_PAGE_SIZE)
+    for sub_id, *_ in rows:
+        await mod_sessions.set(cb.from_user.id, "batch", sub_id, 1, limit=BATCH_LIMIT)
+    await refresh_queue(cb, cursor)
+    await cb.answer()
+
+@dp.callback_query(F.data.startswith("bclear:"))
+async def batch_clear(cb: CallbackQuery):
+    if cb.from_user.id not in MODERATOR_IDS:
+        await cb.answer("Немає доступу", show_alert=True)
+        return
+
+    await mod_sessions.pop_all(cb.from_user.id, "batch")
+    await refresh_queue(cb, cb.data.split(":", 1)[1])
+    await cb.answer("Вибір знято")
+
+@dp.callback_query(F.data.startswith("bapprove:"))
+async def batch_approve(cb: CallbackQuery):
+    if cb.from_user.id not in MODERATOR_IDS:
+        await cb.answer("Немає доступу", show_alert=True)
+        return
+
+    scheduled = await publish_batch(await mod_sessions.pop_all(cb.from_user.id, "batch"))
+    await refresh_queue(cb, cb.data.split(":", 1)[1])
+    if not scheduled:
+        await cb.answer("Вибрані заявки вже оброблені", show_alert=True)
+        return
+
+    await cb.answer(f"Схвалено: {len(scheduled)} ✅")
+    await cb.message.answer(
+        f"✅ Схвалено з підказаними тегами: {' '.join(f'#{sub_id}' for sub_id, _ in scheduled)}\n"
+        f"🕒 Вийдуть у канал {fmt_time(scheduled[0][1])} — {fmt_time(scheduled[-1][1])}"
+    )
+
+@dp.callback_query(F.data == "bdeny")
+async def batch_deny(cb: CallbackQuery, state: FSMContext):
+    if cb.from_user.id not in MODERATOR_IDS:
+        await cb.answer("Немає доступу", show_alert=True)
+        return
+
+    count = len(await mod_sessions.items(cb.from_user.id, "batch"))
+    if not count:
+        await cb.answer("Нічого не вибрано", show_alert=True)
+        return
+    await state.set_state(ModForm.batch_deny_reason)
+    await cb.message.answer(f"Напиши причину відмови для {count} заявок одним повідомленням")
+    await cb.answer()
+
+@dp.message(ModForm.batch_deny_reason, F.text)
+async def batch_deny_reason(m: Message, state: FSMContext):
+    await state.clear()
+    denied = await deny_batch(await mod_sessions.pop_all(m.from_user.id, "batch"), m.text)
+    if not denied:
+        await m.answer("Вибрані заявки вже оброблені або вибір застарів.")
+        return
+    await m.answer(f"❌ Відхилено: {' '.join(f'#{sub_id}' for sub_id in denied)}. Причину надіслано ✅")
+
+# ---------- Inline search ----------
+@dp.inline_query()
+async def inline_search(q: InlineQuery):
+    before = int(q.offset) if q.offset.isdigit() else None
+    rows = await search_listings(q.query, before=before, limit=20)
+
+    results = []
+    for sub_id, caption, car_title, price, city in rows:
+        results.append(InlineQueryResultArticle(
+            id=str(sub_id),
+            title=car_title or f"Оголошення #{sub_id}",
+            description=" · ".join(x for x in (price, city) if x),
+            input_message_content=InputTextMessageContent(message_text=caption or esc(car_title or "")),
+        ))
+
+    await q.answer(results, cache_time=30, next_offset=str(rows[-1][0]) if len(rows) == 20 else "")
+
+# ---------- Saved searches ----------
+# Підписка — збережений пошуковий запит (слова з назви, теги, місто, ціна<X, пробіг<X).
+# Кожна підписка індексується одним найвужчим ключем (слово > місто > тег > «*»),
+# тож для нового поста перевіряються лише підписки під його словами, тегами й містом.
+
+MAX_SUBSCRIPTIONS = 10
+FANOUT_BATCH = 50
+
+def parse_subscription(query: str) -> Optional[Dict[str, Any]]:
+    words, tags, filters = parse_search(query)
+    city = None
+    for word in words:
+        city = city or CITY_INDEX.get(_city_key(word))
+    if city:
+        words = [w for w in words if CITY_INDEX.get(_city_key(w)) != city]
+    if not (words or tags or city or filters):
+        return None
+    return {"words": words, "tags": tags, "city": city, "filters": [list(f) for f in filters]}
+
+def subscription_key(conditions: Dict[str, Any]) -> str:
+    if conditions["words"]:
+        return "w:" + max(conditions["words"], key=len)
+    if conditions["city"]:
+        return "c:" + conditions["city"]
+    if conditions["tags"]:
+        return "t:" + conditions["tags"][0]
+    return "*"
+
+def subscription_matches(conditions: Dict[str, Any], listing: Dict[str, Any]) -> bool:
+    return (
+        all(word in listing["words"] for word in conditions["words"])
+        and all(tag in listing["tags"] for tag in conditions["tags"])
+        and (not conditions["city"] or conditions["city"] == listing["city"])
+        and all(
+            Filter(*f).check(listing["price_amount"], listing["price_currency"]) if f[0] == "price"
+            else Filter(*f).check(listing["mileage_km"])
+            for f in conditions["filters"]
+        )
+    )
+
+async def add_subscription(user_id: int, query: str, conditions: Dict[str, Any]) -> Optional[int]:
+    """Зберігає підписку; None, якщо в користувача вже MAX_SUBSCRIPTIONS."""
+    def write(conn: sqlite3.Connection) -> Optional[int]:
+        count, = conn.execute("SELECT COUNT(*) FROM subscriptions WHERE user_id=?", (user_id,)).fetchone()
+        if count >= MAX_SUBSCRIPTIONS:
+            return None
+        subscription_id = conn.execute(
+            "INSERT INTO subscriptions (user_id, query, conditions) VALUES (?, ?, ?)",
+            (user_id, query, json.dumps(conditions, ensure_ascii=False))
+        ).lastrowid
+        conn.execute(
+            "INSERT INTO subscription_keys (key, subscription_id) VALUES (?, ?)",
+            (subscription_key(conditions), subscription_id)
+        )
+        return subscription_id
+    return await db.transaction(write)
+
+def _delete_subscriptions(conn: sqlite3.Connection, where: str, params: tuple) -> int:
+    ids = [row[0] for row in conn.execute(f"DELETE FROM subscriptions WHERE {where} RETURNING id", params)]
+    conn.executemany("DELETE FROM subscription_keys WHERE subscription_id=?", [(i,) for i in ids])
+    return len(ids)
 
-async def publish_submission(sub_id: int, with_tags: List[str] | None = None):
-    cur.execute("SELECT user_id, answers, photos, media_types, status FROM submissions WHERE id=?", (sub_id,))
-    row = cur.fetchone()
+def listing_terms(conn: sqlite3.Connection, sub_id: int) -> Optional[Dict[str, Any]]:
+    """Те, з чим порівнюються підписки: слова назви, теги, місто, ціна, пробіг, пост у каналі."""
+    row = conn.execute(
+        "SELECT user_id, answers, price_amount, price_currency, mileage_km, city FROM submissions "
+        "WHERE id=? AND status='approved'", (sub_id,)
+    ).fetchone()
     if not row:
         return None
+    user_id, answers, price_amount, price_currency, mileage_km, city = row
+    answers = json.loads(answers or "{}")
+    tags = {name for name, in conn.execute(
+        "SELECT t.name FROM submission_tags st JOIN tags t ON t.id = st.tag_id WHERE st.sub_id=?", (sub_id,)
+    )}
+    post = conn.execute("SELECT message_id FROM channel_posts WHERE sub_id=? AND position=0", (sub_id,)).fetchone()
+    return {
+        "user_id": user_id, "car_title": answers.get("car_title") or "", "price": answers.get("price") or "",
+        "words": set(re.findall(r"\w+", (answers.get("car_title") or "").lower())), "tags": tags,
+        "city": city, "price_amount": price_amount, "price_currency": price_currency,
+        "mileage_km": mileage_km, "message_id": post[0] if post else None,
+    }
 
-    user_id, answers_json, photos_json, media_types_json, status = row
-    if status != "pending":
-        return None
-
-    data = json.loads(answers_json)
-    photos = json.loads(photos_json)
-    media_types = json.loads(media_types_json) if media_types_json else ["photo"] * len(photos)
+def queue_matches(conn: sqlite3.Connection, sub_id: int) -> int:
+    """Підбирає підписки під пост і ставить їх у fanout_queue. Повертає кількість.
 
-    post_text = render_post(data, with_tags or [])
+    Кандидати — лише підписки під ключами поста (його слова, теги, місто і «*»),
+    решта умов перевіряється в Python; повного перебору підписок немає.
+    """
+    listing = listing_terms(conn, sub_id)
+    if listing is None:
+        return 0
+    keys = ["*", *("w:" + w for w in listing["words"]), *("t:" + t for t in listing["tags"])]
+    if listing["city"]:
+        keys.append("c:" + listing["city"])
+    matched = [
+        (sub_id, subscription_id)
+        for subscription_id, user_id, conditions in conn.execute(
+            f"SELECT s.id, s.user_id, s.conditions FROM subscription_keys k "
+            f"JOIN subscriptions s ON s.id = k.subscription_id WHERE k.key IN ({','.join('?' * len(keys))})",
+            keys
+        )
+        if user_id != listing["user_id"] and subscription_matches(json.loads(conditions), listing)
+    ]
+    conn.executemany("INSERT OR IGNORE INTO fanout_queue (sub_id, subscription_id) VALUES (?, ?)", matched)
+    return len(matched)
 
-    album: List[InputMediaPhoto | InputMediaVideo] = []
-    for i, (media_id, media_type) in enumerate(zip(photos, media_types)):
-        if i == 0:
-            if media_type == "video":
-                album.append(InputMediaVideo(media=media_id, caption=post_text))
-            else:
-                album.append(InputMediaPhoto(media=media_id, caption=post_text))
-        else:
-            if media_type == "video":
-                album.append(InputMediaVideo(media=media_id))
-            else:
-                album.append(InputMediaPhoto(media=media_id))
+def post_link(message_id: Optional[int]) -> Optional[str]:
+    channel = str(CHANNEL_ID)
+    if not message_id:
+        return None
+    if channel.startswith("@"):
+        return f"https://t.me/{channel[1:]}/{message_id}"
+    if channel.startswith("-100"):
+        return f"https://t.me/c/{channel[4:]}/{message_id}"
+    return None
 
-    await bot.send_media_group(CHANNEL_ID, album)
+@lru_cache(maxsize=1024)
+def kb_unsubscribe(subscription_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔕 Відписатися", callback_data=f"unsub:{subscription_id}")]
+    ])
 
-    cur.execute("UPDATE submissions SET status='approved', tags=? WHERE id=?", (json.dumps(with_tags or [], ensure_ascii=False), sub_id))
-    db.commit()
+async def notify_subscribers(bot: Bot, sub_id: int, listing: Dict[str, Any], matched: List[tuple]):
+    link = post_link(listing["message_id"])
+    details = " · ".join(esc(x) for x in (listing["car_title"], listing["price"], listing["city"]) if x)
 
-    await bot.send_message(user_id, "✅ Оголошення опубліковано", reply_markup=main_menu_kb())
-    return True
+    async def notify(subscription_id: int, user_id: int, query: str):
+        try:
+            await sender.send(
+                bot,
+                SendMessage(
+                    chat_id=user_id,
+                    text=f"🔔 Нове оголошення за підпискою «{esc(query)}»\n\n{details}"
+                         + (f"\n{link}" if link else ""),
+                    reply_markup=kb_unsubscribe(subscription_id)
+                ),
+                priority=PRIORITY_FANOUT, key=f"match:{sub_id}:{subscription_id}"
+            )
+        except TelegramForbiddenError:
+            # користувач заблокував бота — підписки більше не потрібні
+            await db.transaction(lambda conn: _delete_subscriptions(conn, "user_id=?", (user_id,)))
+        except Exception:
+            logging.exception("Subscription %s notification failed", subscription_id)
 
-# ---------- Bot ----------
-bot = Bot(
-    BOT_TOKEN,
-    default=DefaultBotProperties(parse_mode="HTML")
-)
-dp = Dispatcher()
+    await asyncio.gather(*(notify(*row) for row in matched))
 
-pending_denies: Dict[int, int] = {}
-pending_tag_select: Dict[Tuple[int, int], List[str]] = {}  # (moder_id, sub_id) -> tags
+@dp.message(F.text.regexp(r"^/sub(?:@\w+)?(?:\s|$)"))
+async def subscribe_cmd(m: Message):
+    query = m.text.partition(" ")[2].strip()
+    conditions = parse_subscription(query)
+    if conditions is None:
+        await m.answer(
+            "Напиши, що шукаєш, і бот повідомить про нові оголошення, наприклад:\n"
+            "/sub audi #дизель київ ціна<12000$\n\n"
+            "Слова з назви, хештеги, місто, ціна<X, пробіг<X. Твої підписки — /subs",
+            reply_markup=main_menu_kb()
+        )
+        return
+    subscription_id = await add_subscription(m.from_user.id, query, conditions)
+    if subscription_id is None:
+        await m.answer(f"Не більше {MAX_SUBSCRIPTIONS} підписок. Видали зайві в /subs", reply_markup=main_menu_kb())
+        return
+    await m.answer(f"🔔 Підписку збережено: «{esc(query)}»", reply_markup=kb_unsubscribe(subscription_id))
 
-# ---------- Commands / Menu ----------
-@dp.message(F.text.in_({"/help", "help", "ℹ️ Як це працює"}))
-async def help_cmd(m: Message):
-    await m.answer(
-        "Як подати оголошення:\n"
-        "1) Натисни «🚗 Подати оголошення» або /start\n"
-        "2) Відповідай на питання\n"
-        "3) Додай фото/відео: 1) головне, 2) ззаду, 3) решта до 8\n"
-        "4) Натисни «Надіслати на модерацію ✅»\n\n"
-        "Команди:\n"
-        "/start — почати\n"
-        "/restart — почати заново\n"
-        "/cancel — скасувати\n"
-        "/help — інструкція",
-        reply_markup=main_menu_kb()
-    )
+@dp.message(F.text.in_({"/subs", "🔔 Підписки"}))
+async def subscriptions_cmd(m: Message):
+    rows = await db.fetchall("SELECT id, query FROM subscriptions WHERE user_id=? ORDER BY id", (m.from_user.id,))
+    if not rows:
+        await m.answer("Підписок немає. Додай: /sub audi #дизель ціна<10к", reply_markup=main_menu_kb())
+        return
+    for subscription_id, query in rows:
+        await m.answer(f"🔔 {esc(query)}", reply_markup=kb_unsubscribe(subscription_id))
 
-@dp.message(F.text.in_({"/cancel", "cancel", "❌ Скасувати"}))
-async def cancel_cmd(m: Message, state: FSMContext):
-    await state.clear()
-    await m.answer(
-        "Скасовано ✅\nНатисни «🚗 Подати оголошення» або /start, щоб почати знову.",
-        reply_markup=main_menu_kb()
+@dp.callback_query(F.data.startswith("unsub:"))
+async def unsubscribe(cb: CallbackQuery):
+    subscription_id = int(cb.data.split(":")[1])
+    deleted = await db.transaction(
+        lambda conn: _delete_subscriptions(conn, "id=? AND user_id=?", (subscription_id, cb.from_user.id))
     )
-
-@dp.message(F.text.in_({"/restart", "restart", "🔄 Почати заново"}))
-async def restart_cmd(m: Message, state: FSMContext):
-    await state.clear()
-    await m.answer("Ок, починаємо заново ✅", reply_markup=main_menu_kb())
-    await m.answer("1️⃣ Назва авто (наприклад: Audi A4 2013)")
-    await state.set_state(Form.car_title)
-
-@dp.message(F.text.in_({"/start", "🚗 Подати оголошення"}))
-async def start(m: Message, state: FSMContext):
-    await start_flow(m, state)
+    await cb.message.edit_reply_markup(reply_markup=None)
+    await cb.answer("Підписку видалено" if deleted else "Вже видалено")
 
 # ---------- User flow ----------
-@dp.message(Form.car_title)
-async def q_engine(m: Message, state: FSMContext):
-    await state.update_data(car_title=m.text)
-    await m.answer("2️⃣ Двигун (наприклад: 2.0 бензин / 2.0 дизель / електро)")
-    await state.set_state(Form.engine)
-
-@dp.message(Form.engine)
-async def q_gearbox(m: Message, state: FSMContext):
-    await state.update_data(engine=m.text)
-    await m.answer("3️⃣ Коробка (автомат / механіка / робот / варіатор)")
-    await state.set_state(Form.gearbox)
-
-@dp.message(Form.gearbox)
-async def q_mileage(m: Message, state: FSMContext):
-    await state.update_data(gearbox=m.text)
-    await m.answer("4️⃣ Пробіг (тільки число в км) — наприклад: 173383")
-    await state.set_state(Form.mileage)
-
-@dp.message(Form.mileage)
-async def q_city(m: Message, state: FSMContext):
-    await state.update_data(mileage=m.text)
-    await m.answer("5️⃣ Місто")
-    await state.set_state(Form.city)
-
-@dp.message(Form.city)
-async def q_price(m: Message, state: FSMContext):
-    await state.update_data(city=m.text)
-    await m.answer("6️⃣ Ціна")
-    await state.set_state(Form.price)
-
-@dp.message(Form.price)
-async def q_contacts(m: Message, state: FSMContext):
-    await state.update_data(price=m.text)
-    await m.answer("7️⃣ Контакти (телефон або Telegram)")
-    await state.set_state(Form.contacts)
-
-@dp.message(Form.contacts)
-async def q_description(m: Message, state: FSMContext):
-    await state.update_data(contacts=m.text)
-    await m.answer(f"8️⃣ Опис (стан, нюанси)\n\n⚠️ Максимум {MAX_DESCRIPTION_LENGTH} символів")
-    await state.set_state(Form.description)
-
-# ---------- Photos/Videos funnel ----------
-@dp.message(Form.description)
-async def photo_main_step(m: Message, state: FSMContext):
-    # Перевіряємо довжину опису
-    description_length = len(m.text)
-    
-    if description_length > MAX_DESCRIPTION_LENGTH:
-        await m.answer(
-            f"❌ <b>Помилка: Опис занадто довгий!</b>\n\n"
-            f"Максимум: {MAX_DESCRIPTION_LENGTH} символів\n"
-            f"Ваш опис: {description_length} символів\n\n"
-            f"Будь ласка, скороти опис і надішли його ще раз."
-        )
-        # Залишаємося в тому ж стані, щоб користувач міг написати опис знову
+@dp.message(StateFilter(*(field.state for field in FIELDS)))
+async def form_answer(m: Message, state: FSMContext):
+    index = FIELD_BY_STATE[await state.get_state()]
+    field = FIELDS[index]
+    values = field.parse(m.text) if m.text else None
+    if values is None:
+        await m.answer(field.error if m.text else "Надішли відповідь текстом, будь ласка.\n\n" + field.prompt)
+        return
+
+    await state.update_data(**values)
+    if index + 1 < len(FIELDS):
+        await m.answer(FIELDS[index + 1].prompt)
+        await state.set_state(FIELDS[index + 1].state)
         return
-    
-    # Якщо все ОК - продовжуємо
-    await state.update_data(description=m.text, photos=[], media_types=[])
+
+    # ---------- Photos/Videos funnel ----------
+    await state.update_data(photos=[], media_types=[])
     await m.answer("1️⃣ Надішли ГОЛОВНЕ фото або відео авто (спереду або збоку).\n⚠️ Одне медіа.")
     await state.set_state(Form.photo_main)
 
-@dp.message(Form.photo_main, F.photo)
-async def get_main_photo(m: Message, state: FSMContext):
-    await state.update_data(photo_main=m.photo[-1].file_id, main_type="photo")
-    await m.answer("2️⃣ Надішли фото або відео авто ЗЗАДУ.\n⚠️ Одне медіа.")
-    await state.set_state(Form.photo_back)
+async def accept_media(m: Message) -> Optional[MediaInfo]:
+    """Перевіряє медіа і кешує його метадані; при помилці відповідає користувачу."""
+    info = media_of(m)
+    error = check_media(info)
+    if error:
+        await m.answer(f"❌ {error}\nНадішли інше, будь ласка.")
+        return None
+    await remember_media(m.from_user.id, [info])
+    return info
 
-@dp.message(Form.photo_main, F.video)
-async def get_main_video(m: Message, state: FSMContext):
-    await state.update_data(photo_main=m.video.file_id, main_type="video")
-    await m.answer("2️⃣ Надішли фото або відео авто ЗЗАДУ.\n⚠️ Одне медіа.")
+@dp.message(Form.photo_main, F.photo | F.video)
+async def get_main_media(m: Message, state: FSMContext, album: Optional[List[Message]] = None):
+    # альбом на цьому кроці: перше медіа — головне, решта йде далі по кроках (album[0] — це m)
+    info = await accept_media(m)
+    if not info:
+        if album and len(album) > 1:
+            await get_main_media(album[1], state, album[1:])
+        return
+    await state.update_data(photo_main=info.file_id, main_type=info.media_type, main_uid=info.unique_id)
     await state.set_state(Form.photo_back)
+    if album and len(album) > 1:
+        await get_back_media(album[1], state, album[1:])
+        return
+    await m.answer("2️⃣ Надішли фото або відео авто ЗЗАДУ.\n⚠️ Одне медіа.")
 
 @dp.message(Form.photo_main)
 async def need_photo_main(m: Message):
     await m.answer("Надішли, будь ласка, ОДНЕ фото або відео (це буде головне).")
 
-@dp.message(Form.photo_back, F.photo)
-async def get_back_photo(m: Message, state: FSMContext):
+@dp.message(Form.photo_back, F.photo | F.video)
+async def get_back_media(m: Message, state: FSMContext, album: Optional[List[Message]] = None):
     data = await state.get_data()
-    photos = [data["photo_main"], m.photo[-1].file_id]
-    media_types = [data["main_type"], "photo"]
-    await state.update_data(photos=photos, media_types=media_types)
-
-    await m.answer(
-        "3️⃣ Тепер надішли ДОДАТКОВІ фото або відео (до 8 шт) — салон/деталі/нюанси.\n"
-        "Коли закінчиш — натисни «Готово ✅».",
-        reply_markup=kb_done()
-    )
+    if media_of(m).unique_id == data.get("main_uid"):
+        if album and len(album) > 1:
+            await get_back_media(album[1], state, album[1:])
+            return
+        await m.answer("Це те саме медіа, що й головне. Надішли фото або відео ЗЗАДУ.")
+        return
+    info = await accept_media(m)
+    if not info:
+        if album and len(album) > 1:
+            await get_back_media(album[1], state, album[1:])
+        return
+    photos = [data["photo_main"], info.file_id]
+    media_types = [data["main_type"], info.media_type]
+    media_uids = [data.get("main_uid"), info.unique_id]
+    await state.update_data(photos=photos, media_types=media_types, media_uids=media_uids)
     await state.set_state(Form.photos_extra)
 
-@dp.message(Form.photo_back, F.video)
-async def get_back_video(m: Message, state: FSMContext):
-    data = await state.get_data()
-    photos = [data["photo_main"], m.video.file_id]
-    media_types = [data["main_type"], "video"]
-    await state.update_data(photos=photos, media_types=media_types)
-
+    if album and len(album) > 1:
+        # решта альбому — додаткові медіа
+        await add_extra_media(album[1], state, album[1:])
+        count = len((await state.get_data())["photos"])
+        await m.answer(
+            f"✅ Додано {count} медіа з альбому. Можеш надіслати ще або натисни «Готово ✅».",
+            reply_markup=kb_done()
+        )
+        return
     await m.answer(
         "3️⃣ Тепер надішли ДОДАТКОВІ фото або відео (до 8 шт) — салон/деталі/нюанси.\n"
         "Коли закінчиш — натисни «Готово ✅».",
         reply_markup=kb_done()
     )
-    await state.set_state(Form.photos_extra)
 
 @dp.message(Form.photo_back)
 async def need_photo_back(m: Message):
     await m.answer("Надішли, будь ласка, ОДНЕ фото або відео ЗЗАДУ.")
 
-@dp.message(Form.photos_extra, F.photo)
-async def collect_extra_photos(m: Message, state: FSMContext):
+async def add_extra_media(m: Message, state: FSMContext, album: Optional[List[Message]]):
+    # альбом приходить одним викликом, тож стан оновлюється один раз
     data = await state.get_data()
     photos: List[str] = data.get("photos", [])
     media_types: List[str] = data.get("media_types", [])
+    media_uids: List[Optional[str]] = data.get("media_uids", [])
+    media_uids += [None] * (len(photos) - len(media_uids))
 
-    if len(photos) >= 10:
-        await m.answer("Максимум 10 медіа. Натисни «Готово ✅».", reply_markup=kb_done())
-        return
+    items, errors, seen = [], [], set(media_uids)
+    for info in filter(None, map(media_of, album or [m])):
+        if info.unique_id in seen:
+            continue  # те саме фото вже є в оголошенні
+        seen.add(info.unique_id)
+        error = check_media(info)
+        if error:
+            errors.append(error)
+        else:
+            items.append(info)
+    if errors:
+        await m.answer("❌ Не додано:\n" + "\n".join(errors))
 
-    photos.append(m.photo[-1].file_id)
-    media_types.append("photo")
-    await state.update_data(photos=photos, media_types=media_types)
+    free = MAX_MEDIA - len(photos)
+    if free > 0 and items:
+        for info in items[:free]:
+            photos.append(info.file_id)
+            media_types.append(info.media_type)
+            media_uids.append(info.unique_id)
+        await state.update_data(photos=photos, media_types=media_types, media_uids=media_uids)
+        await remember_media(m.from_user.id, items[:free])
 
-@dp.message(Form.photos_extra, F.video)
-async def collect_extra_videos(m: Message, state: FSMContext):
-    data = await state.get_data()
-    photos: List[str] = data.get("photos", [])
-    media_types: List[str] = data.get("media_types", [])
+    if len(items) > free:
+        await m.answer(f"Максимум {MAX_MEDIA} медіа. Натисни «Готово ✅».", reply_markup=kb_done())
 
-    if len(photos) >= 10:
-        await m.answer("Максимум 10 медіа. Натисни «Готово ✅».", reply_markup=kb_done())
-        return
+@dp.message(Form.photos_extra, F.photo)
+async def collect_extra_photos(m: Message, state: FSMContext, album: Optional[List[Message]] = None):
+    await add_extra_media(m, state, album)
 
-    photos.append(m.video.file_id)
-    media_types.append("video")
-    await state.update_data(photos=photos, media_types=media_types)
+@dp.message(Form.photos_extra, F.video)
+async def collect_extra_videos(m: Message, state: FSMContext, album: Optional[List[Message]] = None):
+    await add_extra_media(m, state, album)
 
 @dp.callback_query(F.data == "photos_done")
 async def photos_done(cb: CallbackQuery, state: FSMContext):
@@ -432,39 +3207,39 @@ async def send_to_mod(cb: CallbackQuery, state: FSMContext):
         await cb.answer("Мінімум 2 медіа: головне + ззаду.", show_alert=True)
         return
 
+    # у БД — підпис для каналу (його без тегів перевикористає get_caption); модераторам —
+    # окремий рендер з місцем під префікс «🆕 Заявка #N», інакше довгий опис у каналі обрізався б зайве
     text = render_post(data)
+    mod_text = render_post(data, reserve=32)
 
-    cur.execute(
-        "INSERT INTO submissions (user_id, username, answers, photos, media_types, tags) VALUES (?, ?, ?, ?, ?, ?)",
-        (
-            cb.from_user.id,
-            cb.from_user.username or "",
-            json.dumps(data, ensure_ascii=False),
-            json.dumps(photos, ensure_ascii=False),
-            json.dumps(media_types, ensure_ascii=False),
-            json.dumps([], ensure_ascii=False)
-        )
+    suggested = suggest_tags(data)
+    signature = listing_signature(data)
+    # перевіряємо до вставки, щоб заявка не знайшла сама себе
+    warnings = await duplicate_warnings(cb.from_user.id, signature, data.get("media_uids", []))
+    summary = await media_summary(data.get("media_uids", []))
+    sub_id = await create_submission(
+        cb.from_user.id, cb.from_user.username or "", data, photos, media_types, text, suggested, signature
     )
-    db.commit()
-    sub_id = cur.lastrowid
 
-    caption = f"🆕 <b>Заявка #{sub_id}</b>\n\n{text}"
-
-    album: List[InputMediaPhoto | InputMediaVideo] = []
-    for i, (media_id, media_type) in enumerate(zip(photos, media_types)):
-        if i == 0:
-            if media_type == "video":
-                album.append(InputMediaVideo(media=media_id, caption=caption))
-            else:
-                album.append(InputMediaPhoto(media=media_id, caption=caption))
-        else:
-            if media_type == "video":
-                album.append(InputMediaVideo(media=media_id))
-            else:
-                album.append(InputMediaPhoto(media=media_id))
-
-    await bot.send_media_group(MOD_GROUP_ID, album)
-    await bot.send_message(MOD_GROUP_ID, "Модерація", reply_markup=kb_mod(sub_id))
+    caption = f"🆕 <b>Заявка #{sub_id}</b>\n\n{mod_text}"
+    await sender.send(
+        bot, SendMediaGroup(chat_id=MOD_GROUP_ID, media=build_album(photos, media_types, caption)),
+        priority=PRIORITY_MOD, key=f"mod:{sub_id}"
+    )
+    await sender.send(
+        bot,
+        SendMessage(
+            chat_id=MOD_GROUP_ID,
+            text="\n".join(
+                ["Модерація"]
+                + ([summary] if summary else [])
+                + ([f"Підказані теги: {' '.join(mask_to_tags(suggested))}"] if suggested else [])
+                + warnings
+            ),
+            reply_markup=kb_mod(sub_id)
+        ),
+        priority=PRIORITY_MOD, key=f"modkb:{sub_id}"
+    )
 
     await cb.message.answer("✅ Відправлено на модерацію", reply_markup=main_menu_kb())
     await state.clear()
@@ -478,18 +3253,52 @@ async def approve(cb: CallbackQuery):
         return
 
     sub_id = int(cb.data.split(":")[1])
-    cur.execute("SELECT status FROM submissions WHERE id=?", (sub_id,))
-    row = cur.fetchone()
+    row = await db.fetchone("SELECT status, suggested_tags FROM submissions WHERE id=?", (sub_id,))
     if not row or row[0] != "pending":
         await cb.answer("Заявка вже оброблена", show_alert=True)
         return
 
     await cb.message.answer(
         f"✅ Заявка #{sub_id} схвалена.\nДодати хештеги перед публікацією?",
-        reply_markup=kb_approve_options(sub_id)
+        reply_markup=kb_approve_options(sub_id, row[1])
     )
     await cb.answer()
 
+async def confirm_publish(cb: CallbackQuery, sub_id: int, publish_at: int, done_text: str):
+    await cb.message.edit_reply_markup(reply_markup=None)
+    if publish_at <= time.time() + 5:
+        await cb.answer(done_text)
+        return
+    await cb.answer("Заплановано 🕒")
+    await cb.message.answer(
+        f"🕒 Заявка #{sub_id} вийде в канал {fmt_time(publish_at)}",
+        reply_markup=kb_reschedule(sub_id)
+    )
+
+# ---------- Reschedule ----------
+@dp.callback_query(F.data.startswith("resched:"))
+async def reschedule_cb(cb: CallbackQuery):
+    if cb.from_user.id not in MODERATOR_IDS:
+        await cb.answer("Немає доступу", show_alert=True)
+        return
+
+    _, sub_id_str, mode = cb.data.split(":")
+    sub_id = int(sub_id_str)
+    now = time.time()
+    if mode == "now":
+        at = int(now)
+    elif mode == "hour":
+        at = int(now) + 3600
+    else:  # morning — завтра о 09:00
+        tomorrow = datetime.fromtimestamp(now, PUBLISH_ZONE).date() + timedelta(days=1)
+        at = int(datetime(tomorrow.year, tomorrow.month, tomorrow.day, 9, tzinfo=PUBLISH_ZONE).timestamp())
+
+    if not await reschedule(sub_id, at):
+        await cb.answer("Вже опубліковано", show_alert=True)
+        return
+    await cb.message.edit_text(f"🕒 Заявка #{sub_id} вийде в канал {fmt_time(at)}", reply_markup=kb_reschedule(sub_id))
+    await cb.answer("Перенесено ✅")
+
 # ---------- Post without tags ----------
 @dp.callback_query(F.data.startswith("postnow:"))
 async def post_now(cb: CallbackQuery):
@@ -499,13 +3308,29 @@ async def post_now(cb: CallbackQuery):
 
     sub_id = int(cb.data.split(":")[1])
 
-    ok = await publish_submission(sub_id, with_tags=[])
-    if not ok:
+    publish_at = await publish_submission(sub_id, with_tags=[])
+    if publish_at is None:
         await cb.answer("Не вдалося. Можливо вже опубліковано/оброблено.", show_alert=True)
         return
 
-    await cb.message.edit_reply_markup(reply_markup=None)
-    await cb.answer("Опубліковано ✅")
+    await confirm_publish(cb, sub_id, publish_at, "Опубліковано ✅")
+
+# ---------- Post with suggested tags ----------
+@dp.callback_query(F.data.startswith("postsugg:"))
+async def post_suggested(cb: CallbackQuery):
+    if cb.from_user.id not in MODERATOR_IDS:
+        await cb.answer("Немає доступу", show_alert=True)
+        return
+
+    sub_id = int(cb.data.split(":")[1])
+    row = await db.fetchone("SELECT suggested_tags FROM submissions WHERE id=?", (sub_id,))
+
+    publish_at = row and await publish_submission(sub_id, with_tags=mask_to_tags(row[0]))
+    if not publish_at:
+        await cb.answer("Не вдалося. Можливо вже опубліковано/оброблено.", show_alert=True)
+        return
+
+    await confirm_publish(cb, sub_id, publish_at, "Опубліковано з тегами ✅")
 
 # ---------- Start picking tags ----------
 @dp.callback_query(F.data.startswith("addtags:"))
@@ -515,13 +3340,16 @@ async def add_tags(cb: CallbackQuery):
         return
 
     sub_id = int(cb.data.split(":")[1])
-    key = (cb.from_user.id, sub_id)
-    if key not in pending_tag_select:
-        pending_tag_select[key] = []
+    selected = await mod_sessions.get(cb.from_user.id, "tags", sub_id)
+    if selected is None:
+        # починаємо з підказаних тегів
+        row = await db.fetchone("SELECT suggested_tags FROM submissions WHERE id=?", (sub_id,))
+        selected = row[0] if row else 0
+        await mod_sessions.set(cb.from_user.id, "tags", sub_id, selected)
 
     await cb.message.answer(
         f"🏷 Обери хештеги для заявки #{sub_id} (можна декілька):",
-        reply_markup=kb_tags_picker(sub_id, pending_tag_select[key])
+        reply_markup=kb_tags_picker(sub_id, selected)
     )
     await cb.answer()
 
@@ -534,15 +3362,15 @@ async def toggle_tag(cb: CallbackQuery):
 
     _, sub_id_str, tag = cb.data.split(":", 2)
     sub_id = int(sub_id_str)
-    key = (cb.from_user.id, sub_id)
 
-    selected = pending_tag_select.get(key, [])
-    if tag in selected:
-        selected.remove(tag)
-    else:
-        selected.append(tag)
+    # старі клавіатури містять сам тег замість індексу
+    index = int(tag) if tag.isdigit() else TAG_INDEX.get(tag)
+    if index is None or index >= len(TAGS):
+        await cb.answer()
+        return
 
-    pending_tag_select[key] = selected
+    selected = (await mod_sessions.get(cb.from_user.id, "tags", sub_id) or 0) ^ (1 << index)
+    await mod_sessions.set(cb.from_user.id, "tags", sub_id, selected)
 
     await cb.message.edit_reply_markup(reply_markup=kb_tags_picker(sub_id, selected))
     await cb.answer()
@@ -555,16 +3383,14 @@ async def tags_done(cb: CallbackQuery):
         return
 
     sub_id = int(cb.data.split(":")[1])
-    key = (cb.from_user.id, sub_id)
-    selected = pending_tag_select.pop(key, [])
+    selected = mask_to_tags(await mod_sessions.pop(cb.from_user.id, "tags", sub_id) or 0)
 
-    ok = await publish_submission(sub_id, with_tags=selected)
-    if not ok:
+    publish_at = await publish_submission(sub_id, with_tags=selected)
+    if publish_at is None:
         await cb.answer("Не вдалося. Можливо вже опубліковано/оброблено.", show_alert=True)
         return
 
-    await cb.message.edit_reply_markup(reply_markup=None)
-    await cb.answer("Опубліковано з тегами ✅")
+    await confirm_publish(cb, sub_id, publish_at, "Опубліковано з тегами ✅")
 
 # ---------- Cancel selecting tags ----------
 @dp.callback_query(F.data.startswith("tags_cancel:"))
@@ -574,84 +3400,733 @@ async def tags_cancel(cb: CallbackQuery):
         return
 
     sub_id = int(cb.data.split(":")[1])
-    key = (cb.from_user.id, sub_id)
-    pending_tag_select.pop(key, None)
+    await mod_sessions.pop(cb.from_user.id, "tags", sub_id)
 
     await cb.message.edit_reply_markup(reply_markup=None)
     await cb.answer("Скасувано")
 
 # ---------- Deny ----------
 @dp.callback_query(F.data.startswith("deny:"))
-async def deny(cb: CallbackQuery):
+async def deny(cb: CallbackQuery, state: FSMContext):
     if cb.from_user.id not in MODERATOR_IDS:
         await cb.answer("Немає доступу", show_alert=True)
         return
 
     sub_id = int(cb.data.split(":")[1])
-    pending_denies[cb.from_user.id] = sub_id
+    await mod_sessions.set(cb.from_user.id, "deny", 0, sub_id)
+    # стан потрібен лише для маршрутизації: хендлер причини не перевіряється для інших повідомлень
+    await state.set_state(ModForm.deny_reason)
     await cb.message.answer("Напиши причину відмови одним повідомленням")
     await cb.answer()
 
-@dp.message(F.text)
-async def deny_reason(m: Message):
-    if m.from_user.id not in pending_denies:
+@dp.message(ModForm.deny_reason, F.text)
+async def deny_reason(m: Message, state: FSMContext):
+    await state.clear()
+    sub_id = await mod_sessions.pop(m.from_user.id, "deny")
+    if sub_id is None:
+        await m.answer("Час на відмову минув, натисни «❌ Deny» ще раз.")
+        return
+
+    row = await db.fetchone("SELECT user_id FROM submissions WHERE id=?", (sub_id,))
+    if not row:
+        return
+    user_id = row[0]
+
+    # заявку міг уже забрати інший модератор
+    denied = await db.execute("UPDATE submissions SET status='denied' WHERE id=? AND status='pending'", (sub_id,))
+    if not denied:
         return
 
-    sub_id = pending_denies.pop(m.from_user.id)
+    await sender.send(
+        bot,
+        SendMessage(
+            chat_id=user_id,
+            text=f"❌ Оголошення відхилено.\nПричина: {m.text}\n\nНатисни «🚗 Подати оголошення» або /start — подати заново.",
+            reply_markup=main_menu_kb()
+        ),
+        priority=PRIORITY_USER, key=f"denied:{sub_id}"
+    )
+    await m.answer("Причину надіслано ✅")
 
-    cur.execute("SELECT user_id, status FROM submissions WHERE id=?", (sub_id,))
-    row = cur.fetchone()
+# ---------- Seller: edit / sold / bump ----------
+async def own_listing(cb: CallbackQuery, sub_id: int) -> bool:
+    """Чи це опубліковане оголошення автора кнопки (з відомим постом у каналі)."""
+    row = await db.fetchone(
+        "SELECT 1 FROM submissions s WHERE s.id=? AND s.user_id=? AND s.status='approved' "
+        "AND EXISTS (SELECT 1 FROM channel_posts p WHERE p.sub_id=s.id)",
+        (sub_id, cb.from_user.id)
+    )
     if not row:
+        await cb.answer("Оголошення вже недоступне для змін", show_alert=True)
+        return False
+    return True
+
+@dp.callback_query(F.data.startswith("edit:"))
+async def edit_listing(cb: CallbackQuery, state: FSMContext):
+    _, sub_id_str, field = cb.data.split(":")
+    sub_id = int(sub_id_str)
+    if field not in EDITABLE_FIELDS or not await own_listing(cb, sub_id):
         return
-    user_id, status = row
-    if status != "pending":
+
+    await state.set_state(EditForm.value)
+    await state.update_data(edit_sub_id=sub_id, edit_field=field)
+    await cb.message.answer(f"Напиши нове значення: {EDITABLE_FIELDS[field]}")
+    await cb.answer()
+
+@dp.message(EditForm.value, F.text)
+async def edit_value(m: Message, state: FSMContext):
+    data = await state.get_data()
+    sub_id, field = data.get("edit_sub_id"), data.get("edit_field")
+    if field not in EDITABLE_FIELDS:
+        await state.clear()
         return
 
-    cur.execute("UPDATE submissions SET status='denied' WHERE id=?", (sub_id,))
-    db.commit()
+    # та сама перевірка, що й в анкеті; при помилці чекаємо нове значення
+    values = FIELD_BY_NAME[field].parse(m.text)
+    if values is None:
+        await m.answer(FIELD_BY_NAME[field].error)
+        return
+    await state.clear()
+    value = values[field]
 
-    await bot.send_message(
-        user_id,
-        f"❌ Оголошення відхилено.\nПричина: {m.text}\n\nНатисни «🚗 Подати оголошення» або /start — подати заново.",
-        reply_markup=main_menu_kb()
+    def propose(conn: sqlite3.Connection) -> Optional[Tuple[int, str]]:
+        row = conn.execute(
+            "SELECT json_extract(answers, '$.' || ?) FROM submissions WHERE id=? AND user_id=? AND status='approved'",
+            (field, sub_id, m.from_user.id)
+        ).fetchone()
+        if not row:
+            return None
+        # нова правка того ж поля замінює ще не розглянуту
+        conn.execute(
+            "UPDATE listing_edits SET status='replaced' WHERE sub_id=? AND field=? AND status='pending'", (sub_id, field)
+        )
+        edit_id = conn.execute(
+            "INSERT INTO listing_edits (sub_id, field, value) VALUES (?, ?, ?)", (sub_id, field, value)
+        ).lastrowid
+        return edit_id, row[0] or ""
+
+    proposed = await db.transaction(propose)
+    if proposed is None:
+        await m.answer("Оголошення вже недоступне для змін", reply_markup=main_menu_kb())
+        return
+    edit_id, old_value = proposed
+
+    await sender.send(
+        bot,
+        SendMessage(
+            chat_id=MOD_GROUP_ID,
+            text=f"✏️ Зміна в оголошенні #{sub_id} ({EDITABLE_FIELDS[field]})\n\n"
+                 f"Було: {esc(old_value)}\nСтало: {esc(value)}",
+            reply_markup=kb_edit_mod(edit_id)
+        ),
+        priority=PRIORITY_MOD
     )
-    await m.answer("Причину надіслано ✅")
+    await m.answer("Зміну надіслано на модерацію ✅", reply_markup=main_menu_kb())
+
+@dp.callback_query(F.data.startswith("editok:") | F.data.startswith("editno:"))
+async def review_edit(cb: CallbackQuery):
+    if cb.from_user.id not in MODERATOR_IDS:
+        await cb.answer("Немає доступу", show_alert=True)
+        return
+
+    action, edit_id_str = cb.data.split(":")
+    edit_id = int(edit_id_str)
+    approve = action == "editok"
+
+    def review(conn: sqlite3.Connection) -> Optional[Tuple[int, int]]:
+        row = conn.execute(
+            "UPDATE listing_edits SET status=? WHERE id=? AND status='pending' RETURNING sub_id, field, value",
+            ("approved" if approve else "denied", edit_id)
+        ).fetchone()
+        if not row:
+            return None
+        sub_id, field, value = row
+        user_id, = conn.execute("SELECT user_id FROM submissions WHERE id=?", (sub_id,)).fetchone()
+        if approve:
+            updated = conn.execute(
+                "UPDATE submissions SET answers=json_set(answers, '$.' || ?, ?) WHERE id=? AND status='approved'",
+                (field, value, sub_id)
+            ).rowcount
+            if updated:
+                answers, = conn.execute("SELECT answers FROM submissions WHERE id=?", (sub_id,)).fetchone()
+                _save_typed(conn, sub_id, json.loads(answers))
+                index_listing(conn, sub_id)
+                conn.execute("INSERT INTO outbox (sub_id, kind, payload) VALUES (?, 'edit', '{}')", (sub_id,))
+        return sub_id, user_id
+
+    reviewed = await db.transaction(review)
+    await cb.message.edit_reply_markup(reply_markup=None)
+    if reviewed is None:
+        await cb.answer("Вже оброблено")
+        return
+    sub_id, user_id = reviewed
+    if approve:
+        outbox.wake()
+
+    await sender.send(
+        bot,
+        SendMessage(
+            chat_id=user_id,
+            text=f"✅ Зміни в оголошенні #{sub_id} опубліковано" if approve
+            else f"❌ Зміни в оголошенні #{sub_id} відхилено",
+            reply_markup=main_menu_kb()
+        ),
+        priority=PRIORITY_USER, key=f"edit:{edit_id}"
+    )
+    await cb.answer("Схвалено ✅" if approve else "Відхилено")
+
+@dp.callback_query(F.data.startswith("sold:"))
+async def mark_sold(cb: CallbackQuery):
+    sub_id = int(cb.data.split(":")[1])
+    if not await own_listing(cb, sub_id):
+        return
+
+    def sell(conn: sqlite3.Connection) -> bool:
+        sold = conn.execute(
+            "UPDATE submissions SET status='sold' WHERE id=? AND user_id=? AND status='approved'",
+            (sub_id, cb.from_user.id)
+        ).rowcount
+        if sold:
+            conn.execute("UPDATE listing_edits SET status='replaced' WHERE sub_id=? AND status='pending'", (sub_id,))
+            conn.execute("INSERT INTO outbox (sub_id, kind, payload) VALUES (?, 'edit', '{}')", (sub_id,))
+        return bool(sold)
+
+    if not await db.transaction(sell):
+        await cb.answer("Оголошення вже недоступне для змін", show_alert=True)
+        return
+    outbox.wake()
+    await cb.message.edit_reply_markup(reply_markup=None)
+    await cb.answer("Позначено як продане ✅")
+
+@dp.callback_query(F.data.startswith("bump:"))
+async def bump_listing(cb: CallbackQuery):
+    sub_id = int(cb.data.split(":")[1])
+    if not await own_listing(cb, sub_id):
+        return
+    now = int(outbox.clock())
+
+    def claim(conn: sqlite3.Connection) -> Optional[int]:
+        # не частіше за BUMP_INTERVAL: час перевіряється і ставиться одним UPDATE
+        bumped = conn.execute(
+            "UPDATE submissions SET bumped_at=? WHERE id=? AND status='approved' "
+            "AND COALESCE(bumped_at, published_at, 0) <= ?",
+            (now, sub_id, now - BUMP_INTERVAL)
+        ).rowcount
+        if not bumped:
+            return None
+        bump_at = publish_time(last_scheduled(conn), now)
+        conn.execute(
+            "INSERT INTO outbox (sub_id, kind, payload, next_attempt_at) VALUES (?, 'bump', '{}', ?)", (sub_id, bump_at)
+        )
+        return bump_at
+
+    bump_at = await db.transaction(claim)
+    if bump_at is None:
+        await cb.answer(f"Піднімати можна раз на {BUMP_INTERVAL // 3600} год", show_alert=True)
+        return
+    outbox.wake()
+    await cb.answer("Оголошення буде піднято " + ("зараз" if bump_at <= now + 5 else fmt_time(bump_at)))
 
 # ---------- Run ----------
 async def main():
+    setup()
     await dp.start_polling(bot)
 
 # ---------- For Render Web Service ----------
-from aiohttp import web
-import os
+
+WEBHOOK_PATH = "/webhook"
+
 
 async def health_check(request):
-    return web.Response(text="Bot is running!")
+    return web.Response(text="Bot is running!" if request.app["ready"].is_set() else "Starting…")
 
-async def start_bot_and_server():
-    # Запускаємо бота в окремій задачі
-    bot_task = asyncio.create_task(dp.start_polling(bot))
-    
-    # Запускаємо HTTP сервер для Render
+
+def authorized(request: web.Request) -> bool:
+    auth = request.headers.get("Authorization", "")
+    return bool(ADMIN_TOKEN) and secrets.compare_digest(auth, f"Bearer {ADMIN_TOKEN}")
+
+async def metrics(request: web.Request) -> web.Response:
+    """GET /metrics — метрики у форматі Prometheus."""
+    lines: List[str] = []
+    for metric in (HANDLER_SECONDS, HANDLER_ERRORS, DB_SECONDS, API_SECONDS, API_ERRORS):
+        lines += metric.render()
+
+    counts = await status_counts()
+    lines += gauge("bazar_submissions", "Заявки за статусом", {(("status", k),): v for k, v in counts.items()})
+
+    stored, = await db.fetchone("SELECT COUNT(*) FROM fsm_state")
+    lines += gauge("bazar_fsm_states", "Стани FSM", {(("where", "memory"),): fsm_storage.size(), (("where", "db"),): stored})
+
+    sessions = await mod_sessions.sizes()
+    lines += gauge("bazar_mod_sessions", "Незавершені дії модераторів (відмови, теги, пакетна модерація)",
+                   {(("kind", kind),): sessions.get(kind, 0) for kind in sorted({*ModSessions.KINDS, *sessions})})
+
+    outbox_pending, = await db.fetchone("SELECT COUNT(*) FROM outbox WHERE status='pending'")
+    lines += gauge("bazar_outbox_pending", "Записи outbox, що чекають відправки", {(): outbox_pending})
+
+    send = sender.metrics()
+    lines += gauge("bazar_send_queue_depth", "Глибина черги вихідних повідомлень", {(): send["queue_depth"]})
+    lines += gauge("bazar_send_latency_seconds", "Затримка відправки (останні 1000)",
+                   {(("quantile", "0.5"),): send["latency_p50"], (("quantile", "0.99"),): send["latency_p99"]})
+    lines += gauge("bazar_send_total", "Відправлені повідомлення",
+                   {(("result", r),): send[r] for r in ("sent", "failed", "retried")})
+
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+
+class SamplingProfiler:
+    """Семплюючий профайлер потоку event loop'а: раз на interval знімає стек
+    через sys._current_frames() і рахує однакові стеки. Працює лише на запит."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._busy = threading.Lock()
+
+    def sample(self, thread_id: int, seconds: float) -> Dict[str, int]:
+        stacks: Dict[str, int] = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(names))
+            stacks[key] = stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+        return stacks
+
+
+profiler = SamplingProfiler()
+
+async def debug_profile(request: web.Request) -> web.Response:
+    """GET /debug/profile?seconds=N — стеки у форматі collapsed (для flamegraph)."""
+    if not authorized(request):
+        return web.Response(status=401)
+    if not profiler._busy.acquire(blocking=False):
+        return web.Response(status=409, text="profiler is already running")
+    try:
+        seconds = min(float(request.query.get("seconds", 10)), 60)
+        stacks = await asyncio.get_running_loop().run_in_executor(
+            None, profiler.sample, threading.get_ident(), seconds
+        )
+    finally:
+        profiler._busy.release()
+    top = sorted(stacks.items(), key=lambda x: -x[1])
+    return web.Response(text="\n".join(f"{stack} {count}" for stack, count in top) + "\n")
+
+
+async def api_queue(request: web.Request) -> web.Response:
+    """GET /api/queue?after=<created_at:id>&limit=N — заявки на модерації + лічильники."""
+    if not authorized(request):
+        return web.json_response({"error": "unauthorized"}, status=401)
+
+    try:
+        after = parse_cursor(request.query.get("after"))
+        limit = min(max(int(request.query.get("limit", 50)), 1), 500)
+    except ValueError:
+        return web.json_response({"error": "bad cursor or limit"}, status=400)
+
+    rows = await pending_page(after, limit)
+    items = [
+        {"id": sub_id, "created_at": created_at, "user_id": user_id, "username": username, "car_title": car_title}
+        for sub_id, created_at, user_id, username, car_title in rows
+    ]
+    return web.json_response({
+        "counts": await status_counts(),
+        "items": items,
+        "next": f"{rows[-1][1]}:{rows[-1][0]}" if len(rows) == limit else None,
+    })
+
+
+class UpdateOrder:
+    """Порядок оновлень кожного користувача при паралельній обробці.
+
+    Оновлення різних користувачів обробляються паралельно; фото одного
+    альбому — теж, інакше AlbumMiddleware не збере їх разом. Решта оновлень
+    користувача чекає, доки завершаться попередні.
+    """
+
+    def __init__(self):
+        # ключ користувача -> (media_group_id, чого чекав альбом, оновлення в обробці)
+        self._tails: Dict[Any, Tuple[Optional[str], List[asyncio.Future], List[asyncio.Future]]] = {}
+
+    def after(self, key: Any, update: Dict[str, Any], done: asyncio.Future) -> List[asyncio.Future]:
+        """Реєструє оновлення (done завершується після його обробки) і повертає, на що чекати перед нею."""
+        group = (update.get("message") or {}).get("media_group_id")
+        last_group, base, tail = self._tails.get(key, (None, [], []))
+        if group and group == last_group:
+            previous = base
+        else:
+            previous, base, tail = tail, tail, []
+        tail.append(done)
+        self._tails[key] = (group, base, tail)
+
+        def finished(_: asyncio.Future):
+            state = self._tails.get(key)
+            if state and all(t.done() for t in state[2]):
+                del self._tails[key]
+        done.add_done_callback(finished)
+        return previous
+
+
+class WebhookHandler:
+    """Приймає оновлення від Telegram і віддає їх обмеженому пулу воркерів.
+
+    Якщо черга заповнена — відповідаємо 503, і Telegram сам повторить доставку
+    пізніше (природний backpressure замість необмеженої кількості задач).
+    Оновлення одного користувача обробляються по черзі (UpdateOrder): інакше
+    два воркери могли б одночасно обробити сусідні відповіді анкети.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Optional[Bot], secret: str, workers: int, queue_size: int):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.workers = workers
+        self.queue: asyncio.Queue[Tuple[Update, List[asyncio.Future], asyncio.Future]] = asyncio.Queue(maxsize=queue_size)
+        self._order = UpdateOrder()
+        self._tasks: List[asyncio.Task] = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(token, self.secret):
+            return web.Response(status=401)
+
+        if self.queue.full():
+            return web.Response(status=503)  # ще до розбору тіла: відмова має бути дешевою
+        raw = await request.json()
+        update = Update.model_validate(raw, context={"bot": self.bot})
+        done = asyncio.get_running_loop().create_future()
+        previous = self._order.after(update_user(raw)[0], raw, done)
+        self.queue.put_nowait((update, previous, done))
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update, previous, done = await self.queue.get()
+            try:
+                # попередні оновлення користувача вже взяті воркерами раніше — черга FIFO
+                if previous:
+                    await asyncio.wait(previous)
+                await self.dp.feed_update(self.bot, update)
+            except Exception:
+                logging.exception("Update %s failed", update.update_id)
+            finally:
+                done.set_result(None)
+                self.queue.task_done()
+
+    async def start(self, app: web.Application):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, app: web.Application):
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+
+
+# ---------- Sharding ----------
+# З SHARDS > 1 головний процес лише отримує оновлення (webhook або polling)
+# і роздає їх процесам-воркерам через Unix-сокети. Користувач завжди
+# потрапляє в той самий шард (його FSM і альбоми живуть у пам'яті шарду),
+# модераторська група — завжди в шард 0, де й працюють фонові задачі.
+# Запис у БД між процесами серіалізує сам SQLite (WAL + busy_timeout).
+
+def update_user(update: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+    """(user_id, chat_id) з сирого оновлення."""
+    for kind, event in update.items():
+        if isinstance(event, dict):
+            chat = event.get("chat") or (event.get("message") or {}).get("chat") or {}
+            return (event.get("from") or {}).get("id"), chat.get("id")
+    return None, None
+
+def shard_of(update: Dict[str, Any], shards: int) -> int:
+    user_id, chat_id = update_user(update)
+    if chat_id is not None and str(chat_id) == str(MOD_GROUP_ID):
+        return 0
+    # crc32, а не hash(): однаковий результат у всіх процесах
+    return zlib.crc32(str(user_id or 0).encode()) % shards
+
+
+class ShardRouter:
+    """Пересилає оновлення у шарди, зберігаючи порядок оновлень кожного користувача
+    (UpdateOrder). Якщо в обробці вже queue_size оновлень — is_full() (webhook
+    відповідає 503).
+    """
+
+    def __init__(self, sockets: List[str], queue_size: int):
+        self.sockets = sockets
+        self.queue_size = queue_size
+        self._sessions: List[ClientSession] = []
+        self._order = UpdateOrder()
+        self._inflight = 0
+
+    async def start(self):
+        self._sessions = [ClientSession(connector=UnixConnector(path=path)) for path in self.sockets]
+
+    async def stop(self):
+        for session in self._sessions:
+            await session.close()
+
+    def is_full(self) -> bool:
+        return self._inflight >= self.queue_size
+
+    def forward(self, update: Dict[str, Any]) -> asyncio.Task:
+        shard = shard_of(update, len(self.sockets))
+        done = asyncio.get_running_loop().create_future()
+        previous = self._order.after((shard, update_user(update)[0]), update, done)
+        task = asyncio.create_task(self._send(shard, update, previous))
+        self._inflight += 1
+
+        def finished(_: asyncio.Task):
+            self._inflight -= 1
+            done.set_result(None)
+        task.add_done_callback(finished)
+        return task
+
+    async def _send(self, shard: int, update: Dict[str, Any], previous: List[asyncio.Future]):
+        if previous:
+            await asyncio.wait(previous)
+        for attempt in range(50):
+            try:
+                async with self._sessions[shard].post("http://shard/update", json=update) as resp:
+                    if resp.status != 200:
+                        logging.error("Shard %s failed update %s: %s", shard, update.get("update_id"), resp.status)
+                    return
+            except ClientError:
+                # шард ще стартує або перезапускається
+                await asyncio.sleep(0.1 * min(attempt + 1, 10))
+        logging.error("Shard %s unreachable, update %s dropped", shard, update.get("update_id"))
+
+    async def proxy(self, request: web.Request) -> web.Response:
+        """Службові GET-ендпоінти шардів: /metrics?shard=N (за замовчуванням шард 0)."""
+        try:
+            shard = int(request.query.get("shard", 0)) % len(self.sockets)
+        except ValueError:
+            return web.Response(status=400)
+        headers = {k: v for k, v in request.headers.items() if k == "Authorization"}
+        async with self._sessions[shard].get(f"http://shard{request.path_qs}", headers=headers) as resp:
+            return web.Response(body=await resp.read(), status=resp.status, content_type=resp.content_type)
+
+
+async def feed_shard_update(request: web.Request) -> web.Response:
+    try:
+        await dp.feed_raw_update(bot, await request.json())
+    except Exception:
+        logging.exception("Update failed")
+        return web.Response(status=500)
+    return web.Response()
+
+def run_shard(shard: int, shards: int, socket_path: str):
+    """Точка входу процесу-воркера."""
+    global SHARD
+    SHARD = shard
+    logging.basicConfig(level=logging.INFO, format=f"[shard {shard}] %(levelname)s %(name)s: %(message)s")
+    setup()
+    sender.set_share(shards)
+    if shard == 0:
+        # правки/підняття з інших шардів не можуть розбудити outbox — частіше перевіряємо чергу
+        outbox.poll_interval = 2.0
+    asyncio.run(serve_shard(socket_path))
+
+async def serve_shard(socket_path: str):
     app = web.Application()
+    app.router.add_post("/update", feed_shard_update)
+    app.router.add_get("/metrics", metrics)
+    if ADMIN_TOKEN:
+        app.router.add_get('/api/queue', api_queue)
+        app.router.add_get('/debug/profile', debug_profile)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.UnixSite(runner, socket_path).start()
+
+    await dp.emit_startup(bot=bot)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+def shard_sockets(shards: int) -> List[str]:
+    workdir = tempfile.mkdtemp(prefix="bazar-")
+    return [os.path.join(workdir, f"shard{i}.sock") for i in range(shards)]
+
+def start_shards(sockets: List[str], target: Callable = run_shard) -> List[multiprocessing.Process]:
+    """Запускає по процесу-воркеру на кожен сокет."""
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=target, args=(i, len(sockets), path), daemon=True) for i, path in enumerate(sockets)]
+    for proc in procs:
+        proc.start()
+    return procs
+
+async def watch_shards(procs: List[multiprocessing.Process], sockets: List[str], target: Callable = run_shard):
+    # перезапускаємо воркер, що впав; оновлення для нього ShardRouter притримає
+    ctx = multiprocessing.get_context("spawn")
+    while True:
+        await asyncio.sleep(5)
+        for i, proc in enumerate(procs):
+            if not proc.is_alive():
+                logging.error("Shard %s exited with %s, restarting", i, proc.exitcode)
+                procs[i] = ctx.Process(target=target, args=(i, len(procs), sockets[i]), daemon=True)
+                procs[i].start()
+
+async def poll_to_shards(router: ShardRouter):
+    await bot.delete_webhook()
+    offset = None
+    allowed = dp.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed)
+        except (TelegramNetworkError, TelegramServerError):
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            while router.is_full():
+                await asyncio.sleep(0.05)
+            router.forward(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+async def supervise(shards: int):
+    sockets = shard_sockets(shards)
+    router = ShardRouter(sockets, queue_size=WEBHOOK_QUEUE_SIZE)
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+    async def webhook(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(token, secret):
+            return web.Response(status=401)
+        if router.is_full():
+            return web.Response(status=503)
+        router.forward(await request.json())
+        return web.Response()
+
+    app = runner = None
+    if os.environ.get('PORT'):
+        app = create_app(webhook if WEBHOOK_URL else None, router)
+        runner = await start_http(app)
+
+    # міграції — тут, один раз, до старту воркерів
+    await asyncio.to_thread(setup)
+    procs = start_shards(sockets)
+    await router.start()
+    watcher = asyncio.create_task(watch_shards(procs, sockets))
+    if app:
+        app["ready"].set()
+    print(f"{shards} shards started")
+
+    try:
+        if WEBHOOK_URL and runner:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=secret,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            print("Webhook mode")
+            await asyncio.Event().wait()
+        else:
+            await poll_to_shards(router)
+    finally:
+        watcher.cancel()
+        if runner:
+            await runner.cleanup()
+        await router.stop()
+        await bot.session.close()
+        for proc in procs:
+            proc.terminate()
+            proc.join(5)
+
+
+# ---------- Startup ----------
+@web.middleware
+async def until_ready(request: web.Request, handler):
+    # поки бот і БД піднімаються, відповідає лише health-check (webhook Telegram повторить)
+    if not request.app["ready"].is_set() and request.path not in ("/", "/health"):
+        return web.Response(status=503, text="Starting")
+    return await handler(request)
+
+def create_app(webhook: Optional[Callable] = None, router: Optional[ShardRouter] = None) -> web.Application:
+    """HTTP-застосунок сервісу. З router службові ендпоінти віддають шарди."""
+    app = web.Application(middlewares=[until_ready])
+    app["ready"] = asyncio.Event()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
-    
+    app.router.add_get('/metrics', router.proxy if router else metrics)
+    if ADMIN_TOKEN:
+        app.router.add_get('/api/queue', router.proxy if router else api_queue)
+        app.router.add_get('/debug/profile', router.proxy if router else debug_profile)
+    if webhook:
+        app.router.add_post(WEBHOOK_PATH, webhook)
+    return app
+
+async def start_http(app: web.Application) -> web.AppRunner:
     runner = web.AppRunner(app)
     await runner.setup()
-    
     port = int(os.environ.get('PORT', 10000))
-    site = web.TCPSite(runner, '0.0.0.0', port)
-    await site.start()
-    
+    await web.TCPSite(runner, '0.0.0.0', port).start()
     print(f"HTTP server started on port {port}")
-    
-    # Чекаємо завершення бота
-    await bot_task
+    return runner
+
+async def start_bot_and_server():
+    # HTTP сервер для Render піднімається першим: health-check проходить,
+    # поки відкривається БД і ще до будь-якого запиту до Telegram
+    webhook = None
+    if WEBHOOK_URL:
+        # Webhook: оновлення приходять на той самий aiohttp сервер
+        webhook = WebhookHandler(
+            dp, None,
+            secret=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            workers=WEBHOOK_WORKERS,
+            queue_size=WEBHOOK_QUEUE_SIZE,
+        )
+    app = create_app(webhook.handle if webhook else None)
+    if webhook:
+        app.on_startup.append(webhook.start)
+        app.on_shutdown.append(webhook.stop)
+    runner = await start_http(app)
+
+    # міграції можуть тривати — не блокуємо event loop, щоб health-check відповідав
+    await asyncio.to_thread(setup)
+    app["ready"].set()
+
+    if webhook:
+        webhook.bot = bot
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=webhook.secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        print("Webhook mode")
+        await dp.emit_startup(bot=bot)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await dp.emit_shutdown(bot=bot)
+    else:
+        # Polling: знімаємо webhook, якщо він лишився з попереднього деплою
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["retag"]:
+        # python bazar.py retag — перерахувати підказані теги й розібрані ціну/пробіг для всієї історії
+        open_db()
+        print(f"Retagged {asyncio.run(retag_all())} submissions")
+        sys.exit()
+    if sys.argv[1:] == ["archive"]:
+        # python bazar.py archive — заархівувати старі заявки зараз (те саме робить бот раз на добу)
+        open_db()
+        report = asyncio.run(archiver.run_once())
+        print(f"Archived {report['archived']} submissions, reclaimed {report['reclaimed_bytes']} bytes")
+        sys.exit()
+    if SHARDS > 1:
+        # кілька процесів-воркерів за одним фронтом (webhook або polling)
+        asyncio.run(supervise(SHARDS))
     # Якщо є PORT (Render Web Service) - запускаємо з HTTP сервером
-    if os.environ.get('PORT'):
+    elif os.environ.get('PORT'):
         asyncio.run(start_bot_and_server())
     else:
         # Локально - просто бот
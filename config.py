@@ -4,9 +4,38 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")  # має бути формату -100xxxx або @channel_name
 MOD_GROUP_ID = os.getenv("MOD_GROUP_ID")  # має бути формату -100xxxx
 
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN не встановлено!")
-if not CHANNEL_ID:
-    raise ValueError("CHANNEL_ID не встановлено!")
-if not MOD_GROUP_ID:
-    raise ValueError("MOD_GROUP_ID не встановлено!")
+
+def require():
+    """Перевіряє обов'язкові змінні. Викликається при запуску бота, а не при імпорті,
+    щоб HTTP health-check міг піднятися раніше."""
+    if not BOT_TOKEN:
+        raise ValueError("BOT_TOKEN не встановлено!")
+    if not CHANNEL_ID:
+        raise ValueError("CHANNEL_ID не встановлено!")
+    if not MOD_GROUP_ID:
+        raise ValueError("MOD_GROUP_ID не встановлено!")
+
+DB_PATH = os.getenv("DB_PATH", "autobazar.db")
+
+# Webhook режим (на Render). Без WEBHOOK_URL бот працює через polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публічна адреса сервісу, напр. https://xxx.onrender.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # якщо не задано — генерується при старті
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+
+# Токен для службових HTTP-ендпоінтів (/api/...). Без нього вони вимкнені.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Розклад публікацій у канал
+PUBLISH_INTERVAL = int(os.getenv("PUBLISH_INTERVAL", "120"))  # мінімум секунд між постами
+PUBLISH_SLOTS = os.getenv("PUBLISH_SLOTS", "")  # напр. "09:00,12:00,15:00,18:00,21:00"; порожньо — без слотів
+PUBLISH_TZ = os.getenv("PUBLISH_TZ", "Europe/Kyiv")
+BUMP_INTERVAL = int(os.getenv("BUMP_INTERVAL", str(3 * 24 * 3600)))  # як часто продавець може підняти оголошення
+
+# Архівація: оброблені заявки, старші за ARCHIVE_AFTER секунд, переносяться в стиснуті
+# помісячні файли в ARCHIVE_DIR (за замовчуванням — тека archive поруч із БД); 0 — вимкнено
+ARCHIVE_AFTER = int(os.getenv("ARCHIVE_AFTER", str(180 * 24 * 3600)))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "archive")
+
+# Кількість процесів-воркерів; оновлення розподіляються між ними за user_id
+SHARDS = int(os.getenv("SHARDS", "1"))
@@ -0,0 +1,1317 @@
+"""Офлайн навантажувальний тест бота.
+
+Ганяє синтетичні апдейти через dp.feed_update проти локальної заглушки
+Telegram Bot API (aiohttp-сервер), тож ні токен, ні мережа не потрібні.
+
+Сценарії:
+  startup     — холодний старт окремого процесу: імпорт, setup(), перший апдейт
+  form        — користувачі проходять усю анкету й надсилають на модерацію
+  submitters  — --submitters (50) користувачів одночасно: p99 обробки апдейту і затримка event loop
+                (запити до SQLite не мають його блокувати)
+  album       — користувачі кидають альбом у крок «додаткові фото» або одразу на кроці головного
+                фото (рівно до ліміту 10 медіа), потім ще один — у чернетці лишається 10 медіа, а про ліміт повідомляється один раз
+  moderation  — модератори схвалюють (з тегами) і відхиляють заявки; потім кілька модераторів
+                одночасно тиснуть tags_done/postnow на ту саму заявку, і процес «падає» між
+                відправкою поста і записом у БД — кожна заявка має вийти в канал один раз
+  webhook     — той самий потік анкет, але POST'ами на /webhook (секрет, обмежена черга,
+                503 і повтор, як у Telegram); --replay FILE — записані апдейти (JSONL)
+  schedule    — розклад публікацій на віртуальному годиннику (OutboxDispatcher(clock=...)):
+                після простою прострочені пости йдуть по одному з PUBLISH_INTERVAL між ними,
+                у режимі PUBLISH_SLOTS — лише в слоти, і розклад переживає рестарт
+  render      — рендер підписів на корпусі синтетичних оголошень (мкс на пост, ліміт 1024)
+                і підпис у кеші submissions.caption для довгого опису
+  tags        — таблиця прикладів для parse_amount/parse_mileage/suggest_tags (формати «$8 500»,
+                «8.5k», «8500 у.о.», роздільники «,» і «.», «млн») і швидкість retag_all
+                на --retag-rows рядках; tag_toggle — клацання тегів модераторами (toggle_tag через
+                dp.feed_update, p50/p99) і побудова клавіатури kb_tags_picker у мкс
+  search      — --search-listings опублікованих оголошень (за замовчуванням 500 тис.): перша й
+                наступні --search-pages сторінок для слів, тегів і фільтрів; не входить у набір
+                за замовчуванням
+  duplicates  — duplicate_warnings на --dup-rows заявках, де кожна десята — копія того самого
+                оголошення з тим самим фото (тисячі кандидатів у LSH-кошиках) і для унікальної заявки
+  queue       — сторінки /queue на початку, посередині й у кінці черги з --queue-rows заявок:
+                keyset-пагінація по idx_submissions_status_created не залежить від глибини
+  migrate     — migrate() на БД старого формату (до v1) з --migrate-rows заявками: час кожної
+                міграції і запити бота після неї (черга модерації, ліміт на день, медіа, пошук)
+                — усі мають іти по індексах; не входить у набір за замовчуванням
+  subscriptions — --subscriptions збережених пошуків × --posts нових постів: час підбору
+                підписників на пост (інвертований індекс проти повного перебору) і
+                розсилка через outbox; не входить у набір за замовчуванням
+
+Запуск:
+  python loadtest.py --users 1000
+  python loadtest.py --users 1000 --save-baseline    # зберегти як базову лінію
+  python loadtest.py --users 1000 --compare          # порівняти з базовою лінією
+  python loadtest.py --users 1000 --shards 4         # те саме через 4 процеси-воркери (SHARDS)
+  python loadtest.py --scenarios subscriptions --subscriptions 100000 --posts 1000
+  python loadtest.py --scenarios search --search-listings 500000
+  python loadtest.py --scenarios migrate --migrate-rows 1000000
+
+Окремо міряється старт: час імпорту bazar, setup() (БД + бот) і час від запуску
+процесу до першого обробленого апдейту.
+
+Код виходу 1, якщо p99, пропускна здатність або час старту погіршились більше ніж на --tolerance.
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from aiohttp import ClientSession, web
+
+MOD_GROUP_ID = -1002
+CHANNEL_ID = -1001
+MODERATOR_BASE = 9_000_000
+
+
+# ---------- Fake Bot API ----------
+class FakeTelegram:
+    """Відповідає на будь-який метод Bot API правдоподібним результатом."""
+
+    def __init__(self):
+        self.calls: Dict[str, int] = {}
+        self._message_ids = itertools.count(1)
+        self.texts: Counter = Counter()  # (chat_id, текст) надісланих повідомлень
+        self.channel_posts: List[str] = []  # file_id першого медіа кожного альбому в каналі
+        self.on_channel_post = None  # викликається після кожного поста в канал
+
+    def _message(self, chat_id: Any) -> Dict[str, Any]:
+        chat_id = int(chat_id)
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = await request.post()
+
+        lower = method.lower()
+        if lower == "getme":
+            result: Any = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        elif lower == "sendmediagroup":
+            media = json.loads(params["media"])
+            result = [self._message(params["chat_id"]) for _ in media]
+            if int(params["chat_id"]) == CHANNEL_ID:
+                self.channel_posts.append(media[0]["media"])
+                if self.on_channel_post:
+                    self.on_channel_post()
+        elif lower == "sendmessage":
+            result = self._message(params["chat_id"])
+            self.texts[result["chat"]["id"], params["text"]] += 1
+        elif lower in ("editmessagetext", "editmessagecaption", "sendphoto", "copymessage"):
+            result = self._message(params.get("chat_id", 1))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+
+# ---------- Update factory ----------
+class Updates:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"user{user_id}"}
+
+    def _chat(self, chat_id: int) -> Dict[str, Any]:
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+
+    def message(self, user_id: int, chat_id: int | None = None, **content) -> Dict[str, Any]:
+        update_id = next(self._ids)
+        return {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": self._chat(chat_id or user_id), "from": self._user(user_id), **content,
+        }}
+
+    def text(self, user_id: int, text: str, chat_id: int | None = None) -> Dict[str, Any]:
+        return self.message(user_id, chat_id, text=text)
+
+    def photo(self, user_id: int, media_group_id: str | None = None) -> Dict[str, Any]:
+        n = next(self._ids)
+        photo = [{"file_id": f"file{n}", "file_unique_id": f"uniq{n}", "width": 1280, "height": 960}]
+        content: Dict[str, Any] = {"photo": photo}
+        if media_group_id:
+            content["media_group_id"] = media_group_id
+        return self.message(user_id, **content)
+
+    def callback(self, user_id: int, data: str, chat_id: int | None = None) -> Dict[str, Any]:
+        update_id = next(self._ids)
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": self._user(user_id), "chat_instance": "1", "data": data,
+            "message": {"message_id": update_id, "date": int(time.time()), "chat": self._chat(chat_id or user_id)},
+        }}
+
+
+ANSWERS = [
+    "Audi A4 2013", "2.0 TDI дизель", "автомат", "173 тис", "Київ", "$9 800", "+380501234567",
+    "Стан гарний, один власник, сервісна історія. Нова гума, без ДТП.",
+]
+
+
+# ---------- Runner ----------
+class LoadTest:
+    def __init__(self, bazar, concurrency: int, router=None):
+        self.bazar = bazar
+        self.router = router
+        self.updates = Updates()
+        self.sem = asyncio.Semaphore(concurrency)
+        self.latencies: List[float] = []
+        self.webhook = None  # (ClientSession, url, secret) — див. webhook_replay
+        self.rejected = 0
+
+    async def post(self, raw: Dict[str, Any]):
+        """Як Telegram: POST із секретом; на 503 повторюємо з дедалі більшою паузою."""
+        session, url, secret = self.webhook
+        delay = 0.05
+        while True:
+            start = time.perf_counter()
+            async with session.post(url, json=raw, headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as resp:
+                if resp.status == 200:
+                    self.latencies.append(time.perf_counter() - start)
+                    return
+                if resp.status != 503:
+                    raise RuntimeError(f"webhook answered {resp.status}")
+            self.rejected += 1
+            # без наростання сотні клієнтів, що стукають кожні 50 мс, з'їдають процесор самим лише 503
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
+    async def replay(self, stream: List[Dict[str, Any]]):
+        async with self.sem:
+            for raw in stream:
+                await self.feed(raw)
+
+    async def feed(self, raw: Dict[str, Any]):
+        if self.webhook:
+            await self.post(raw)
+            return
+        if self.router:
+            # через Unix-сокет у процес-шард; відповідь приходить після обробки
+            start = time.perf_counter()
+            await self.router.forward(raw)
+            self.latencies.append(time.perf_counter() - start)
+            return
+        from aiogram.types import Update
+        update = Update.model_validate(raw, context={"bot": self.bazar.bot})
+        start = time.perf_counter()
+        await self.bazar.dp.feed_update(self.bazar.bot, update)
+        self.latencies.append(time.perf_counter() - start)
+
+    def form_stream(self, user_id: int, answers: List[str] = ANSWERS) -> List[Dict[str, Any]]:
+        """Апдейти одного користувача, що проходить анкету до відправки на модерацію."""
+        return [
+            self.updates.text(user_id, "/start"),
+            *(self.updates.text(user_id, answer) for answer in answers),
+            *(self.updates.photo(user_id) for _ in range(5)),  # головне, ззаду, 3 додаткові
+            self.updates.callback(user_id, "photos_done"),
+            self.updates.callback(user_id, "send_mod"),
+        ]
+
+    async def user_flow(self, user_id: int):
+        await self.replay(self.form_stream(user_id))
+
+    async def album_flow(self, user_id: int):
+        async with self.sem:
+            await self.feed(self.updates.text(user_id, "/start"))
+            for answer in ANSWERS:
+                await self.feed(self.updates.text(user_id, answer))
+            group = f"album{user_id}"
+            if user_id % 2:
+                await self.feed(self.updates.photo(user_id))
+                await self.feed(self.updates.photo(user_id))
+                await asyncio.gather(*(self.feed(self.updates.photo(user_id, group)) for _ in range(8)))
+            else:
+                # увесь альбом одразу на кроці головного фото: головне, ззаду і 8 додаткових
+                await asyncio.gather(*(self.feed(self.updates.photo(user_id, group)) for _ in range(10)))
+            # ліміт вибрано — цей альбом не додається, лише одне повідомлення про максимум
+            group = f"extra{user_id}"
+            await asyncio.gather(*(self.feed(self.updates.photo(user_id, group)) for _ in range(3)))
+
+    async def moderate(self, moder_id: int, sub_id: int):
+        async with self.sem:
+            await self.feed(self.updates.callback(moder_id, f"approve:{sub_id}", MOD_GROUP_ID))
+            if sub_id % 3 == 0:
+                await self.feed(self.updates.callback(moder_id, f"deny:{sub_id}", MOD_GROUP_ID))
+                await self.feed(self.updates.text(moder_id, "Неякісні фото", MOD_GROUP_ID))
+                return
+            await self.feed(self.updates.callback(moder_id, f"addtags:{sub_id}", MOD_GROUP_ID))
+            for index in (0, 8, 18):
+                await self.feed(self.updates.callback(moder_id, f"tag:{sub_id}:{index}", MOD_GROUP_ID))
+            await self.feed(self.updates.callback(moder_id, f"tags_done:{sub_id}", MOD_GROUP_ID))
+
+    async def toggle_flow(self, moder_id: int, sub_id: int, clicks: List[int]):
+        async with self.sem:
+            for index in clicks:
+                await self.feed(self.updates.callback(moder_id, f"tag:{sub_id}:{index}", MOD_GROUP_ID))
+
+    async def run(self, name: str, coros) -> Dict[str, float]:
+        self.latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*coros)
+        elapsed = time.perf_counter() - start
+        lat = sorted(self.latencies)
+        return {
+            "updates": len(lat),
+            "seconds": round(elapsed, 3),
+            "throughput": round(len(lat) / elapsed, 1),
+            "p50_ms": round(lat[len(lat) // 2] * 1000, 2),
+            "p99_ms": round(lat[int(len(lat) * 0.99)] * 1000, 2),
+            "mean_ms": round(statistics.fmean(lat) * 1000, 2),
+        }
+
+
+async def concurrent_submitters(test: "LoadTest", users: int) -> Dict[str, Any]:
+    """users людей одночасно проходять анкету; поруч міряється, наскільки запізнюється event loop."""
+    lags: List[float] = []
+    done = asyncio.Event()
+
+    async def ticker():
+        # запити SQLite йдуть у потоках Storage — цикл не має блокуватися на них
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append(time.perf_counter() - start - 0.005)
+
+    # прогрів: перша анкета в процесі будує схеми pydantic для типів aiogram (~150 мс за раз)
+    await test.user_flow(5_000_000 + users)
+    task = asyncio.create_task(ticker())
+    try:
+        result = await test.run("submitters", (test.user_flow(5_000_000 + i) for i in range(users)))
+    finally:
+        done.set()
+        await task
+    lags.sort()
+    result.update({
+        "users": users,
+        "loop_lag_p99_ms": round(lags[int(len(lags) * 0.99)] * 1000, 2),
+        "loop_lag_max_ms": round(lags[-1] * 1000, 2),
+    })
+    return result
+
+
+async def check_albums(bazar, fake: FakeTelegram, user_ids: List[int]) -> Dict[str, int]:
+    """Після album_flow у кожній чернетці рівно MAX_MEDIA медіа, а повідомлення про ліміт — одне."""
+    from aiogram.fsm.storage.base import StorageKey
+
+    cap = f"Максимум {bazar.MAX_MEDIA} медіа. Натисни «Готово ✅»."
+    wrong_drafts = wrong_caps = 0
+    for user_id in user_ids:
+        data = await bazar.fsm_storage.get_data(StorageKey(bot_id=bazar.bot.id, chat_id=user_id, user_id=user_id))
+        photos, uids = data.get("photos", []), data.get("media_uids", [])
+        wrong_drafts += not (len(photos) == len(set(uids)) == bazar.MAX_MEDIA)
+        wrong_caps += fake.texts[user_id, cap] != 1
+    if wrong_drafts or wrong_caps:
+        raise AssertionError(f"album: {wrong_drafts} чернеток не на {bazar.MAX_MEDIA} медіа, "
+                             f"{wrong_caps} користувачів без рівно одного повідомлення про ліміт")
+    return {"wrong_drafts": wrong_drafts, "wrong_cap_messages": wrong_caps}
+
+
+async def wait_outbox(bazar, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pending, = await bazar.db.fetchone("SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')")
+        if not pending:
+            return
+        bazar.outbox.wake()
+        await asyncio.sleep(0.1)
+
+
+async def publish_race(bazar, fake: FakeTelegram, test: "LoadTest", subs: int, crashes: int,
+                       moderators: List[int]) -> Dict[str, Any]:
+    """Гонка модераторів і падіння процесу посеред публікації: жодна заявка не виходить у канал двічі."""
+    first_user = 3_000_000
+    await test.run("race_form", (test.user_flow(first_user + i) for i in range(subs + crashes)))
+    ids = [row[0] for row in await bazar.db.fetchall(
+        "SELECT id FROM submissions WHERE user_id >= ? AND status='pending' ORDER BY id", (first_user,)
+    )]
+    race, crashed = ids[:subs], ids[subs:]
+
+    async def click_all(sub_id: int):
+        await asyncio.gather(*(
+            test.feed(test.updates.callback(moder_id, f"{action}:{sub_id}", MOD_GROUP_ID))
+            for moder_id in moderators for action in ("tags_done", "postnow")
+        ))
+    result = await test.run("race", (click_all(sub_id) for sub_id in race))
+    await wait_outbox(bazar)
+
+    for sub_id in crashed:
+        sent = asyncio.Event()
+        fake.on_channel_post = sent.set
+        await test.feed(test.updates.callback(moderators[0], f"postnow:{sub_id}", MOD_GROUP_ID))
+        await sent.wait()
+        # пост уже в каналі, транзакція після нього ще не виконана — «вбиваємо» процес
+        await bazar.outbox.stop()
+        fake.on_channel_post = None
+        inflight = bazar.sender._inflight.get(f"publish:{sub_id}")
+        if inflight:
+            await asyncio.wait([inflight])
+        bazar.sender._done.clear()  # пам'ять процесу зникла разом із ним
+        bazar.outbox.start(bazar.bot)
+        await wait_outbox(bazar)
+
+    first_media = dict(await bazar.db.fetchall(
+        f"SELECT sub_id, file_id FROM submission_media WHERE position=0 AND sub_id IN ({','.join('?' * len(ids))})", ids
+    ))
+    posts = Counter(fake.channel_posts)
+    per_sub = {sub_id: posts[first_media[sub_id]] for sub_id in ids}
+    entries = dict(await bazar.db.fetchall(
+        f"SELECT sub_id, COUNT(*) FROM outbox WHERE kind='publish' AND sub_id IN ({','.join('?' * len(ids))}) "
+        "GROUP BY sub_id", ids
+    ))
+    statuses = Counter(row[0] for row in await bazar.db.fetchall(
+        f"SELECT status FROM submissions WHERE id IN ({','.join('?' * len(crashed))})", crashed
+    )) if crashed else Counter()
+    result.update({
+        "submissions": len(race),
+        "duplicate_posts": sum(max(n - 1, 0) for n in per_sub.values()),
+        "missing_posts": sum(1 for sub_id in race if per_sub[sub_id] == 0),
+        "duplicate_outbox_entries": sum(max(n - 1, 0) for n in entries.values()),
+        "crashes": len(crashed),
+        "crashed_back_to_moderators": statuses["pending"],
+    })
+    if result["duplicate_posts"] or result["missing_posts"] or result["duplicate_outbox_entries"]:
+        raise AssertionError(f"race: {result}")
+    if statuses["pending"] != len(crashed):
+        raise AssertionError(f"race: після падіння заявки мають повернутись модераторам, а маємо {dict(statuses)}")
+    return result
+
+
+class VirtualClock:
+    """Годинник для OutboxDispatcher(clock=...): час іде лише тоді, коли його посунуть."""
+
+    def __init__(self, start: float):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+
+async def schedule_check(bazar, fake: FakeTelegram, test: "LoadTest", moderator: int) -> Dict[str, Any]:
+    """Інтервал між постами, округлення до слотів і рестарт посеред розкладу на віртуальному часі."""
+    start = (datetime.now(bazar.PUBLISH_ZONE) + timedelta(days=1)).replace(hour=8, minute=0, second=0, microsecond=0)
+    clock = VirtualClock(start.timestamp())  # завжди попереду реального часу, тож notify теж уже настали
+    interval, slots, original = bazar.PUBLISH_INTERVAL, bazar._SLOTS, bazar.outbox
+    await original.stop()
+    sends: List[float] = []
+    fake.on_channel_post = lambda: sends.append(clock.now)
+    users = itertools.count(5_000_000)
+
+    async def restart():
+        # новий процес: новий диспетчер і порожня пам'ять відправника, стан — лише в БД
+        await bazar.outbox.stop()
+        bazar.sender._done.clear()
+        bazar.outbox = bazar.OutboxDispatcher(poll_interval=0.05, clock=clock)
+        bazar.outbox.start(bazar.bot)
+
+    async def approve(count: int) -> List[int]:
+        first = next(users)
+        for _ in range(count - 1):
+            next(users)
+        await test.run("schedule_form", (test.user_flow(first + i) for i in range(count)))
+        ids = [row[0] for row in await bazar.db.fetchall(
+            "SELECT id FROM submissions WHERE user_id BETWEEN ? AND ? AND status='pending' ORDER BY id",
+            (first, first + count - 1)
+        )]
+        for sub_id in ids:
+            await test.feed(test.updates.callback(moderator, f"postnow:{sub_id}", MOD_GROUP_ID))
+        return ids
+
+    async def settle():
+        # чекаємо, доки диспетчер обробить усе, що вже настало на віртуальному годиннику
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            busy, = await bazar.db.fetchone(
+                "SELECT COUNT(*) FROM outbox WHERE status='sending' OR (status='pending' AND next_attempt_at <= ?)",
+                (int(clock.now),)
+            )
+            if not busy:
+                return
+            bazar.outbox.wake()
+            await asyncio.sleep(0.01)
+        raise AssertionError("schedule: outbox не обробив записи, що настали")
+
+    async def run_until(posts: int):
+        # посуваємо годинник до кожного наступного поста, доки не вийде posts постів
+        while len(sends) < posts:
+            await settle()
+            due, = await bazar.db.fetchone(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status='pending' AND kind IN ('publish', 'bump')"
+            )
+            if due is None:
+                break
+            clock.now = max(clock.now, due)
+            bazar.outbox.wake()
+        await settle()
+
+    try:
+        # 1) інтервал: 5 постів, бот лежав, поки всі не прострочились; рестарт і посеред розкладу
+        bazar.PUBLISH_INTERVAL, bazar._SLOTS = 120, []
+        await restart()
+        await bazar.outbox.stop()
+        await approve(5)
+        clock.now += 1000
+        restarted_at = clock.now
+        await restart()
+        await run_until(2)
+        await restart()
+        await run_until(5)
+        interval_sends = sends[:]
+        gaps = [int(b - a) for a, b in zip(interval_sends, interval_sends[1:])]
+        if len(interval_sends) != 5 or interval_sends[0] != restarted_at or min(gaps) < 120:
+            raise AssertionError(f"schedule: інтервал порушено, пости о {interval_sends} (рестарт о {restarted_at})")
+
+        # 2) слоти: пости на 09:00, 12:00 і 15:00, бот лежав з 8:xx до 13:30
+        bazar._SLOTS = [(9, 0), (12, 0), (15, 0), (18, 0), (21, 0)]
+        await bazar.outbox.stop()
+        sends.clear()
+        await approve(3)
+        clock.now = start.replace(hour=13, minute=30).timestamp()
+        await restart()
+        await run_until(3)
+        hours = [datetime.fromtimestamp(t, bazar.PUBLISH_ZONE).strftime("%H:%M:%S") for t in sends]
+        if hours != ["15:00:00", "18:00:00", "21:00:00"]:
+            raise AssertionError(f"schedule: пости мали вийти у слоти 15/18/21, а вийшли о {hours}")
+    finally:
+        fake.on_channel_post = None
+        bazar.PUBLISH_INTERVAL, bazar._SLOTS = interval, slots
+        await bazar.outbox.stop()
+        bazar.outbox = original
+        original.start(bazar.bot)
+    return {
+        "interval_gaps_s": gaps,
+        "slot_posts": hours,
+        "restarts": 3,
+    }
+
+
+# (текст, очікуваний результат)
+AMOUNT_CASES = [
+    ("$8 500", (8500, "USD")), ("8.5k", (8500, None)), ("8500 у.о.", (8500, "USD")),
+    ("8,500$", (8500, "USD")), ("$8,500", (8500, "USD")), ("$12.000", (12000, "USD")),
+    ("8.500 €", (8500, "EUR")), ("7,5 тис $", (7500, "USD")), ("12 000 євро", (12000, "EUR")),
+    ("1.5 млн грн", (1_500_000, "UAH")), ("1,5 млн грн", (1_500_000, "UAH")), ("350 000 грн", (350_000, "UAH")),
+    ("1.250.000 грн", (1_250_000, "UAH")), ("9800 дол", (9800, "USD")), ("торг", None),
+]
+PRICE_CASES = [
+    ("8,500$", "$8 500"), ("$12.000", "$12 000"), ("7 900 €", "7 900 €"), ("350 000 грн", "350 000 грн"),
+    ("$8", None), ("50 €", None), ("8500", None),
+]
+MILEAGE_CASES = [
+    ("173383", 173_383), ("173 тис", 173_000), ("173k", 173_000), ("173", 173_000), ("1.5", 1500),
+    ("1,5 тис", 1500), ("173.383", 173_383), ("173,383 км", 173_383), ("95 000 км", 95_000), ("новий", None),
+]
+TAG_CASES = [
+    ({"gearbox": "автомат", "engine": "2.0 TDI дизель", "car_title": "Audi A4 Avant 2013", "price": "$8,500"},
+     {"#автомат", "#дизель", "#універсал", "#до10к"}),
+    ({"gearbox": "механіка", "engine": "1.6 бензин", "car_title": "Skoda Octavia седан", "price": "$12.000"},
+     {"#механіка", "#бензин", "#седан", "#до15к"}),
+    ({"gearbox": "АКПП", "engine": "електро 64 кВт", "car_title": "Nissan Leaf хетчбек", "price": "8.5k $"},
+     {"#автомат", "#електро", "#хетчбек", "#до10к"}),
+    ({"gearbox": "DSG", "engine": "1.4 TSI газ/бензин", "car_title": "VW Golf", "price": "2 900$"},
+     {"#робот", "#бензин", "#газ", "#до3к"}),
+    ({"gearbox": "варіатор", "engine": "2.5 гібрид", "car_title": "Toyota RAV4 кросовер", "price": "1.5 млн грн"},
+     {"#варіатор", "#гібрид", "#кросовер"}),
+    ({"gearbox": "автомат", "engine": "3.0 дизель", "car_title": "BMW X5 позашляховик", "price": "25.000 €"},
+     {"#автомат", "#дизель", "#позашляховик", "#20кплюс"}),
+    ({"gearbox": "механіка", "engine": "1.5 dCi", "car_title": "Renault Megane універсал", "price": "5,000 у.о."},
+     {"#механіка", "#дизель", "#універсал", "#до5к"}),
+]
+
+
+def synthetic_answers(rng: random.Random, cities: List[str]) -> Dict[str, str]:
+    brand = rng.choice(list(BRANDS))
+    words = ["стан", "гарний", "сервісна", "історія", "нова", "гума", "<без>", "ДТП", "&", "один", "власник", "🚗"]
+    return {
+        "car_title": f"{brand.title()} {rng.choice(BRANDS[brand]).upper()} {rng.randint(2000, 2024)}",
+        "engine": f"{rng.choice(['1.6', '2.0', '3.0'])} {rng.choice(['бензин', 'дизель', 'гібрид'])}",
+        "gearbox": rng.choice(["автомат", "механіка", "робот"]),
+        "mileage": f"{rng.randint(10, 400)} 000",
+        "city": rng.choice(cities),
+        "price": f"${rng.randint(2, 60)} 000",
+        "contacts": "+380501234567",
+        # частина описів довша за те, що влазить у підпис
+        "description": " ".join(rng.choice(words) for _ in range(rng.choice([5, 40, 140]))),
+    }
+
+
+async def render_benchmark(bazar, test: "LoadTest", listings: int) -> Dict[str, Any]:
+    """render_post на корпусі оголошень і перевірка, що закешований підпис — саме канальний."""
+    import html
+    import re
+
+    rng = random.Random(7)
+    cities = list(bazar.CITIES)
+    corpus = [synthetic_answers(rng, cities) for _ in range(listings)]
+    timings, over_limit = [], 0
+    for data in corpus:
+        start = time.perf_counter()
+        caption = bazar.render_post(data)
+        timings.append(time.perf_counter() - start)
+        over_limit += bazar.tg_len(html.unescape(re.sub(r"<[^>]+>", "", caption))) > bazar.CAPTION_LIMIT
+    timings.sort()
+    if over_limit:
+        raise AssertionError(f"render: {over_limit} підписів довші за {bazar.CAPTION_LIMIT}")
+
+    # довгий опис: у кеші має лежати підпис без резерву під «🆕 Заявка #N»
+    user_id = 6_000_000
+    long = ANSWERS[:-1] + ["Дуже докладний опис. " * 45]
+    await test.replay(test.form_stream(user_id, long))
+    sub_id, answers, caption = await bazar.db.fetchone(
+        "SELECT id, answers, caption FROM submissions WHERE user_id=? ORDER BY id DESC", (user_id,)
+    )
+    if caption != bazar.render_post(json.loads(answers)):
+        raise AssertionError("render: у submissions.caption закешовано підпис для модераторів, а не для каналу")
+    start = time.perf_counter()
+    for _ in range(100):
+        await bazar.get_caption(sub_id, [])
+    cached = (time.perf_counter() - start) / 100
+    return {
+        "listings": listings,
+        "render_p50_us": round(timings[len(timings) // 2] * 1e6, 1),
+        "render_p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+        "renders_per_second": round(len(timings) / sum(timings)),
+        "cached_caption_ms": round(cached * 1000, 3),
+    }
+
+
+async def tag_benchmark(bazar, rows: int) -> Dict[str, Any]:
+    """Точність розбору й підказаних тегів на таблиці прикладів, потім retag_all на rows рядках."""
+    wrong = [f"parse_amount({text!r}) = {got}, а не {want}"
+             for text, want in AMOUNT_CASES if (got := bazar.parse_amount(text)) != want]
+    wrong += [f"parse_price({text!r}) = {got}, а не {want}"
+              for text, want in PRICE_CASES if (got := (bazar.parse_price(text) or {}).get("price")) != want]
+    wrong += [f"parse_mileage({text!r}) = {got}, а не {want}"
+              for text, want in MILEAGE_CASES if (got := bazar.parse_mileage(text)) != want]
+    wrong += [f"suggest_tags({data['car_title']!r}) = {got}, а не {want}"
+              for data, want in TAG_CASES if (got := set(bazar.mask_to_tags(bazar.suggest_tags(data)))) != want]
+    cases = len(AMOUNT_CASES) + len(PRICE_CASES) + len(MILEAGE_CASES) + len(TAG_CASES)
+    if wrong:
+        raise AssertionError("tags:\n" + "\n".join(wrong))
+
+    def fill(conn) -> int:
+        first, = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM submissions").fetchone()
+        conn.executemany(
+            "INSERT INTO submissions (user_id, answers, status, created_at, updated_at) "
+            "VALUES (?, ?, 'denied', strftime('%s','now'), strftime('%s','now'))",
+            [(4_000_000 + i, json.dumps(TAG_CASES[i % len(TAG_CASES)][0], ensure_ascii=False)) for i in range(rows)]
+        )
+        return first
+    first = await bazar.db.transaction(fill)
+    start = time.perf_counter()
+    retagged = await bazar.retag_all()
+    elapsed = time.perf_counter() - start
+
+    # пакетний шлях дає ті самі теги, що й таблиця
+    stored = await bazar.db.fetchall(
+        "SELECT id, suggested_tags FROM submissions WHERE id >= ? ORDER BY id", (first,)
+    )
+    mismatched = sum(
+        set(bazar.mask_to_tags(mask or 0)) != TAG_CASES[(sub_id - first) % len(TAG_CASES)][1] for sub_id, mask in stored
+    )
+    if mismatched:
+        raise AssertionError(f"tags: retag_all дав інші теги для {mismatched} рядків")
+    return {
+        "cases": cases,
+        "accuracy": round((cases - len(wrong)) / cases, 3),
+        "retagged_rows": retagged,
+        "retag_seconds": round(elapsed, 3),
+        "retag_rows_per_second": round(retagged / elapsed),
+    }
+
+
+async def toggle_benchmark(bazar, test: "LoadTest", moderators: List[int]) -> Dict[str, Any]:
+    """Клацання тегів (toggle_tag) через dp.feed_update і окремо побудова kb_tags_picker."""
+    rng = random.Random(9)
+    # кожен модератор одночасно вибирає теги для max_per_kind заявок — більше ModSessions витісняє
+    subs = len(moderators) * bazar.mod_sessions.max_per_kind
+    flows = {(moderators[i % len(moderators)], 9_900_000 + i): [rng.randrange(len(bazar.TAGS)) for _ in range(20)]
+             for i in range(subs)}
+    result = await test.run("tag_toggle", (test.toggle_flow(m, sub_id, clicks) for (m, sub_id), clicks in flows.items()))
+
+    # після кліків у сесії модератора — XOR усіх натиснутих тегів
+    wrong = 0
+    for (moder_id, sub_id), clicks in flows.items():
+        expected = 0
+        for index in clicks:
+            expected ^= 1 << index
+        wrong += (await bazar.mod_sessions.get(moder_id, "tags", sub_id) or 0) != expected
+        await bazar.mod_sessions.pop(moder_id, "tags", sub_id)
+    if wrong:
+        raise AssertionError(f"tag_toggle: у {wrong} сесіях не той набір тегів")
+
+    # клавіатура після кожного кліку: маска міняється на один біт
+    timings = []
+    for sub_id in range(100):
+        mask = 0
+        for _ in range(100):
+            mask ^= 1 << rng.randrange(len(bazar.TAGS))
+            start = time.perf_counter()
+            bazar.kb_tags_picker(12_000_000 + sub_id, mask)
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    result.update({
+        "keyboard_p50_us": round(timings[len(timings) // 2] * 1e6, 1),
+        "keyboard_p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+    })
+    return result
+
+
+BRANDS = {
+    "audi": ["a4", "a6", "q5"], "bmw": ["x5", "320", "520"], "volkswagen": ["passat", "golf", "tiguan"],
+    "skoda": ["octavia", "superb", "fabia"], "toyota": ["camry", "rav4", "corolla"], "renault": ["megane", "logan"],
+    "ford": ["focus", "fusion", "kuga"], "hyundai": ["tucson", "elantra"], "kia": ["sportage", "ceed"],
+    "mercedes": ["e220", "c200"], "nissan": ["leaf", "qashqai"], "opel": ["astra", "vectra"],
+    "mazda": ["6", "cx5"], "honda": ["accord", "civic"], "mitsubishi": ["outlander", "lancer"],
+    "peugeot": ["308", "3008"], "chevrolet": ["aveo", "volt"], "volvo": ["xc60", "s60"],
+    "lexus": ["rx350", "is250"], "tesla": ["model3", "models"],
+}
+
+
+async def subscription_benchmark(bazar, subscriptions: int, posts: int, fanout: bool) -> Dict[str, Any]:
+    """Підбір підписників для нових постів через subscription_keys і, за fanout, розсилка через outbox."""
+    rng = random.Random(42)
+    brands, cities, tags = list(BRANDS), list(bazar.CITIES), bazar.TAGS
+
+    def query() -> str:
+        # здебільшого марка (часто з моделлю), плюс уточнення; рідко — лише ціна
+        parts = []
+        kind = rng.random()
+        if kind < 0.85:
+            brand = rng.choice(brands)
+            parts.append(brand + (" " + rng.choice(BRANDS[brand]) if rng.random() < 0.5 else ""))
+        elif kind < 0.92:
+            parts.append(rng.choice(cities))
+        elif kind < 0.97:
+            parts.append(rng.choice(tags))
+        if rng.random() < 0.3:
+            parts.append(rng.choice(cities))
+        if rng.random() < 0.3:
+            parts.append(rng.choice(tags))
+        if rng.random() < 0.5 or not parts:
+            parts.append(f"ціна<{rng.randrange(3, 40)}к")
+        if rng.random() < 0.2:
+            parts.append(f"пробіг<{rng.randrange(50, 300)}т")
+        return " ".join(parts)
+
+    def fill(conn):
+        for user_id in range(1, subscriptions + 1):
+            q = query()
+            conditions = bazar.parse_subscription(q)
+            subscription_id = conn.execute(
+                "INSERT INTO subscriptions (user_id, query, conditions) VALUES (?, ?, ?)",
+                (10_000_000 + user_id, q, json.dumps(conditions, ensure_ascii=False))
+            ).lastrowid
+            conn.execute("INSERT INTO subscription_keys (key, subscription_id) VALUES (?, ?)",
+                         (bazar.subscription_key(conditions), subscription_id))
+
+        listings = []
+        for i in range(posts):
+            brand = rng.choice(brands)
+            answers = {"car_title": f"{brand.title()} {rng.choice(BRANDS[brand]).upper()} {rng.randrange(2005, 2024)}",
+                       "price": f"${rng.randrange(2, 50) * 1000}"}
+            sub_id = conn.execute(
+                "INSERT INTO submissions (user_id, answers, status, price_amount, price_currency, mileage_km, city, "
+                "created_at, updated_at) VALUES (?, ?, 'approved', ?, 'USD', ?, ?, 0, 0)",
+                (1, json.dumps(answers, ensure_ascii=False), int(answers["price"][1:]),
+                 rng.randrange(10, 400) * 1000, rng.choice(cities))
+            ).lastrowid
+            bazar._save_tags(conn, sub_id, rng.sample(tags, 3))
+            listings.append(sub_id)
+        return listings
+
+    start = time.perf_counter()
+    listings = await bazar.db.transaction(fill)
+    result: Dict[str, Any] = {"subscriptions": subscriptions, "posts": posts,
+                              "fill_seconds": round(time.perf_counter() - start, 2)}
+
+    # те саме, що перший прохід outbox-запису fanout: підбір і постановка в fanout_queue
+    latencies, queued = [], []
+    for sub_id in listings:
+        start = time.perf_counter()
+        queued.append(await bazar.db.transaction(lambda conn: bazar.queue_matches(conn, sub_id)))
+        latencies.append(time.perf_counter() - start)
+    lat = sorted(latencies)
+    result.update({
+        "match_p50_ms": round(lat[len(lat) // 2] * 1000, 2),
+        "match_p99_ms": round(lat[int(len(lat) * 0.99)] * 1000, 2),
+        "matches_per_post": round(sum(queued) / posts, 1),
+        "notifications_per_day": sum(queued) * 1000 // posts,
+    })
+
+    # для порівняння: повний перебір усіх підписок на кожен пост (на вибірці постів)
+    scan = []
+    for sub_id in listings[:20]:
+        start = time.perf_counter()
+        listing = await bazar.db.read(lambda conn: bazar.listing_terms(conn, sub_id))
+        rows = await bazar.db.fetchall("SELECT id, user_id, conditions FROM subscriptions")
+        sum(bazar.subscription_matches(json.loads(c), listing) for _, _, c in rows)
+        scan.append(time.perf_counter() - start)
+    result["full_scan_p50_ms"] = round(sorted(scan)[len(scan) // 2] * 1000, 2)
+
+    if fanout:
+        # розсилка через outbox і SendScheduler; на всіх постах це мільйони повідомлень — беремо перші 20
+        await bazar.db.executemany(
+            "INSERT INTO outbox (sub_id, kind, payload) VALUES (?, 'fanout', ?)",
+            [(sub_id, json.dumps({"queued": n})) for sub_id, n in zip(listings[:20], queued)]
+        )
+        sent_before = bazar.sender.sent
+        start = time.perf_counter()
+        bazar.outbox.wake()
+        # поки йде розсилка, звичайний запис outbox (сповіщення автору) не має чекати її порцій
+        await asyncio.sleep(0.5)
+        entry_id = await bazar.db.transaction(lambda conn: conn.execute(
+            "INSERT INTO outbox (sub_id, kind, payload) VALUES (?, 'notify', ?)",
+            (listings[0], json.dumps({"chat_id": 1, "text": "✅ Оголошення опубліковано"}))
+        ).lastrowid)
+        bazar.outbox.wake()
+        queued_at = time.perf_counter()
+        while (await bazar.db.fetchone("SELECT status FROM outbox WHERE id=?", (entry_id,)))[0] == "pending":
+            await asyncio.sleep(0.005)
+        notify_delay = time.perf_counter() - queued_at
+        await wait_outbox(bazar, timeout=3600)
+        elapsed = time.perf_counter() - start
+        result.update({
+            "fanout_seconds": round(elapsed, 2),
+            "notifications_per_second": round((bazar.sender.sent - sent_before) / elapsed, 1),
+            "notify_during_fanout_ms": round(notify_delay * 1000, 1),
+        })
+    return result
+
+
+SEARCH_QUERIES = [
+    "audi", "toyota camry", "#дизель", "#автомат #кросовер", "bmw #дизель", "ціна<10000$",
+    "skoda ціна<8000$", "#механіка пробіг<100т", "", "tesla model3 #електро",
+]
+
+
+async def search_benchmark(bazar, listings: int, pages: int) -> Dict[str, Any]:
+    """search_listings на --search-listings опублікованих оголошеннях: перша і глибші сторінки (before)."""
+    rng = random.Random(11)
+    cities = list(bazar.CITIES)
+
+    def fill(conn) -> None:
+        first, = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM submissions").fetchone()
+        conn.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(t,) for t in bazar.TAGS])
+        tag_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM tags WHERE name IN (%s)" % ",".join("?" * len(bazar.TAGS)), bazar.TAGS
+        )]
+        for chunk in range(0, listings, 10_000):
+            rows, tags = [], []
+            for i in range(chunk, min(chunk + 10_000, listings)):
+                data = synthetic_answers(rng, cities)
+                # кожне десяте — в архіві, тож сторінку доводиться добирати
+                rows.append((7_000_000 + i, json.dumps(data, ensure_ascii=False), int(data["price"][1:].replace(" ", "")),
+                             int(data["mileage"].replace(" ", "")), data["city"], 0 if i % 10 == 0 else None))
+                tags += [(first + i, tag_id) for tag_id in rng.sample(tag_ids, 3)]
+            conn.executemany(
+                "INSERT INTO submissions (user_id, answers, caption, status, price_amount, price_currency, mileage_km, "
+                "city, archived_at, created_at, updated_at) VALUES (?, ?, '', 'approved', ?, 'USD', ?, ?, ?, 0, 0)", rows
+            )
+            conn.executemany("INSERT INTO submission_tags (sub_id, tag_id) VALUES (?, ?)", tags)
+        conn.execute(f"INSERT INTO listings_fts (rowid, car_title, city, description) {bazar._FTS_SELECT} WHERE id >= ?",
+                     (first,))
+
+    start = time.perf_counter()
+    await bazar.db.transaction(fill)
+    await bazar.db.execute("ANALYZE")
+    result: Dict[str, Any] = {"listings": listings, "fill_seconds": round(time.perf_counter() - start, 1)}
+
+    first_pages, deep_pages = [], []
+    for query in SEARCH_QUERIES:
+        before = None
+        for page in range(pages):
+            start = time.perf_counter()
+            rows = await bazar.search_listings(query, before)
+            (first_pages if page == 0 else deep_pages).append(time.perf_counter() - start)
+            ids = [row[0] for row in rows]
+            if ids != sorted(ids, reverse=True) or (before and ids and ids[0] >= before):
+                raise AssertionError(f"search: сторінка {page} для {query!r} не від найновіших")
+            if len(rows) < 20:
+                break
+            before = ids[-1]
+    for name, timings in (("first_page", first_pages), ("deep_page", deep_pages)):
+        timings.sort()
+        result[f"{name}_p50_ms"] = round(timings[len(timings) // 2] * 1000, 2)
+        result[f"{name}_max_ms"] = round(timings[-1] * 1000, 2)
+    return result
+
+
+MIGRATED_QUERIES = {
+    # ті самі запити, що в бота, — після міграції кожен має йти по індексу, а не SCAN submissions
+    "pending_page": ("SELECT id, created_at, user_id, username, json_extract(answers, '$.car_title') FROM submissions "
+                     "WHERE status='pending' AND (created_at, id) > (?, ?) ORDER BY created_at, id LIMIT 10", (-1, 0)),
+    "user_daily": ("SELECT COUNT(*) FROM submissions WHERE user_id=? AND created_at > strftime('%s','now') - 86400",
+                   (8_000_500,)),
+    "media": ("SELECT file_id, media_type FROM submission_media WHERE sub_id=? ORDER BY position", (500_000,)),
+    "search_words": ("SELECT rowid FROM listings_fts WHERE listings_fts MATCH ? ORDER BY rowid DESC LIMIT 20",
+                     ('"audi"*',)),
+    "status_counts": ("SELECT status, n FROM submission_counts WHERE n > 0", ()),
+}
+
+
+async def duplicate_benchmark(bazar, rows: int) -> Dict[str, Any]:
+    """duplicate_warnings на --dup-rows заявках, з яких кожна десята — копія одного оголошення з тим самим фото."""
+    rng = random.Random(3)
+    cities = list(bazar.CITIES)
+    # сигнатури рахуються один раз на шаблон: MinHash на кожен рядок заповнював би БД хвилинами
+    templates = [bazar.listing_signature(synthetic_answers(rng, cities)) for _ in range(1000)]
+    packed = [(bazar.pack_signature(sig), bazar.lsh_bands(sig)) for sig in templates]
+
+    def fill(conn) -> int:
+        first, = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM submissions").fetchone()
+        for chunk in range(0, rows, 10_000):
+            subs, bands, media = [], [], []
+            for i in range(chunk, min(chunk + 10_000, rows)):
+                template = 0 if i % 10 == 0 else rng.randrange(1, len(templates))
+                blob, keys = packed[template]
+                subs.append((9_500_000 + i, blob, rng.choice(["approved", "denied", "archived"])))
+                bands += [(key, first + i) for key in keys]
+                media.append((first + i, "dupphoto" if template == 0 else f"dup{i}"))
+            conn.executemany(
+                "INSERT INTO submissions (user_id, answers, minhash, status, created_at, updated_at) "
+                "VALUES (?, '{}', ?, ?, 0, 0)", subs
+            )
+            conn.executemany("INSERT OR IGNORE INTO dup_lsh (band_key, sub_id) VALUES (?, ?)", bands)
+            conn.executemany(
+                "INSERT INTO submission_media (sub_id, position, file_id, media_type, file_unique_id) "
+                "VALUES (?, 0, ?, 'photo', ?)", [(sub_id, uid, uid) for sub_id, uid in media]
+            )
+        return first
+    start = time.perf_counter()
+    await bazar.db.transaction(fill)
+    result: Dict[str, Any] = {"rows": rows, "fill_seconds": round(time.perf_counter() - start, 1)}
+
+    fresh = bazar.listing_signature({"car_title": "Заз 968М 1989", "description": "єдиний такий, рідна фарба"})
+    for name, signature, uids in (("copied", templates[0], ["dupphoto"]), ("unique", fresh, ["freshphoto"])):
+        timings, warnings = [], []
+        for _ in range(50):
+            start = time.perf_counter()
+            warnings = await bazar.duplicate_warnings(1, signature, uids)
+            timings.append(time.perf_counter() - start)
+        if (name == "copied") != (len(warnings) == 2):
+            raise AssertionError(f"duplicates: для {name} попередження {warnings}")
+        timings.sort()
+        result[f"{name}_p50_ms"] = round(timings[len(timings) // 2] * 1000, 2)
+        result[f"{name}_max_ms"] = round(timings[-1] * 1000, 2)
+    return result
+
+
+async def queue_benchmark(bazar, pending: int) -> Dict[str, Any]:
+    """Сторінки /queue (render_queue) на початку, посередині й у кінці черги з --queue-rows заявок."""
+    def fill(conn) -> int:
+        first, = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM submissions").fetchone()
+        conn.executemany(
+            "INSERT INTO submissions (user_id, username, answers, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'pending', ?, ?)",
+            ((9_000_000 + i, f"user{i}", json.dumps({"car_title": f"Audi A4 {i}"}), 1_600_000_000 + i // 3,
+              1_600_000_000) for i in range(pending))
+        )
+        return first
+    first = await bazar.db.transaction(fill)
+
+    sql, params = MIGRATED_QUERIES["pending_page"]
+    plan = " ".join(row[3] for row in await bazar.db.fetchall("EXPLAIN QUERY PLAN " + sql, params))
+    if "idx_submissions_status_created" not in plan or "TEMP B-TREE" in plan:
+        raise AssertionError(f"queue: сторінка черги не йде по idx_submissions_status_created: {plan}")
+
+    result: Dict[str, Any] = {"pending": pending}
+    for name, offset in (("first", None), ("middle", pending // 2), ("last", pending - 5)):
+        cursor = None
+        if offset is not None:
+            created_at, sub_id = await bazar.db.fetchone(
+                "SELECT created_at, id FROM submissions WHERE status='pending' AND id >= ? "
+                "ORDER BY created_at, id LIMIT 1 OFFSET ?", (first, offset)
+            )
+            cursor = f"{created_at}:{sub_id}"
+        timings = []
+        for _ in range(50):
+            start = time.perf_counter()
+            await bazar.render_queue(cursor, MODERATOR_BASE)
+            timings.append(time.perf_counter() - start)
+        result[f"{name}_page_ms"] = round(statistics.median(timings) * 1000, 3)
+
+    # щоб ці заявки не потрапили в інші сценарії
+    await bazar.db.execute("UPDATE submissions SET status='denied' WHERE id >= ? AND status='pending'", (first,))
+    return result
+
+
+async def migrate_benchmark(bazar, rows: int, workdir: str) -> Dict[str, Any]:
+    """migrate() на великій БД старого формату (до v1: фото JSON-списком у submissions) і запити після неї."""
+    import sqlite3
+
+    rng = random.Random(5)
+    cities = list(bazar.CITIES)
+    conn = sqlite3.connect(os.path.join(workdir, "legacy.db"))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE submissions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, username TEXT, "
+                 "answers TEXT, photos TEXT, status TEXT DEFAULT 'pending')")
+    statuses = ["pending"] + ["approved"] * 6 + ["denied"] * 3
+    start = time.perf_counter()
+    with conn:
+        conn.executemany(
+            "INSERT INTO submissions (user_id, username, answers, photos, status) VALUES (?, ?, ?, ?, ?)",
+            ((8_000_000 + i % 50_000, f"user{i % 50_000}", json.dumps(synthetic_answers(rng, cities), ensure_ascii=False),
+              json.dumps([f"legacy{i}_{n}" for n in range(3)]), rng.choice(statuses)) for i in range(rows))
+        )
+    result: Dict[str, Any] = {"rows": rows, "fill_seconds": round(time.perf_counter() - start, 1)}
+
+    steps: Dict[str, float] = {}
+
+    def timed(migration):
+        def run(conn):
+            start = time.perf_counter()
+            migration(conn)
+            steps[migration.__name__] = time.perf_counter() - start
+        return run
+
+    migrations = bazar.MIGRATIONS
+    bazar.MIGRATIONS = [timed(migration) for migration in migrations]
+    try:
+        start = time.perf_counter()
+        bazar.migrate(conn)
+        result["migrate_seconds"] = round(time.perf_counter() - start, 1)
+    finally:
+        bazar.MIGRATIONS = migrations
+    result["slowest_migrations"] = {name: round(t, 1) for name, t in sorted(steps.items(), key=lambda x: -x[1])[:3]}
+
+    scans = []
+    for name, (sql, params) in MIGRATED_QUERIES.items():
+        plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+        if "SCAN submissions" in plan or "SCAN submission_media" in plan:
+            scans.append(f"{name}: {plan}")
+        timings = []
+        for _ in range(20):
+            start = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            timings.append(time.perf_counter() - start)
+        result[f"{name}_ms"] = round(statistics.median(timings) * 1000, 3)
+    conn.close()
+    if scans:
+        raise AssertionError("migrate: запити без індексу після міграції:\n" + "\n".join(scans))
+    return result
+
+
+def load_replay(path: str) -> List[List[Dict[str, Any]]]:
+    """Записані апдейти (по одному JSON на рядок) → потоки окремих користувачів у вихідному порядку."""
+    import bazar
+    streams: Dict[Any, List[Dict[str, Any]]] = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                raw = json.loads(line)
+                streams.setdefault(bazar.update_user(raw)[0], []).append(raw)
+    return list(streams.values())
+
+
+async def webhook_replay(bazar, test: "LoadTest", streams: List[List[Dict[str, Any]]],
+                         workers: int, queue_size: int) -> Dict[str, Any]:
+    """Ганяє потоки апдейтів через справжній WebhookHandler і HTTP-сервер бота."""
+    secret = "loadtest-secret"
+    handler = bazar.WebhookHandler(bazar.dp, bazar.bot, secret=secret, workers=workers, queue_size=queue_size)
+    app = bazar.create_app(handler.handle)
+    app["ready"].set()
+    app.on_startup.append(handler.start)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{bazar.WEBHOOK_PATH}"
+
+    before, before_id = await bazar.db.fetchone("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM submissions")
+    async with ClientSession() as session:
+        async with session.post(url, json=streams[0][0]) as resp:
+            unauthorized = resp.status  # без секрету — 401
+        test.webhook = (session, url, secret)
+        test.rejected = 0
+        try:
+            result = await test.run("webhook", (test.replay(stream) for stream in streams))
+            start = time.perf_counter()
+            await handler.queue.join()  # POST підтверджує лише постановку в чергу
+            result["drain_seconds"] = round(time.perf_counter() - start, 3)
+            # пропускна здатність — до повної обробки, а не до відповіді 200
+            result["throughput"] = round(result["updates"] / (result["seconds"] + result["drain_seconds"]), 1)
+        finally:
+            test.webhook = None
+    await handler.stop(app)
+    await runner.cleanup()
+
+    # апдейти одного користувача мають оброблятися по порядку: інакше відповіді анкети й фото переплутаються
+    complete, = await bazar.db.fetchone(
+        "SELECT COUNT(*) FROM submissions s WHERE s.id > ? AND json_extract(s.answers, '$.car_title') = ? "
+        "AND json_extract(s.answers, '$.city') = ? AND (SELECT COUNT(*) FROM submission_media m WHERE m.sub_id = s.id) = 5",
+        (before_id, ANSWERS[0], ANSWERS[4])
+    )
+    after, = await bazar.db.fetchone("SELECT COUNT(*) FROM submissions")
+    result.update({
+        "rejected_503": test.rejected,
+        "no_secret_status": unauthorized,
+        "submissions": after - before,
+        "complete_submissions": complete,
+    })
+    return result
+
+
+def startup_probe(base_url: str):
+    """Виконується в окремому процесі: імпорт, setup() і перший апдейт."""
+    t0 = time.perf_counter()
+    import bazar
+    t1 = time.perf_counter()
+    configure(bazar, base_url, moderators=0, album_latency=0.05, real_limits=False)
+    t2 = time.perf_counter()
+
+    async def first_update():
+        await bazar.dp.feed_raw_update(bazar.bot, Updates().text(1, "/start"))
+        await bazar.bot.session.close()
+    asyncio.run(first_update())
+    t3 = time.perf_counter()
+    print(json.dumps({"import_ms": (t1 - t0) * 1000, "setup_ms": (t2 - t1) * 1000, "update_ms": (t3 - t2) * 1000}))
+
+
+def measure_startup(base_url: str, runs: int = 3) -> Dict[str, float]:
+    """Медіана по кількох холодних запусках інтерпретатора (схема БД уже актуальна)."""
+    samples = []
+    for _ in range(runs + 1):
+        start = time.perf_counter()
+        out = subprocess.run(
+            [sys.executable, "-c", f"import loadtest; loadtest.startup_probe({base_url!r})"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        ).stdout
+        sample = json.loads(out.strip().splitlines()[-1])
+        sample["first_update_ms"] = (time.perf_counter() - start) * 1000
+        samples.append(sample)
+    samples = samples[1:]  # перший запуск ще й мігрує порожню БД
+    return {k: round(statistics.median(s[k] for s in samples), 1) for k in samples[0]}
+
+
+def max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 1024 if sys.platform != "darwin" else rss / 1024 / 1024, 1)
+
+
+def configure(bazar, base_url: str, moderators: int, album_latency: float, real_limits: bool):
+    from aiogram.client.telegram import TelegramAPIServer
+
+    bazar.setup()
+    bazar.bot.session.api = TelegramAPIServer.from_base(base_url)
+    bazar.MODERATOR_IDS.update(MODERATOR_BASE + i for i in range(moderators))
+    if not real_limits:
+        # міряємо сам бот, а не ліміти Telegram
+        bazar.sender.global_bucket = bazar.TokenBucket(1e9, 1e9)
+        bazar.sender._chat_bucket = lambda chat_id: bazar.TokenBucket(1e9, 1e9)
+        bazar.sender.set_share = lambda shards: None
+    for middleware in bazar.dp.message.outer_middleware:
+        if isinstance(middleware, bazar.AlbumMiddleware):
+            middleware.latency = album_latency
+
+
+def shard_worker(shard: int, shards: int, socket_path: str, **options):
+    """Процес-шард: той самий bazar.run_shard, але з фейковим Bot API."""
+    import bazar
+    configure(bazar, **options)
+    logging.disable(logging.INFO)
+    bazar.run_shard(shard, shards, socket_path)
+
+
+async def main(args) -> Dict[str, Any]:
+    fake = FakeTelegram()
+    base_url = await fake.start()
+
+    os.environ.update({
+        "BOT_TOKEN": "123456:LOADTEST",
+        "CHANNEL_ID": str(CHANNEL_ID),
+        "MOD_GROUP_ID": str(MOD_GROUP_ID),
+        "DB_PATH": os.path.join(args.workdir, "startup.db"),
+        "PUBLISH_INTERVAL": "0",
+    })
+    results: Dict[str, Any] = {"shards": args.shards, "config": {
+        # з чим знято цифри: --compare з іншими параметрами чи на іншій машині порівнює непорівнюване
+        "users": args.users, "scenarios": sorted(args.scenarios), "cpus": os.cpu_count(),
+        "python": sys.version.split()[0],
+    }}
+    if "startup" in args.scenarios:
+        results["startup"] = await asyncio.to_thread(measure_startup, base_url)
+
+    os.environ["DB_PATH"] = os.path.join(args.workdir, "loadtest.db")
+    import bazar
+    configure(bazar, base_url, args.moderators, args.album_latency, args.real_limits)
+
+    procs, router = [], None
+    if args.shards > 1:
+        worker = functools.partial(
+            shard_worker, base_url=base_url, moderators=args.moderators,
+            album_latency=args.album_latency, real_limits=args.real_limits,
+        )
+        sockets = bazar.shard_sockets(args.shards)
+        procs = bazar.start_shards(sockets, target=worker)
+        router = bazar.ShardRouter(sockets, queue_size=10 ** 6)
+        await router.start()
+        while not all(map(os.path.exists, sockets)):  # не міряємо старт воркерів
+            await asyncio.sleep(0.1)
+    else:
+        await bazar.dp.emit_startup(bot=bazar.bot)
+    test = LoadTest(bazar, args.concurrency, router)
+    try:
+        if "form" in args.scenarios:
+            results["form"] = await test.run("form", (test.user_flow(1000 + i) for i in range(args.users)))
+        if "submitters" in args.scenarios:
+            results["submitters"] = await concurrent_submitters(test, args.submitters)
+        if "album" in args.scenarios:
+            results["album"] = await test.run(
+                "album", (test.album_flow(500_000 + i) for i in range(args.users))
+            )
+            if router is None:  # у шардах FSM живе в інших процесах
+                results["album"].update(await check_albums(bazar, fake, [500_000 + i for i in range(args.users)]))
+        if "moderation" in args.scenarios:
+            rows = await bazar.db.fetchall("SELECT id FROM submissions WHERE status='pending' ORDER BY id")
+            moderators = [MODERATOR_BASE + i for i in range(args.moderators)]
+            results["moderation"] = await test.run(
+                "moderation", (test.moderate(moderators[i % len(moderators)], sub_id) for i, (sub_id,) in enumerate(rows))
+            )
+            start = time.perf_counter()
+            await wait_outbox(bazar)
+            results["moderation"]["outbox_drain_seconds"] = round(time.perf_counter() - start, 3)
+            if router is None:
+                results["moderation_race"] = await publish_race(
+                    bazar, fake, test, subs=min(args.users, 50), crashes=3, moderators=moderators[:3]
+                )
+        if "webhook" in args.scenarios and router is None:
+            streams = load_replay(args.replay) if args.replay else \
+                [test.form_stream(2_000_000 + i) for i in range(args.users)]
+            results["webhook"] = await webhook_replay(
+                bazar, test, streams, workers=args.webhook_workers, queue_size=args.webhook_queue
+            )
+            if not args.replay and results["webhook"]["complete_submissions"] != args.users:
+                raise AssertionError(f"webhook: {results['webhook']['complete_submissions']} повних заявок замість {args.users}")
+        if "schedule" in args.scenarios and router is None:
+            results["schedule"] = await schedule_check(bazar, fake, test, MODERATOR_BASE)
+        if "render" in args.scenarios and router is None:
+            results["render"] = await render_benchmark(bazar, test, args.listings)
+        if "tags" in args.scenarios:
+            results["tags"] = await tag_benchmark(bazar, args.retag_rows)
+            results["tag_toggle"] = await toggle_benchmark(bazar, test, [MODERATOR_BASE + i for i in range(args.moderators)])
+        if "duplicates" in args.scenarios:
+            results["duplicates"] = await duplicate_benchmark(bazar, args.dup_rows)
+        if "queue" in args.scenarios:
+            results["queue"] = await queue_benchmark(bazar, args.queue_rows)
+        if "migrate" in args.scenarios:
+            results["migrate"] = await migrate_benchmark(bazar, args.migrate_rows, args.workdir)
+        if "search" in args.scenarios:
+            results["search"] = await search_benchmark(bazar, args.search_listings, args.search_pages)
+        if "subscriptions" in args.scenarios:
+            results["subscriptions"] = await subscription_benchmark(
+                bazar, args.subscriptions, args.posts, fanout=router is None
+            )
+    finally:
+        if router:
+            await router.stop()
+            for proc in procs:
+                proc.terminate()
+                proc.join(5)
+        else:
+            await bazar.dp.emit_shutdown(bot=bazar.bot)
+        await bazar.bot.session.close()
+        await fake.runner.cleanup()
+
+    results["max_rss_mb"] = max_rss_mb()
+    results["api_calls"] = fake.calls
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> bool:
+    ok = True
+    current, base = results.get("config", {}), baseline.get("config", {})
+    differs = [f"{key}: {base[key]} → {current.get(key)}" for key in base if key != "scenarios" and base[key] != current.get(key)]
+    if differs:
+        print("⚠️ базова лінія знята з іншими параметрами (" + ", ".join(differs) + ")")
+    current, base = results.get("startup"), baseline.get("startup")
+    if current and base:
+        delta = (current["first_update_ms"] - base["first_update_ms"]) / base["first_update_ms"]
+        worse = delta > tolerance
+        ok &= not worse
+        print(f"{'startup':>11}: first update {base['first_update_ms']} → {current['first_update_ms']} ms ({delta:+.0%})"
+              + ("  ❌ REGRESSION" if worse else ""))
+    for scenario, current in results.items():
+        base = baseline.get(scenario)
+        if not isinstance(current, dict) or not isinstance(base, dict) or "p99_ms" not in base:
+            continue
+        p99_delta = (current["p99_ms"] - base["p99_ms"]) / base["p99_ms"]
+        tput_delta = (current["throughput"] - base["throughput"]) / base["throughput"]
+        worse = p99_delta > tolerance or tput_delta < -tolerance
+        ok &= not worse
+        print(f"{scenario:>11}: p99 {base['p99_ms']} → {current['p99_ms']} ms ({p99_delta:+.0%}), "
+              f"throughput {base['throughput']} → {current['throughput']}/s ({tput_delta:+.0%})"
+              + ("  ❌ REGRESSION" if worse else ""))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--submitters", type=int, default=50, help="одночасних користувачів у сценарії submitters")
+    parser.add_argument("--moderators", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=500, help="одночасно активних користувачів")
+    parser.add_argument("--scenarios", default="startup,form,submitters,album,moderation,webhook,schedule,render,tags,duplicates,queue")
+    parser.add_argument("--album-latency", type=float, default=0.05, help="вікно AlbumMiddleware, с")
+    parser.add_argument("--real-limits", action="store_true", help="не вимикати rate limit відправки")
+    parser.add_argument("--shards", type=int, default=1, help="кількість процесів-воркерів (як SHARDS)")
+    parser.add_argument("--webhook-workers", type=int, default=8, help="воркери WebhookHandler (WEBHOOK_WORKERS)")
+    parser.add_argument("--webhook-queue", type=int, default=1000, help="черга WebhookHandler (WEBHOOK_QUEUE_SIZE)")
+    parser.add_argument("--replay", help="JSONL із записаними апдейтами для сценарію webhook")
+    parser.add_argument("--dup-rows", type=int, default=200_000, help="заявок для сценарію duplicates")
+    parser.add_argument("--queue-rows", type=int, default=100_000, help="заявок на модерації для сценарію queue")
+    parser.add_argument("--migrate-rows", type=int, default=1_000_000, help="заявок у старій БД для сценарію migrate")
+    parser.add_argument("--search-listings", type=int, default=500_000, help="оголошень для сценарію search")
+    parser.add_argument("--search-pages", type=int, default=10, help="сторінок на запит у сценарії search")
+    parser.add_argument("--listings", type=int, default=20_000, help="оголошень для сценарію render")
+    parser.add_argument("--retag-rows", type=int, default=50_000, help="рядків для retag_all у сценарії tags")
+    parser.add_argument("--subscriptions", type=int, default=100_000, help="підписок для сценарію subscriptions")
+    parser.add_argument("--posts", type=int, default=1000, help="нових постів для сценарію subscriptions")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadtest_baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    args.scenarios = set(args.scenarios.split(","))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        results = asyncio.run(main(args))
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Baseline saved to {args.baseline}")
+
+    if args.compare:
+        with open(args.baseline) as f:
+            if not compare(results, json.load(f), args.tolerance):
+                sys.exit(1)